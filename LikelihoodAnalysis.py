@@ -2,14 +2,27 @@ import os
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib.widgets import Slider
 
 from utils import load_from_h5, used_columns
+from cache import file_fingerprint, stage_key
+from render import draw_points
 
+#files in the "data" subfolder
 filenames = ["new_neutrino11x.h5", "new_neutrino12x.h5", "new_neutrino13x.h5"]
-filepaths = [os.path.join("data", filename) for filename in filenames]
 
-print("Loading dataframe")
-dataframe = load_from_h5(filepaths)
+#columns kept for the analysis
+likelihood_columns = ["Track reconstruction likelyhood", "Shower reconstruction likelyhood", "energy", "Is shower?"]
+
+#histogram index for energy-threshold scans, rebuilt automatically when the files or binning change
+index_filepath = os.path.join("data", "likelihood_index.npz")
+likelihood_bins = 100
+likelihood_range = [[0,3000],[-2500,0]]
+
+Emin = 9000
+separated_figures = True
+render_mode = 'scatter' #'raster' or 'decimate' for productions too large to scatter every event
+energy_scan = False #True opens an interactive energy-threshold scan of the histograms from the saved index instead of loading the events
 
 
 def preprocessing_data(dataframe,Emin):
@@ -34,7 +47,7 @@ def preprocessing_data(dataframe,Emin):
     print("Missing values: {}".format(dataframe.isnull().values.sum()))
 
     print('Only retaining relevant columns related to likelihood and energy')
-    dataframe = dataframe.filter(["Track reconstruction likelyhood", "Shower reconstruction likelyhood","energy","Is shower?"])
+    dataframe = dataframe.filter(likelihood_columns)
 
     print(f'Dropping low-energy values below {Emin}')
     dataframe = dataframe[dataframe['energy']>Emin]
@@ -43,7 +56,33 @@ def preprocessing_data(dataframe,Emin):
     return dataframe
 
 
-def plotting_hist_scatter(dataframe,separated_figures):
+def load_likelihood_data(filepaths, Emin=None):
+    '''
+    Loads the likelihood columns of the events passing the same cuts as `preprocessing_data`, applying the cuts while reading.
+
+    Only the rows which pass are ever held in memory, so the memory used scales with the number of selected events.
+
+    Arguments
+    --------
+    filepaths : list
+        Paths to the data files
+    Emin    : float or None
+        Lower energy threshold for data to be taken into account. If None, there is no energy threshold
+
+    Returns
+    -------
+    dataframe : pd.DataFrame
+        Pre-processed dataframe, as returned by `preprocessing_data`
+    '''
+    filters = [("Track reconstruction likelyhood", ">", 0)]
+    if(Emin is not None):
+        print(f'Loading events with energy above {Emin}')
+        filters.insert(0, ("energy", ">", Emin))
+    dataframe = load_from_h5(filepaths, columns=likelihood_columns, filters=filters, dropna=True)
+    return dataframe[likelihood_columns]
+
+
+def plotting_hist_scatter(dataframe,separated_figures,render_mode='scatter',max_points=100000):
     '''
     Plotting a scatter plot of the likelihood data track vs. shower.
     Plotting 2d histograms of track and shower likelihood.
@@ -54,6 +93,11 @@ def plotting_hist_scatter(dataframe,separated_figures):
         Name of dataframe
     separated   : bool
         Set type of plot. If 'True', then plots separated plots, if 'False' plots come in two figures.
+    render_mode : str
+        'scatter' draws every event, 'raster' draws a fixed-size image of the events coloured per class,
+        'decimate' draws a random subset of at most `max_points` events. See `render.draw_points`.
+    max_points  : int
+        Maximum number of events drawn per plot for 'decimate'
     '''
     x = dataframe["Track reconstruction likelyhood"]
     y = dataframe["Shower reconstruction likelyhood"]
@@ -70,15 +114,14 @@ def plotting_hist_scatter(dataframe,separated_figures):
 
     if separated_figures==True :
         plt.figure(num=1,figsize=(7, 4))
-        plt.scatter(x,y,marker='.',c='C2',s=2)
+        draw_points(plt.gca(), [(x, y, 'C2', None)], render_mode, max_points=max_points, marker='.', s=2)
         plt.xlabel('Track reconstruction likelihood')
         plt.ylabel('Shower reconstruction likelihood')
         plt.title(f'Scatter plot for track and shower events (unmarked) with energy > {Emin}')
         plt.tight_layout()
 
         plt.figure(num=2,figsize=(6, 4))
-        plt.scatter(x_track,y_track,marker='.',label='Track event',s=2)
-        plt.scatter(x_shower,y_shower,marker='.',label='Shower event',c='orange',s=2)
+        draw_points(plt.gca(), [(x_track, y_track, 'C0', 'Track event'), (x_shower, y_shower, 'orange', 'Shower event')], render_mode, max_points=max_points, marker='.', s=2)
         plt.xlabel('Track reconstruction likelihood')
         plt.ylabel('Shower reconstruction likelihood')
         plt.title(f'Scatter plot for track and shower events with energy > {Emin}')
@@ -86,21 +129,21 @@ def plotting_hist_scatter(dataframe,separated_figures):
         plt.tight_layout()
 
         plt.figure(num=3,figsize=(6, 4))
-        plt.scatter(x_track,y_track,marker='.',s=2)
+        draw_points(plt.gca(), [(x_track, y_track, 'C0', None)], render_mode, max_points=max_points, marker='.', s=2)
         plt.xlabel('Track reconstruction likelihood')
         plt.ylabel('Shower reconstruction likelihood')
         plt.title(f'Scatter plot for track events with energy > {Emin}')
         plt.tight_layout()
 
         plt.figure(num=4,figsize=(6, 4))
-        plt.scatter(x_shower,y_shower,marker='.',c='orange',s=2)
+        draw_points(plt.gca(), [(x_shower, y_shower, 'orange', None)], render_mode, max_points=max_points, marker='.', s=2)
         plt.xlabel('Track reconstruction likelihood')
         plt.ylabel('Shower reconstruction likelihood')
         plt.title(f'Scatter plot for shower events with energy > {Emin}')
         plt.tight_layout()
 
         fig1 = plt.figure(num=5,figsize=(6, 4))
-        h1 = plt.hist2d(x_track,y_track, bins=100,range=[[0,3000],[-2500,0]],norm='asinh',cmap='viridis')
+        h1 = plt.hist2d(x_track,y_track, bins=likelihood_bins,range=likelihood_range,norm='asinh',cmap='viridis')
         plt.xlabel('Track reconstruction likelihood')
         plt.ylabel('Shower reconstruction likelihood')
         plt.title(f'2d histogram, track data with energy > {Emin}')
@@ -108,7 +151,7 @@ def plotting_hist_scatter(dataframe,separated_figures):
         plt.tight_layout()
 
         fig2 = plt.figure(num=6,figsize=(6, 4))
-        h2 = plt.hist2d(x_shower,y_shower, bins=100,range=[[0,3000],[-2500,0]],norm='asinh',cmap='viridis')
+        h2 = plt.hist2d(x_shower,y_shower, bins=likelihood_bins,range=likelihood_range,norm='asinh',cmap='viridis')
         plt.xlabel('Track reconstruction likelihood')
         plt.ylabel('Shower reconstruction likelihood')
         plt.title(f'2d histogram, shower data with energy > {Emin}')
@@ -120,25 +163,24 @@ def plotting_hist_scatter(dataframe,separated_figures):
     else:
         fig1, [[ax1, ax2], [ax3, ax4]] = plt.subplots(2,2,figsize=(15,15))
 
-        ax1.scatter(x,y,c='C2',s=2)
+        draw_points(ax1, [(x, y, 'C2', None)], render_mode, max_points=max_points, s=2)
         ax1.set_xlabel('Track reconstruction likelihood')
         ax1.set_ylabel('Shower reconstruction likelihood')
         ax1.set_title('Scatter plot for track and shower events (unmarked)')
 
-        ax2.scatter(x_track,y_track,marker='.',label='Track event',s=2)
-        ax2.scatter(x_shower,y_shower,marker='.',label='Shower event',c='orange',s=2)
+        draw_points(ax2, [(x_track, y_track, 'C0', 'Track event'), (x_shower, y_shower, 'orange', 'Shower event')], render_mode, max_points=max_points, marker='.', s=2)
         ax2.set_xlabel('Track reconstruction likelihood')
         ax2.set_ylabel('Shower reconstruction likelihood')
         ax2.set_title('Scatter plot for track and shower events')
         ax2.legend()
 
-        ax3.scatter(x_track,y_track,marker='.',label='Track event',s=2)
+        draw_points(ax3, [(x_track, y_track, 'C0', 'Track event')], render_mode, max_points=max_points, marker='.', s=2)
         ax3.set_xlabel('Track reconstruction likelihood')
         ax3.set_ylabel('Shower reconstruction likelihood')
         ax3.set_title('Scatter plot for track events')
         ax3.legend()
 
-        ax4.scatter(x_shower,y_shower,marker='.',label='Shower event',c='orange',s=2)
+        draw_points(ax4, [(x_shower, y_shower, 'orange', 'Shower event')], render_mode, max_points=max_points, marker='.', s=2)
         ax4.set_xlabel('Track reconstruction likelihood')
         ax4.set_ylabel('Shower reconstruction likelihood')
         ax4.set_title('Scatter plot for shower events')
@@ -151,25 +193,25 @@ def plotting_hist_scatter(dataframe,separated_figures):
 
         fig2, [[ax5,ax6], [ax7, ax8]] = plt.subplots(2,2,figsize=(15,15))
 
-        h1 = ax5.hist2d(x,y, bins=100,range=[[0,3000],[-2500,0]],norm='asinh',cmap='viridis')
+        h1 = ax5.hist2d(x,y, bins=likelihood_bins,range=likelihood_range,norm='asinh',cmap='viridis')
         ax5.set_xlabel('Track reconstruction likelihood')
         ax5.set_ylabel('Shower reconstruction likelihood')
         ax5.set_title('2d histogram, all data')
         fig2.colorbar(h1[3])
 
-        ax6.scatter(x,y,marker='.',c='orange',s=2)
+        draw_points(ax6, [(x, y, 'orange', None)], render_mode, max_points=max_points, marker='.', s=2)
         ax6.set_xlabel('Track reconstruction likelihood')
         ax6.set_ylabel('Shower reconstruction likelihood')
         ax6.set_title('Scatter plot for track and shower events')
         ax6.legend()
 
-        h3 = ax7.hist2d(x_track,y_track, bins=100,range=[[0,3000],[-2500,0]],norm='asinh',cmap='viridis')
+        h3 = ax7.hist2d(x_track,y_track, bins=likelihood_bins,range=likelihood_range,norm='asinh',cmap='viridis')
         ax7.set_xlabel('Track reconstruction likelihood')
         ax7.set_ylabel('Shower reconstruction likelihood')
         ax7.set_title('2d histogram, track data')
         fig2.colorbar(h3[3])
 
-        h4 = ax8.hist2d(x_shower,y_shower, bins=100,range=[[0,3000],[-2500,0]],norm='asinh',cmap='viridis')
+        h4 = ax8.hist2d(x_shower,y_shower, bins=likelihood_bins,range=likelihood_range,norm='asinh',cmap='viridis')
         ax8.set_xlabel('Track reconstruction likelihood')
         ax8.set_ylabel('Shower reconstruction likelihood')
         ax8.set_title('2d histogram, shower data')
@@ -182,7 +224,190 @@ def plotting_hist_scatter(dataframe,separated_figures):
 
 
 
-Emin = 9000
-dataframe = preprocessing_data(dataframe, Emin)
+def _histogram_bins(values, edges):
+    #bin of each value as in np.histogramdd (the last edge belongs to the last bin), -1 or len(edges) - 1 outside the edges
+    bins = np.searchsorted(edges, values, side="right") - 1
+    bins[values == edges[-1]] = len(edges) - 2
+    return bins
+
+def build_likelihood_index(dataframe, energy_edges):
+    '''
+    Builds the track/shower likelihood histograms of each class, accumulated over energy bins from high to low energy.
+
+    The histograms of all events above any energy edge are then a single slice of the index. For a threshold between
+    two edges, the events of the energy bin containing it are kept as well, sorted by energy, so that the part of that
+    bin above the threshold can be added exactly.
+
+    Arguments
+    --------
+    dataframe   : pd.DataFrame
+        Pre-processed dataframe (see `preprocessing_data`), without energy cut
+    energy_edges : np.ndarray
+        Increasing energy bin edges
+
+    Returns
+    -------
+    index : dict
+        "cumulative": array of shape (2, len(energy_edges), bins, bins), where [c, k] is the histogram of class c
+        (0 = track, 1 = shower) for events with energy >= energy_edges[k]; "energies": the energies of the histogrammed
+        events, sorted, and "cells": the bin of each of them in the flattened histograms of shape (2, bins, bins);
+        plus the "energy_edges", "x_edges" and "y_edges"
+    '''
+    energy_edges = np.asarray(energy_edges)
+    x_edges = np.linspace(*likelihood_range[0], likelihood_bins + 1)
+    y_edges = np.linspace(*likelihood_range[1], likelihood_bins + 1)
+
+    energy = dataframe["energy"].to_numpy()
+    energy_bin = np.searchsorted(energy_edges, energy, side="right") - 1
+    x_bin = _histogram_bins(dataframe["Track reconstruction likelyhood"].to_numpy(), x_edges)
+    y_bin = _histogram_bins(dataframe["Shower reconstruction likelyhood"].to_numpy(), y_edges)
+    valid = ((energy_bin >= 0) & ~np.isnan(energy) & (x_bin >= 0) & (x_bin < likelihood_bins) & (y_bin >= 0) & (y_bin < likelihood_bins))
+
+    n_cells = 2 * likelihood_bins**2
+    cells = ((dataframe["Is shower?"].to_numpy(dtype=np.int64) * likelihood_bins + x_bin) * likelihood_bins + y_bin)[valid]
+    counts = np.bincount(energy_bin[valid] * n_cells + cells, minlength=len(energy_edges) * n_cells)
+    counts = counts.reshape(len(energy_edges), 2, likelihood_bins, likelihood_bins).swapaxes(0, 1)
+
+    #accumulate from the highest energy bin downwards
+    cumulative = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1].astype(np.int64)
+    order = np.argsort(energy[valid], kind="stable")
+    return {"cumulative": cumulative, "energies": energy[valid][order], "cells": cells[order].astype(np.int32),
+            "energy_edges": energy_edges, "x_edges": x_edges, "y_edges": y_edges}
+
+def likelihood_index(filepaths, index_filepath, energy_edges=None, n_energy_bins=200):
+    '''
+    Loads the histogram index from disk, or builds and saves it if it is missing or outdated.
+
+    Arguments
+    --------
+    filepaths   : list
+        Paths to the data files
+    index_filepath : str
+        Path to the saved index (.npz)
+    energy_edges : np.ndarray or None
+        Energy bin edges. If None, `n_energy_bins` logarithmically spaced edges spanning the energies in the data are used
+    n_energy_bins : int
+        Number of energy bins if `energy_edges` is None
+
+    Returns
+    -------
+    index : dict
+        See `build_likelihood_index`
+    '''
+    #"events" marks indexes which keep the sorted events, older saved indexes are rebuilt
+    key = stage_key([file_fingerprint(filepath) for filepath in filepaths], None if energy_edges is None else list(energy_edges),
+                    n_energy_bins, likelihood_bins, likelihood_range, "events")
+    names = ("cumulative", "energies", "cells", "energy_edges", "x_edges", "y_edges")
+    if(os.path.isfile(index_filepath)):
+        with np.load(index_filepath) as saved:
+            if(str(saved["key"]) == key):
+                print("Using saved histogram index {}".format(index_filepath))
+                return {name: saved[name] for name in names}
+
+    print("Loading dataframe")
+    dataframe = load_likelihood_data(filepaths)
+    if(energy_edges is None):
+        energy_edges = np.geomspace(dataframe["energy"].min(), dataframe["energy"].max(), n_energy_bins)
+
+    print("Building histogram index")
+    index = build_likelihood_index(dataframe, energy_edges)
+    np.savez(index_filepath, key=key, **index)
+    return index
+
+def _histograms_above(index, energy):
+    #histograms of the events with an energy above `energy`: the bins above the edge following it, plus the events of its own bin above it
+    cumulative, energy_edges, energies = index["cumulative"], index["energy_edges"], index["energies"]
+    k = np.searchsorted(energy_edges, energy, side="right")
+    if(k < len(energy_edges)):
+        histograms = cumulative[:, k].copy()
+        high = np.searchsorted(energies, energy_edges[k], side="left")
+    else:
+        histograms = np.zeros_like(cumulative[:, 0])
+        high = len(energies)
+    low = np.searchsorted(energies, energy, side="right")
+    histograms += np.bincount(index["cells"][low:high], minlength=histograms.size).reshape(histograms.shape)
+    return histograms
+
+def index_histograms(index, Emin, Emax=None):
+    '''
+    Histograms of track and shower events in an energy window (Emin < energy <= Emax), from the index.
+
+    The cut is exact for any threshold, as in `load_likelihood_data`: only the events of the energy bins containing
+    the thresholds are counted one by one.
+
+    Arguments
+    --------
+    index   : dict
+        See `build_likelihood_index`
+    Emin    : float
+        Lower energy threshold
+    Emax    : float or None
+        Upper energy threshold, None for no upper threshold
+
+    Returns
+    -------
+    H_track, H_shower, H_all : np.ndarray
+        Histograms of track events, shower events and all events, indexed as [x, y]
+    '''
+    histograms = _histograms_above(index, Emin)
+    if(Emax is not None):
+        histograms = histograms - _histograms_above(index, Emax)
+
+    return histograms[0], histograms[1], histograms[0] + histograms[1]
+
+def plot_energy_scan(index, Emin):
+    '''
+    Plots the 2d histograms of track, shower and all events from the index, with a slider to change the energy threshold interactively.
+
+    Arguments
+    --------
+    index   : dict
+        See `build_likelihood_index`
+    Emin    : float
+        Initial energy threshold
+    '''
+    fig, axes = plt.subplots(1, 3, figsize=(18, 6))
+    fig.subplots_adjust(bottom=0.2)
+    extent = [*likelihood_range[0], *likelihood_range[1]]
+    titles = ['2d histogram, track data', '2d histogram, shower data', '2d histogram, all data']
+
+    images = []
+    for ax, H, title in zip(axes, index_histograms(index, Emin), titles):
+        image = ax.imshow(H.T, origin='lower', extent=extent, aspect='auto', norm='asinh', cmap='viridis')
+        ax.set_xlabel('Track reconstruction likelihood')
+        ax.set_ylabel('Shower reconstruction likelihood')
+        ax.set_title(title)
+        fig.colorbar(image, ax=ax)
+        images.append(image)
+
+    energy_edges = index["energy_edges"]
+    slider_ax = fig.add_axes([0.2, 0.05, 0.6, 0.03])
+    slider = Slider(slider_ax, 'log10(Emin)', np.log10(energy_edges[0]), np.log10(energy_edges[-1]), valinit=np.log10(max(Emin, energy_edges[0])))
+
+    def update(value):
+        for image, H in zip(images, index_histograms(index, 10**value)):
+            image.set_data(H.T)
+            image.autoscale()
+        fig.suptitle(f'Likelihood histograms with energy > {10**value:.0f}')
+        fig.canvas.draw_idle()
+
+    slider.on_changed(update)
+    update(slider.val)
+    plt.show()
+
+
+def main():
+    filepaths = [os.path.join("data", filename) for filename in filenames]
+
+    if energy_scan:
+        index = likelihood_index(filepaths, index_filepath)
+        plot_energy_scan(index, Emin)
+    else:
+        print("Loading dataframe")
+        dataframe = load_likelihood_data(filepaths, Emin)
+
+        plotting_hist_scatter(dataframe,separated_figures=separated_figures,render_mode=render_mode)
+
 
-plotting_hist_scatter(dataframe,separated_figures=True)
\ No newline at end of file
+if(__name__ == "__main__"):
+    main()
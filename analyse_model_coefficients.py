@@ -1,16 +1,71 @@
 import os
 import matplotlib.pyplot as plt
 import numpy as np
-from joblib import load
 
+from registry import load_model, read_index
+
+#file in the "models" subfolder; None uses the registered linear model with the best validation score
 model_filename = r"m9.joblib"
-model_filepath = os.path.join("models", model_filename)
 
-classifier = load(model_filepath)
+#"coefficients" for linear models, "permutation" for the permutation importance of any model,
+#"auto" uses the coefficients if the model has them and the permutation importance otherwise
+importance = "auto"
+
+#permutation importance, on a stratified subsample of the validation set of the model
+n_samples = 20000
+min_repeats = 5
+max_repeats = 50
+tolerance = 0.002 #stops repeating a feature once its 95% confidence interval is narrower than +/- tolerance
+n_jobs = None
+random_state = 0
+
+
+def best_linear_model(models_dir):
+    """Returns the file name of the registered model with coefficients (LinearSVC, or SVC with a linear kernel) with the best validation score."""
+    linear = {filename: metadata for filename, metadata in read_index(models_dir).items()
+              if metadata["classifier_type"] == "LinearSVC" or (metadata["classifier_type"] == "SVC" and metadata["params"].get("kernel") == "linear")}
+    if(not linear):
+        raise FileNotFoundError("No registered linear models in {}".format(models_dir))
+    return max(linear, key=lambda filename: -np.inf if linear[filename].get("score") is None else linear[filename]["score"])
+
+def plot_feature_bars(feature_names, values, title, errors=None):
+    """Plots a value per feature as a horizontal bar chart, with optional error bars."""
+    plt.figure(constrained_layout=True, figsize=(12, 6))
+    plt.barh(feature_names, values, xerr=errors, capsize=3 if errors is not None else 0)
+    plt.title(title)
+    plt.show()
+
+def plot_coefficients(model_filepath):
+    """Plots the absolute values of the feature coefficients of a saved linear classifier."""
+    classifier = load_model(model_filepath)
+
+    coefficients = classifier.coef_[0,:]
+    coefficients = np.absolute(coefficients)
+    plot_feature_bars(classifier.feature_names_in_, coefficients, "Absolute values of the feature coefficients used in the SVM classifier")
+
+def plot_permutation_importance(model_filepath):
+    """Computes and plots the permutation importance of each feature of a saved classifier, with 95% confidence intervals."""
+    from importance import stratified_subsample, permutation_importance
+    from evaluation import validation_set
+
+    X_valid, y_valid, other = validation_set(model_filepath)
+    X_valid, y_valid = stratified_subsample(X_valid, y_valid, n_samples, random_state)
+    print("Computing permutation importance on {} validation samples".format(len(X_valid)))
+    importances = permutation_importance(model_filepath, X_valid, y_valid, min_repeats=min_repeats, max_repeats=max_repeats, tolerance=tolerance,
+                                         n_jobs=n_jobs, random_state=random_state, baseline_cache_filepath=os.path.splitext(model_filepath)[0] + "_baseline.npz")
+    print(importances.to_string(index=False))
+
+    importances = importances.iloc[::-1]
+    plot_feature_bars(importances["Feature"], importances["Importance"], "Permutation importance (drop in validation accuracy)", errors=importances["CI half-width"])
+
+def main():
+    filename = model_filename if model_filename is not None else best_linear_model("models")
+    model_filepath = os.path.join("models", filename)
+    if(importance == "coefficients" or (importance == "auto" and hasattr(load_model(model_filepath), "coef_"))):
+        plot_coefficients(model_filepath)
+    else:
+        plot_permutation_importance(model_filepath)
+
 
-coefficients = classifier.coef_[0,:]
-coefficients = np.absolute(coefficients)
-plt.figure(constrained_layout=True, figsize=(12, 6))
-plt.barh(classifier.feature_names_in_, coefficients)
-plt.title("Absolute values of the feature coefficients used in the SVM classifier")
-plt.show()
\ No newline at end of file
+if(__name__ == "__main__"):
+    main()
@@ -0,0 +1,158 @@
+import time
+import numpy as np
+import pandas as pd
+from sklearn.kernel_approximation import Nystroem, PolynomialCountSketch
+from sklearn.linear_model import SGDClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.svm import SVC
+
+
+def make_feature_map(method="nystroem", n_components=1000, kernel="poly", degree=3, gamma=None, coef0=0, random_state=None):
+    """
+    Creates an explicit feature map approximating the kernel of an `SVC`.
+
+    Arguments
+    ---------
+    method : str
+        "nystroem" for a Nystroem approximation (any kernel) or "count_sketch" for random polynomial features (poly kernel only)
+    n_components : int
+        Number of features of the approximation; larger is more accurate and slower
+    kernel, degree, gamma, coef0
+        Kernel parameters, as for `SVC`. If `gamma` is None, it is set like gamma="scale" by `fit_approximate`
+    random_state : int or None
+        Seed for sampling the approximation
+
+    Returns
+    -------
+    feature_map : Nystroem or PolynomialCountSketch
+        Unfitted feature map
+    """
+    if(method == "nystroem"):
+        return Nystroem(kernel=kernel, degree=degree, gamma=gamma, coef0=coef0, n_components=n_components, random_state=random_state)
+    elif(method == "count_sketch"):
+        if(kernel != "poly"):
+            raise ValueError("count_sketch only approximates the poly kernel, not '{}'".format(kernel))
+        return PolynomialCountSketch(degree=degree, gamma=gamma, coef0=coef0, n_components=n_components, random_state=random_state)
+    else:
+        raise ValueError("Unknown kernel approximation '{}'".format(method))
+
+def fit_approximate(chunks, feature_map, classes=(False, True), n_epochs=5, alpha=1e-4, random_state=None):
+    """
+    Trains a linear SVM on approximate kernel features, one chunk of data at a time.
+
+    The feature map is fitted on the first chunk, so that chunk should be a representative sample (e.g. shuffled).
+    The linear model is trained with `SGDClassifier.partial_fit` (hinge loss), so the full dataset never has to be in memory.
+
+    Arguments
+    ---------
+    chunks : callable
+        Function without arguments returning a fresh iterable of (X, y) chunks each time it is called
+    feature_map : Nystroem or PolynomialCountSketch
+        Unfitted feature map, see `make_feature_map`
+    classes : tuple
+        All labels which occur in the data
+    n_epochs : int
+        Number of passes over the chunks
+    alpha : float
+        Regularisation strength of the linear model
+    random_state : int or None
+        Seed for the linear model
+
+    Returns
+    -------
+    classifier : Pipeline
+        Fitted feature map followed by the linear model, usable like any sklearn classifier
+    """
+    classifier = SGDClassifier(loss="hinge", alpha=alpha, random_state=random_state)
+    fitted = False
+    for epoch in range(n_epochs):
+        for X, y in chunks():
+            if(not fitted):
+                if(feature_map.gamma is None):
+                    #same as SVC(gamma="scale")
+                    feature_map.set_params(gamma=1 / (X.shape[1] * np.asarray(X, dtype=float).var()))
+                feature_map.fit(X)
+                fitted = True
+            classifier.partial_fit(feature_map.transform(X), y, classes=np.asarray(classes))
+
+    return Pipeline([("feature_map", feature_map), ("classifier", classifier)])
+
+def array_chunks(X, y, chunksize, shuffle=True, random_state=None):
+    """
+    Returns a function which yields (X, y) chunks of in-memory data, for use with `fit_approximate`.
+
+    Arguments
+    ---------
+    X : pd.DataFrame
+        Features
+    y : pd.Series
+        Labels
+    chunksize : int
+        Number of rows per chunk
+    shuffle : bool
+        Whether to shuffle the rows (once) before dividing them into chunks, so that every chunk is a representative sample
+    random_state : int or None
+        Seed for shuffling
+
+    Returns
+    -------
+    chunks : callable
+        Function without arguments returning a generator of (X, y) chunks
+    """
+    if(shuffle):
+        permutation = np.random.default_rng(random_state).permutation(len(X))
+        X, y = X.iloc[permutation], y.iloc[permutation]
+    return lambda: ((X.iloc[start:start + chunksize], y.iloc[start:start + chunksize]) for start in range(0, len(X), chunksize))
+
+def compare_with_exact(X_train, y_train, X_valid, y_valid, approximate_configs, chunksize=100000, exact_kernel="poly", exact_max_samples=None, random_state=None):
+    """
+    Trains the exact `SVC` and approximate-kernel models on the same data and reports accuracy and wall-clock time side by side.
+
+    Arguments
+    ---------
+    X_train, y_train, X_valid, y_valid : pd.DataFrame, pd.Series
+        Training and validation sets
+    approximate_configs : list of dict
+        Keyword arguments for `make_feature_map` (plus optionally "n_epochs" and "alpha" for `fit_approximate`), one per model
+    chunksize : int
+        Number of rows per chunk for the approximate models
+    exact_kernel : str
+        Kernel of the exact `SVC`. If None, the exact model is skipped
+    exact_max_samples : int or None
+        If given, the exact `SVC` is trained on at most this many (randomly chosen) training samples, to keep it tractable
+    random_state : int or None
+        Seed for the approximations and the subsample of the exact model
+
+    Returns
+    -------
+    results : pd.DataFrame
+        One row per model with its accuracy, training samples, fit time and predict time
+    """
+    rows = []
+    shuffled = np.random.default_rng(random_state).permutation(len(X_train))
+    X_train, y_train = X_train.iloc[shuffled], y_train.iloc[shuffled]
+
+    if(exact_kernel is not None):
+        n_samples = len(X_train) if exact_max_samples is None else min(exact_max_samples, len(X_train))
+        start = time.perf_counter()
+        classifier = SVC(kernel=exact_kernel).fit(X_train.iloc[:n_samples], y_train.iloc[:n_samples])
+        fit_time = time.perf_counter() - start
+        start = time.perf_counter()
+        accuracy = classifier.score(X_valid, y_valid)
+        rows.append({"Model": "SVC(kernel={})".format(exact_kernel), "Accuracy": accuracy, "Training samples": n_samples,
+                     "Fit time (s)": fit_time, "Predict time (s)": time.perf_counter() - start})
+
+    for config in approximate_configs:
+        config = dict(config)
+        fit_kwargs = {key: config.pop(key) for key in ("n_epochs", "alpha") if key in config}
+        feature_map = make_feature_map(random_state=random_state, **config)
+
+        start = time.perf_counter()
+        classifier = fit_approximate(array_chunks(X_train, y_train, chunksize, shuffle=False), feature_map, classes=np.unique(y_train), random_state=random_state, **fit_kwargs)
+        fit_time = time.perf_counter() - start
+        start = time.perf_counter()
+        accuracy = classifier.score(X_valid, y_valid)
+        rows.append({"Model": "{}(n_components={})".format(config.get("method", "nystroem"), feature_map.n_components), "Accuracy": accuracy,
+                     "Training samples": len(X_train), "Fit time (s)": fit_time, "Predict time (s)": time.perf_counter() - start})
+
+    return pd.DataFrame(rows)
@@ -0,0 +1,226 @@
+import os
+import sys
+import time
+import subprocess
+import tracemalloc
+import pandas as pd
+import matplotlib.pyplot as plt
+from sklearn.svm import LinearSVC, SVC
+from sklearn.ensemble import RandomForestClassifier
+
+from utils import load_from_h5, used_columns, equal_entries_df, train_test_balanced, normalise_dataframe
+from normaliser import QuantileNormaliser
+from plot_density import density_grid
+from synthetic_data import write_synthetic_files
+from compiled_model import compile_model
+from train import excluded_columns, equalised_columns
+
+
+def measure(function, *args, measure_memory=True, repeat=1, **kwargs):
+    """
+    Measures the wall time and peak memory of a function call.
+
+    The function is timed `repeat` times, and called once more under tracemalloc if `measure_memory` is True,
+    as tracemalloc slows down the call. Memory allocated in child processes is not included.
+
+    Arguments
+    ---------
+    function : callable
+        Function to be measured
+    *args, **kwargs
+        Arguments of the function
+    measure_memory : bool
+        Whether to measure the peak memory
+    repeat : int
+        Number of timed calls
+
+    Returns
+    -------
+    result
+        Return value of the function
+    wall_time : float
+        Shortest wall time of the timed calls in seconds
+    peak_memory : int or None
+        Peak memory allocated during the call in bytes
+    """
+    wall_time = float("inf")
+    for index in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        wall_time = min(wall_time, time.perf_counter() - start)
+
+    peak_memory = None
+    if(measure_memory):
+        tracemalloc.start()
+        function(*args, **kwargs)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return result, wall_time, peak_memory
+
+def run_benchmarks(sizes, data_dir, measure_memory=True, repeat=1, fit_max_samples=20000, kde_datapoints=1000, batch_sizes=(1, 100, 10000), random_state=0):
+    """
+    Times and memory-profiles the stages of the pipeline on synthetic data of several sizes.
+
+    Arguments
+    ---------
+    sizes : list
+        Numbers of events to benchmark with
+    data_dir : str
+        Directory the synthetic HDF files are written to
+    measure_memory : bool
+        Whether to measure the peak memory of each stage
+    repeat : int
+        Number of timed calls per stage, of which the shortest is reported
+    fit_max_samples : int
+        Maximum number of training samples for the exact SVC, which scales badly
+    kde_datapoints : int
+        Number of tracks used for the exact density grid; the binned (FFT) density grid uses all tracks
+    batch_sizes : list
+        Numbers of validation events predicted per call, with the fitted sklearn models and their compiled versions
+    random_state : int
+        Seed of the synthetic data and the split
+
+    Returns
+    -------
+    results : pd.DataFrame
+        One row per benchmark and size, with the wall time (s) and peak memory (bytes)
+    """
+    rows = []
+    def record(benchmark, n_events, function, *args, **kwargs):
+        result, wall_time, peak_memory = measure(function, *args, measure_memory=measure_memory, repeat=repeat, **kwargs)
+        rows.append({"Benchmark": benchmark, "Events": n_events, "Wall time (s)": wall_time, "Peak memory (bytes)": peak_memory})
+        print("{:<52} {:>10} events: {:10.5f} s".format(benchmark, n_events, wall_time))
+        return result
+
+    train_columns = [x for x in used_columns if x not in excluded_columns]
+    for n_events in sizes:
+        filepaths = write_synthetic_files(os.path.join(data_dir, str(n_events)), n_events, random_state=random_state)
+
+        dataframe = record("load_from_h5", n_events, load_from_h5, filepaths, columns=used_columns)
+        dataframe = dataframe[used_columns].dropna()
+        balanced = record("equal_entries_df", n_events, equal_entries_df, equalised_columns, dataframe, used_columns)
+        X_train, X_valid, y_train, y_valid = record("train_test_balanced", n_events, train_test_balanced, balanced, equalised_columns, train_columns, random_state=random_state)
+        record("normalise_dataframe", n_events, lambda: normalise_dataframe(balanced.copy(), excluded_columns))
+        normaliser = record("QuantileNormaliser.fit", n_events, QuantileNormaliser().fit, X_train)
+        X_train = record("QuantileNormaliser.transform", n_events, normaliser.transform, X_train)
+        X_valid = normaliser.transform(X_valid)
+
+        classifiers = [
+            record("fit LinearSVC", n_events, LinearSVC(dual="auto").fit, X_train, y_train),
+            record("fit RandomForestClassifier", n_events, RandomForestClassifier(n_estimators=50, n_jobs=1, random_state=random_state).fit, X_train, y_train)
+        ]
+        record("fit SVC (poly)", n_events, SVC(kernel="poly").fit, X_train[:fit_max_samples], y_train[:fit_max_samples])
+
+        for classifier in classifiers:
+            compiled = compile_model(classifier)
+            for batch_size in batch_sizes:
+                batch = X_valid[:batch_size]
+                for predictor, label in [(classifier, "sklearn"), (compiled, "compiled")]:
+                    record("predict {} ({}), batch {}".format(type(classifier).__name__, label, batch_size), n_events, predictor.predict, batch)
+
+        tracks = dataframe[dataframe["Is shower?"] == False]
+        record("density_grid (exact)", n_events, density_grid, tracks, datapoint_count=kde_datapoints, method="exact")
+        record("density_grid (fft)", n_events, density_grid, tracks, method="fft")
+
+    return pd.DataFrame(rows)
+
+def benchmark_cold_start(subcommands, repeat=3):
+    """
+    Times how long the subcommands of cli.py take to start, each in a fresh Python process.
+
+    Two numbers are measured per subcommand: "--help", which should not import any heavy library,
+    and "--imports-only", which imports the module of the subcommand without running it.
+
+    Arguments
+    ---------
+    subcommands : list
+        Names of the subcommands
+    repeat : int
+        Number of runs per measurement, of which the shortest is reported
+
+    Returns
+    -------
+    results : pd.DataFrame
+        One row per subcommand and measurement, in the format of `run_benchmarks` with 0 events and no peak memory
+    """
+    cli_filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py")
+    rows = []
+    for subcommand in subcommands:
+        for flag in ["--help", "--imports-only"]:
+            wall_time = float("inf")
+            for index in range(repeat):
+                start = time.perf_counter()
+                subprocess.run([sys.executable, cli_filepath, subcommand, flag], check=True, stdout=subprocess.DEVNULL)
+                wall_time = min(wall_time, time.perf_counter() - start)
+            benchmark = "cold start {} {}".format(subcommand, flag)
+            rows.append({"Benchmark": benchmark, "Events": 0, "Wall time (s)": wall_time, "Peak memory (bytes)": None})
+            print("{:<46}: {:8.3f} s".format(benchmark, wall_time))
+    return pd.DataFrame(rows)
+
+def compare_to_baseline(results, baseline_filepath, tolerance=1.2):
+    """
+    Compares benchmark results with a saved baseline.
+
+    Arguments
+    ---------
+    results : pd.DataFrame
+        Results of `run_benchmarks`
+    baseline_filepath : str
+        Path to a JSON file with earlier results
+    tolerance : float
+        Ratio to the baseline above which a benchmark is flagged as slower
+
+    Returns
+    -------
+    comparison : pd.DataFrame
+        Wall time and peak memory of each benchmark relative to the baseline
+    """
+    baseline = pd.read_json(baseline_filepath, orient="records")
+    comparison = results.merge(baseline, on=["Benchmark", "Events"], suffixes=("", " (baseline)"))
+    comparison["Time ratio"] = comparison["Wall time (s)"] / comparison["Wall time (s) (baseline)"]
+    comparison["Memory ratio"] = comparison["Peak memory (bytes)"] / comparison["Peak memory (bytes) (baseline)"]
+    comparison["Slower"] = comparison["Time ratio"] > tolerance
+    return comparison[["Benchmark", "Events", "Wall time (s)", "Time ratio", "Peak memory (bytes)", "Memory ratio", "Slower"]]
+
+def plot_scaling(results):
+    """Plots the wall time and peak memory of each benchmark against the number of events."""
+    fig, [ax1, ax2] = plt.subplots(1, 2, figsize=(14, 6), constrained_layout=True)
+    #cold-start times do not depend on the number of events
+    for benchmark, frame in results[results["Events"] > 0].groupby("Benchmark", sort=False):
+        ax1.plot(frame["Events"], frame["Wall time (s)"], marker="o", label=benchmark)
+        ax2.plot(frame["Events"], frame["Peak memory (bytes)"], marker="o", label=benchmark)
+    for ax, label in [(ax1, "Wall time (s)"), (ax2, "Peak memory (bytes)")]:
+        ax.set_xscale("log")
+        ax.set_yscale("log")
+        ax.set_xlabel("Events")
+        ax.set_ylabel(label)
+    ax1.legend()
+    plt.show()
+
+
+if(__name__ == "__main__"):
+    sizes = [10000, 100000, 1000000]
+    data_dir = os.path.join("data", "benchmark")
+    results_filepath = os.path.join("benchmarks", "results.json")
+    baseline_filepath = os.path.join("benchmarks", "baseline.json")
+    update_baseline = False #set to True to save these results as the new baseline
+    measure_memory = True
+    repeat = 3
+    show_plot = True
+
+    cold_start_subcommands = ["train", "analyse-likelihood", "plot-density", "coefficients"]
+
+    results = run_benchmarks(sizes, data_dir, measure_memory=measure_memory, repeat=repeat)
+    results = pd.concat([results, benchmark_cold_start(cold_start_subcommands, repeat=repeat)], ignore_index=True)
+
+    os.makedirs(os.path.dirname(results_filepath), exist_ok=True)
+    results.to_json(results_filepath, orient="records", indent=1)
+    if(update_baseline or not os.path.isfile(baseline_filepath)):
+        print("Saving results as baseline at {}".format(baseline_filepath))
+        results.to_json(baseline_filepath, orient="records", indent=1)
+    else:
+        print(compare_to_baseline(results, baseline_filepath).to_string(index=False))
+
+    if(show_plot):
+        plot_scaling(results)
@@ -0,0 +1,143 @@
+import os
+import hashlib
+import tempfile
+import pandas as pd
+
+
+def file_fingerprint(filepath, use_hash=False):
+    """
+    Identifies the contents of a file without reading it.
+
+    Arguments
+    ---------
+    filepath : str
+        Path to the file
+    use_hash : bool
+        If True, the SHA-256 hash of the contents is used instead of the size and modification time.
+        Slower, but robust against files being copied or touched
+
+    Returns
+    -------
+    fingerprint : tuple
+        File name along with either (size, modification time) or the hash of the contents
+    """
+    if(use_hash):
+        sha = hashlib.sha256()
+        with open(filepath, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                sha.update(block)
+        return (os.path.basename(filepath), sha.hexdigest())
+
+    stat = os.stat(filepath)
+    return (os.path.basename(filepath), stat.st_size, stat.st_mtime_ns)
+
+def stage_key(*parts):
+    """
+    Combines the settings of a preprocessing stage into a short key.
+
+    Arguments
+    ---------
+    *parts
+        Anything with a deterministic repr, typically the key of the previous stage followed by the settings of this stage
+
+    Returns
+    -------
+    key : str
+        Hexadecimal key identifying the stage output
+    """
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:16]
+
+def evict_cache(cache_dir, max_bytes):
+    """
+    Removes the least recently used cache entries until the cache is at most `max_bytes` large.
+
+    Every file in `cache_dir` counts as an entry, i.e. the cached stages as well as other cached files such as the
+    spatial indexes of `spatial_index.py`, except the temporary files of entries being written (see `write_atomic`).
+    The most recently used entry is always kept.
+
+    Arguments
+    ---------
+    cache_dir : str
+        Directory containing the cached stages
+    max_bytes : int
+        Maximum total size of the cache in bytes
+    """
+    entries = [entry for entry in os.scandir(cache_dir) if entry.is_file() and not entry.name.endswith(".tmp")]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    total_bytes = sum(entry.stat().st_size for entry in entries)
+
+    for entry in entries[:-1]:
+        if(total_bytes <= max_bytes):
+            break
+        total_bytes -= entry.stat().st_size
+        os.remove(entry.path)
+        print("Evicted cache entry {}".format(entry.name))
+
+def write_atomic(filepath, write):
+    """
+    Writes a file under a temporary name in the same directory and renames it to `filepath` once it is complete, so that
+    an interrupted or concurrent write never leaves a partial file at `filepath`.
+
+    Arguments
+    ---------
+    filepath : str
+        Path of the file
+    write : callable
+        Function writing the file to the path it is given
+    """
+    descriptor, temporary_filepath = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(filepath) + ".", dir=os.path.dirname(filepath) or ".")
+    os.close(descriptor)
+    try:
+        write(temporary_filepath)
+        os.replace(temporary_filepath, filepath)
+    except BaseException:
+        if(os.path.isfile(temporary_filepath)):
+            os.remove(temporary_filepath)
+        raise
+
+def stage_filepath(cache_dir, stage, key):
+    """Returns the path at which the output of a stage is cached."""
+    return os.path.join(cache_dir, "{}-{}.parquet".format(stage, key))
+
+def is_cached(cache_dir, stage, key):
+    """Checks whether the output of a stage is cached."""
+    return os.path.isfile(stage_filepath(cache_dir, stage, key))
+
+def cached_stage(cache_dir, stage, key, compute, max_bytes=None):
+    """
+    Returns the output of a preprocessing stage, computing it only if it is not cached yet.
+
+    Stages are stored as `<stage>-<key>.parquet` in `cache_dir`. Reading an entry marks it as recently used.
+
+    Arguments
+    ---------
+    cache_dir : str
+        Directory containing the cached stages
+    stage : str
+        Name of the stage, e.g. "loaded"
+    key : str
+        Key of the stage output, see `stage_key`
+    compute : callable
+        Function without arguments which computes the stage output if it is not cached
+    max_bytes : int or None
+        Maximum total size of the cache in bytes. If None, nothing is evicted
+
+    Returns
+    -------
+    dataframe : pd.DataFrame
+        Output of the stage
+    """
+    filepath = stage_filepath(cache_dir, stage, key)
+    if(os.path.isfile(filepath)):
+        print("Using cached stage '{}' ({})".format(stage, key))
+        os.utime(filepath)
+        return pd.read_parquet(filepath)
+
+    dataframe = compute()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    write_atomic(filepath, dataframe.to_parquet)
+    if(max_bytes is not None):
+        evict_cache(cache_dir, max_bytes)
+
+    return dataframe
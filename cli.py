@@ -0,0 +1,159 @@
+import sys
+import json
+import time
+import argparse
+import importlib
+
+#only the standard library is imported here, the modules of the subcommands (and with them pandas, sklearn, matplotlib, scipy)
+#are imported when a subcommand runs, so that --help and the other subcommands start fast
+subcommands = {
+    "train": ("train", "Preprocesses the data, trains a classifier and saves it"),
+    "analyse-likelihood": ("LikelihoodAnalysis", "Plots the track and shower likelihoods of events above an energy threshold"),
+    "plot-density": ("plot_density", "Plots the density of the track positions"),
+    "coefficients": ("analyse_model_coefficients", "Plots the feature importance of a saved classifier: the coefficients of a linear model, or the permutation importance of any model")
+}
+
+
+def parse_setting(setting):
+    """
+    Parses a KEY=VALUE setting, where VALUE is read as JSON if possible and as a string otherwise.
+
+    Arguments
+    ---------
+    setting : str
+        Setting, e.g. "n_estimators=100" or 'filenames=["a.h5", "b.h5"]'
+
+    Returns
+    -------
+    key : str
+    value
+    """
+    key, separator, value = setting.partition("=")
+    if(not separator):
+        raise argparse.ArgumentTypeError("'{}' is not of the form KEY=VALUE".format(setting))
+    try:
+        return key.strip(), json.loads(value)
+    except json.JSONDecodeError:
+        return key.strip(), value
+
+def read_config(config_filepath, subcommand):
+    """
+    Reads the settings of a subcommand from a JSON config file.
+
+    The file holds an object of settings, e.g. {"filenames": ["a.h5"], "Emin": 10000}. Settings under a key named after a
+    subcommand, e.g. {"train": {"n_estimators": 100}}, only apply to that subcommand and take precedence.
+
+    Arguments
+    ---------
+    config_filepath : str
+        Path to the config file
+    subcommand : str
+        Name of the subcommand
+
+    Returns
+    -------
+    settings : dict
+        Settings of the subcommand
+    """
+    with open(config_filepath) as config_file:
+        config = json.load(config_file)
+    settings = {key: value for key, value in config.items() if key not in subcommands}
+    settings.update(config.get(subcommand, {}))
+    return settings
+
+def configure(module, settings):
+    """
+    Overrides the settings at the top of a module.
+
+    Arguments
+    ---------
+    module : module
+        Module of a subcommand
+    settings : dict
+        New values, keyed by the name of the module variable
+
+    Raises
+    ------
+    KeyError
+        If a setting does not exist in the module, to catch typos
+    """
+    for key in settings:
+        if(not hasattr(module, key) or callable(getattr(module, key))):
+            raise KeyError("'{}' is not a setting of {}".format(key, module.__name__))
+    for key, value in settings.items():
+        setattr(module, key, value)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Track/shower classification of KM3NeT neutrino events")
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    #flags only override the settings of the module when given
+    common = argparse.ArgumentParser(add_help=False, argument_default=argparse.SUPPRESS)
+    common.add_argument("--config", help="JSON file with settings, see the README")
+    common.add_argument("--set", dest="settings", action="append", type=parse_setting, metavar="KEY=VALUE",
+                        help="Overrides any setting at the top of the module, VALUE is read as JSON if possible; can be repeated")
+    common.add_argument("--imports-only", action="store_true", help="Only imports the module of the subcommand, to measure the cold-start time")
+
+    subparser = {name: subparsers.add_parser(name, parents=[common], help=description, description=description, argument_default=argparse.SUPPRESS)
+                 for name, (module_name, description) in subcommands.items()}
+
+    for name in ["train", "analyse-likelihood", "plot-density"]:
+        subparser[name].add_argument("--filenames", nargs="+", metavar="FILENAME", help="HDF files in the \"data\" subfolder")
+    for name in ["train", "coefficients"]:
+        subparser[name].add_argument("--model-filename", dest="model_filename", help="Model file in the \"models\" subfolder")
+
+    train = subparser["train"]
+    train.add_argument("--classifier", dest="classifier_type", choices=["LinearSVC", "SVC", "RandomForestClassifier"])
+    train.add_argument("--training-mode", dest="training_mode", choices=["exact", "approximate", "compare"])
+    train.add_argument("--kernel")
+    train.add_argument("--n-estimators", dest="n_estimators", type=int)
+    train.add_argument("--max-depth", dest="max_depth", type=int)
+    train.add_argument("--n-quantiles", dest="n_quantiles", type=int)
+    train.add_argument("--split-seed", dest="split_seed", type=int)
+    train.add_argument("--trace-memory", dest="trace_memory", action="store_true", help="Traces the peak memory of each stage in the run report")
+    train.add_argument("--profile-fit", dest="profile_fit", action="store_true", help="Runs the fit under cProfile")
+    train.add_argument("--no-equalise", dest="equalise_columns", action="store_false", help="Keeps all rows instead of balancing the particle types")
+
+    likelihood = subparser["analyse-likelihood"]
+    likelihood.add_argument("--emin", dest="Emin", type=float, help="Lower energy threshold")
+    likelihood.add_argument("--render-mode", dest="render_mode", choices=["scatter", "raster", "decimate"])
+    likelihood.add_argument("--energy-scan", dest="energy_scan", action="store_true", help="Opens the interactive energy-threshold scan")
+    likelihood.add_argument("--combined-figure", dest="separated_figures", action="store_false", help="Draws all plots in one figure")
+
+    density = subparser["plot-density"]
+    density.add_argument("--gridsize", type=int)
+    density.add_argument("--datapoint-count", dest="datapoint_count", type=int)
+    density.add_argument("--method", choices=["fft", "exact"])
+    density.add_argument("--position", choices=["Track", "Shower"], help="Plots the track positions of track events or the shower positions of shower events")
+    for limit in ["xmin", "xmax", "ymin", "ymax"]:
+        density.add_argument("--" + limit, dest=limit, type=float)
+
+    return parser
+
+def main(argv=None):
+    args = vars(build_parser().parse_args(argv))
+    subcommand = args.pop("subcommand")
+    config_filepath = args.pop("config", None)
+    set_settings = dict(args.pop("settings", []))
+    imports_only = args.pop("imports_only", False)
+
+    #later sources take precedence: module defaults, config file, --set, flags
+    settings = read_config(config_filepath, subcommand) if config_filepath is not None else {}
+    settings.update(set_settings)
+    settings.update(args)
+
+    start = time.perf_counter()
+    module = importlib.import_module(subcommands[subcommand][0])
+    if(imports_only):
+        print("Imported {} in {:.3f} s".format(module.__name__, time.perf_counter() - start))
+        return
+
+    try:
+        configure(module, settings)
+    except KeyError as error:
+        sys.exit(error.args[0])
+    module.main()
+
+
+if(__name__ == "__main__"):
+    main()
@@ -0,0 +1,277 @@
+import os
+import numpy as np
+import pandas as pd
+from joblib import dump, load
+
+from registry import load_model
+
+#from about this many events per call, sklearn predicts with a forest faster than its `CompiledForest`
+compiled_forest_max_events = 1000
+
+def compiled_filepath(model_filepath):
+    """Returns the path at which the compiled version of a model is saved, e.g. models/m9_compiled.joblib for models/m9.joblib."""
+    root, extension = os.path.splitext(model_filepath)
+    return root + "_compiled" + extension
+
+def _feature_array(X, feature_names, dtype):
+    #selecting the columns by name is all the validation done, which is most of the speed-up for small batches
+    if(isinstance(X, pd.DataFrame)):
+        X = X.to_numpy() if list(X.columns) == feature_names else X[feature_names].to_numpy()
+    X = np.ascontiguousarray(X, dtype=dtype)
+    if(X.ndim != 2 or X.shape[1] != len(feature_names)):
+        raise ValueError("Expected {} features, got an array of shape {}".format(len(feature_names), X.shape))
+    return X
+
+
+class CompiledLinearModel:
+    """
+    Predictor of a binary linear classifier (`LinearSVC`, or `SVC` with a linear kernel), reduced to its coefficient vector.
+
+    Arguments
+    ---------
+    coef : np.ndarray
+        Coefficient per feature
+    intercept : float
+        Intercept of the decision function
+    classes : np.ndarray
+        The two classes; the second one is predicted where the decision function is positive
+    feature_names : list
+        Names of the features, in the order of `coef`
+    """
+
+    def __init__(self, coef, intercept, classes, feature_names):
+        self.coef_ = np.ascontiguousarray(coef, dtype=np.float64)
+        self.intercept_ = float(intercept)
+        self.classes_ = np.asarray(classes)
+        self.feature_names_in_ = np.asarray(feature_names, dtype=object)
+
+    @property
+    def nbytes(self):
+        """Memory used by the arrays of the predictor in bytes."""
+        return self.coef_.nbytes + self.classes_.nbytes
+
+    def decision_function(self, X):
+        """Returns the signed distance of each event to the separating hyperplane."""
+        return _feature_array(X, list(self.feature_names_in_), np.float64) @ self.coef_ + self.intercept_
+
+    def predict(self, X):
+        """Returns the predicted class of each event."""
+        return self.classes_[(self.decision_function(X) > 0).astype(np.intp)]
+
+
+class CompiledForest:
+    """
+    Predictor of a random forest, with the nodes of all trees packed into flat arrays.
+
+    The trees are walked for all events and trees at once, one level per step. Leaves point to themselves with an infinite
+    threshold, so pairs of (event, tree) which reached a leaf can take further steps unchanged; the finished pairs are only
+    removed every `steps_per_check` steps. Features are compared in float32, like in sklearn; the thresholds are stored
+    as the largest float32 not above the original threshold, which gives the same comparisons.
+
+    This is much faster than sklearn for small batches, where sklearn's overhead per call and per tree dominates;
+    for batches of about a thousand events or more, sklearn's compiled tree walk is faster.
+
+    Arguments
+    ---------
+    feature : np.ndarray
+        Feature compared at each node (0 for leaves)
+    threshold : np.ndarray
+        Threshold of each node (infinite for leaves); events with a feature value up to the threshold go to the left child
+    children : np.ndarray
+        Index of the left and right child of each node in the packed arrays, of shape (nodes, 2); leaves are their own children
+    value : np.ndarray
+        Class probabilities of each node, of shape (nodes, classes)
+    roots : np.ndarray
+        Index of the root node of each tree
+    classes : np.ndarray
+        Classes of the forest
+    feature_names : list
+        Names of the features
+    """
+
+    steps_per_check = 4
+
+    def __init__(self, feature, threshold, children, value, roots, classes, feature_names):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.value = value
+        self.roots = roots
+        self.classes_ = np.asarray(classes)
+        self.feature_names_in_ = np.asarray(feature_names, dtype=object)
+
+    @property
+    def nbytes(self):
+        """Memory used by the arrays of the predictor in bytes."""
+        arrays = [self.feature, self.threshold, self.children, self.value, self.roots, self.classes_]
+        return sum(array.nbytes for array in arrays)
+
+    def apply(self, X):
+        """
+        Returns the leaf each event ends up in, for every tree.
+
+        Returns
+        -------
+        leaves : np.ndarray
+            Index of the leaf in the packed arrays, of shape (trees, events)
+        """
+        X = _feature_array(X, list(self.feature_names_in_), np.float32)
+        n_events, n_features = X.shape
+        values = X.ravel()
+
+        #flattened, so that the child of a node is children[2 * node] (left) or children[2 * node + 1] (right)
+        children = self.children.reshape(-1)
+
+        nodes = np.repeat(self.roots.astype(np.int64), n_events)
+        #position of the first feature of the event of each (tree, event) pair in the flattened features
+        offsets = np.tile(np.arange(n_events, dtype=np.int64) * n_features, len(self.roots))
+        active = np.arange(len(nodes))
+        while(active.size):
+            current = nodes[active]
+            active_offsets = offsets[active]
+            for step in range(self.steps_per_check):
+                go_right = values[active_offsets + self.feature[current]] > self.threshold[current]
+                current = children[2 * current + go_right]
+            nodes[active] = current
+            active = active[children[2 * current] != current]
+        return nodes.reshape(len(self.roots), n_events)
+
+    def predict_proba(self, X):
+        """Returns the class probabilities of each event, averaged over the trees."""
+        leaves = self.apply(X)
+        return self.value[leaves].sum(axis=0) / len(self.roots)
+
+    def predict(self, X):
+        """Returns the predicted class of each event."""
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+def _float32_thresholds(threshold):
+    #float32 features compared with a float64 threshold give the same result as with the largest float32 not above it
+    rounded = threshold.astype(np.float32)
+    above = rounded.astype(np.float64) > threshold
+    rounded[above] = np.nextafter(rounded[above], np.float32(-np.inf))
+    return rounded
+
+def _packed_children(children, root):
+    #node indices of a tree become indices in the packed arrays; leaves (-1 in sklearn) become their own children
+    return np.where(children >= 0, children, np.arange(len(children))) + root
+
+def compile_forest(forest, feature_names):
+    """Packs the trees of a fitted random forest (or any forest of sklearn decision tree classifiers) into a `CompiledForest`."""
+    trees = [estimator.tree_ for estimator in forest.estimators_]
+    sizes = np.array([tree.node_count for tree in trees])
+    roots = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+
+    is_leaf = np.concatenate([tree.children_left < 0 for tree in trees])
+    feature = np.where(is_leaf, 0, np.concatenate([tree.feature for tree in trees])).astype(np.int32)
+    threshold = np.where(is_leaf, np.inf, _float32_thresholds(np.concatenate([tree.threshold for tree in trees]))).astype(np.float32)
+    children = np.stack([np.concatenate([_packed_children(tree.children_left, root) for tree, root in zip(trees, roots)]),
+                         np.concatenate([_packed_children(tree.children_right, root) for tree, root in zip(trees, roots)])], axis=1).astype(np.int32)
+    #tree values are class fractions per node (single output); normalised as in DecisionTreeClassifier.predict_proba
+    value = np.concatenate([tree.value[:, 0, :] for tree in trees])
+    normaliser = value.sum(axis=1, keepdims=True)
+    value = value / np.where(normaliser == 0, 1, normaliser)
+
+    return CompiledForest(feature, threshold, children, value, roots.astype(np.int32), forest.classes_, feature_names)
+
+def compile_model(classifier):
+    """
+    Reduces a fitted classifier to flat NumPy arrays with a fast batch predictor.
+
+    Supported are `LinearSVC` and `SVC` with a linear kernel (binary), which become a `CompiledLinearModel`,
+    and random forests, which become a `CompiledForest`.
+
+    Arguments
+    ---------
+    classifier
+        Fitted sklearn classifier, with feature names
+
+    Returns
+    -------
+    compiled : CompiledLinearModel or CompiledForest
+        Predictor with the same outputs as the classifier
+
+    Raises
+    ------
+    TypeError
+        If the classifier cannot be compiled
+    """
+    feature_names = list(classifier.feature_names_in_)
+    name = type(classifier).__name__
+    if(name == "LinearSVC" or (name == "SVC" and classifier.kernel == "linear")):
+        if(len(classifier.classes_) != 2):
+            raise TypeError("Only binary linear classifiers can be compiled, got {} classes".format(len(classifier.classes_)))
+        coef = np.asarray(classifier.coef_.toarray() if hasattr(classifier.coef_, "toarray") else classifier.coef_)
+        return CompiledLinearModel(coef[0], classifier.intercept_[0], classifier.classes_, feature_names)
+    if(hasattr(classifier, "estimators_") and all(type(estimator).__name__ in ("DecisionTreeClassifier", "ExtraTreeClassifier")
+                                                 for estimator in classifier.estimators_)):
+        if(classifier.n_outputs_ != 1):
+            raise TypeError("Only single-output forests can be compiled")
+        return compile_forest(classifier, feature_names)
+    raise TypeError("{} cannot be compiled; supported are LinearSVC, SVC with a linear kernel and random forests".format(name))
+
+def save_compiled(model_filepath):
+    """
+    Compiles a saved model and saves the result next to it (see `compiled_filepath`), uncompressed so that it can be memory-mapped.
+
+    Arguments
+    ---------
+    model_filepath : str
+        Path of the saved classifier
+
+    Returns
+    -------
+    compiled : CompiledLinearModel or CompiledForest
+        Compiled model
+    """
+    compiled = compile_model(load_model(model_filepath, mmap=False))
+    dump(compiled, compiled_filepath(model_filepath))
+    return compiled
+
+def ensure_compiled(model_filepath):
+    """
+    Compiles a saved model (see `save_compiled`) if it has no compiled version yet, or the compiled version is older than the model.
+
+    Arguments
+    ---------
+    model_filepath : str
+        Path of the saved classifier
+
+    Returns
+    -------
+    filepath : str
+        Path of the compiled model
+    """
+    filepath = compiled_filepath(model_filepath)
+    if(not os.path.isfile(filepath) or os.path.getmtime(filepath) < os.path.getmtime(model_filepath)):
+        print("Compiling {}".format(model_filepath))
+        save_compiled(model_filepath)
+    return filepath
+
+def load_compiled(filepath, mmap=True):
+    """
+    Loads a compiled model. With `mmap`, its arrays are memory-mapped read-only, so processes loading it share them.
+
+    Arguments
+    ---------
+    filepath : str
+        Path of the compiled model, see `compiled_filepath`
+    mmap : bool
+        Whether to memory-map the arrays
+
+    Returns
+    -------
+    compiled : CompiledLinearModel or CompiledForest
+    """
+    return load(filepath, mmap_mode="r" if mmap else None)
+
+
+if(__name__ == "__main__"):
+    model_filename = "m9.joblib"
+    model_filepath = os.path.join("models", model_filename)
+
+    compiled = save_compiled(model_filepath)
+    print("Compiled {} to {} ({} bytes of arrays, {} bytes on disk, the model file has {} bytes)".format(
+        model_filepath, compiled_filepath(model_filepath), compiled.nbytes,
+        os.path.getsize(compiled_filepath(model_filepath)), os.path.getsize(model_filepath)))
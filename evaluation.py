@@ -0,0 +1,401 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from utils import group_codes
+
+#columns kept with the validation set to slice the performance by, next to the labels
+slice_columns = ["energy", "Inelasticity", "Particle name", "is_cc"]
+
+#file in the "models" subfolder
+model_filename = "model.joblib"
+
+energy_bins = np.logspace(2, 7, 11) #GeV, log-spaced
+inelasticity_bins = np.linspace(0, 1, 6)
+n_thresholds = 200 #thresholds of the ROC and efficiency-purity curves, at quantiles of the scores
+show_plots = True
+
+
+def validation_scores_filepath(model_filepath):
+    """Returns the path at which the validation scores of a model are cached, e.g. models/m9_validation.parquet for models/m9.joblib."""
+    return os.path.splitext(model_filepath)[0] + "_validation.parquet"
+
+def classifier_scores(classifier, X):
+    """
+    Scores events with a single model call: `decision_function` if the classifier has one, the probability of the second class otherwise.
+
+    The predictions are derived from the scores, in the same way as `predict` of a binary classifier.
+
+    Arguments
+    ---------
+    classifier
+        Fitted binary classifier
+    X : pd.DataFrame
+        Normalised features
+
+    Returns
+    -------
+    scores : np.ndarray
+        Score per event; higher means more like the second class (showers)
+    predictions : np.ndarray
+        Predicted class per event
+    """
+    if(hasattr(classifier, "decision_function")):
+        scores = np.asarray(classifier.decision_function(X), dtype=np.float64)
+        predictions = classifier.classes_[(scores > 0).astype(np.intp)]
+    else:
+        probabilities = classifier.predict_proba(X)
+        scores = np.asarray(probabilities[:, 1], dtype=np.float64)
+        predictions = classifier.classes_[np.argmax(probabilities, axis=1)]
+    return scores, predictions
+
+def save_validation_scores(filepath, scores, predictions, y, slices):
+    """
+    Caches the scores of the validation set together with the labels and the columns to slice by.
+
+    Arguments
+    ---------
+    filepath : str
+        Path of the parquet file, see `validation_scores_filepath`
+    scores, predictions : np.ndarray
+        Scores and predictions per event, see `classifier_scores`
+    y : pd.Series
+        Labels ("Is shower?")
+    slices : pd.DataFrame
+        Columns to slice by (`slice_columns`), in the order of `y`
+
+    Returns
+    -------
+    validation : pd.DataFrame
+        Cached table
+    """
+    validation = slices.reset_index(drop=True)
+    validation["Is shower?"] = np.asarray(y)
+    validation["Score"] = scores
+    validation["Prediction"] = np.asarray(predictions)
+    validation.to_parquet(filepath, index=False)
+    return validation
+
+def validation_set(model_filepath, columns=()):
+    """
+    Recreates the normalised validation set of a model, using the training settings saved in its metadata.
+
+    Models without saved settings get the validation set of the current settings of `train.py`. The split can only be
+    recreated from a fixed seed: `train.py` saves the seed it drew for a random split, and models saved before that
+    (or without saved settings while `split_seed` is None) raise an error instead of being scored on a different split.
+    So do models whose saved data key differs from that of the current input files, features and preprocessing.
+
+    Arguments
+    ---------
+    model_filepath : str
+        Path of the saved classifier
+    columns : list
+        Other columns to return for the validation events, e.g. `slice_columns`
+
+    Returns
+    -------
+    X_valid : pd.DataFrame
+        Normalised features
+    y_valid : pd.Series
+        Labels
+    other : pd.DataFrame
+        Values of `columns` for the validation events
+
+    Raises
+    ------
+    ValueError
+        If the split of the model cannot be recreated, as it was drawn without a saved seed or the data changed
+    """
+    import train
+    from utils import train_test_balanced
+    from normaliser import load_normaliser
+    from registry import metadata_filepath
+
+    metadata = {}
+    if(os.path.isfile(metadata_filepath(model_filepath))):
+        with open(metadata_filepath(model_filepath)) as metadata_file:
+            metadata = json.load(metadata_file)
+
+    #the settings of the model only apply while its validation set is recreated, so that the next model (or training run) gets its own
+    with train.applied_settings(metadata.get("settings", {})):
+        if(train.split_seed is None):
+            raise ValueError("The validation set of {} cannot be recreated: its training/validation split was drawn without a saved seed. "
+                             "Retrain the model to save the seed, or set `split_seed` in train.py for models without saved settings".format(model_filepath))
+        #the features and input files are not part of the saved settings, so the data they give is compared with the saved key
+        if(metadata.get("data_key") is not None and train.training_data_key(train.split_seed) != metadata["data_key"]):
+            raise ValueError("The validation set of {} cannot be recreated: the input files, features or preprocessing differ from "
+                             "those it was trained with".format(model_filepath))
+
+        train_columns = [x for x in train.used_columns if x not in train.excluded_columns]
+        other_columns = [x for x in columns if x not in train_columns]
+        if(train.ingested_store is not None and train.training_mode == "approximate"):
+            #streamed models split the ingested files one at a time, see `train.streamed_split`
+            manifest, counts, quotas = train.ingested_quotas()
+            training_files, X_valid, n_training = train.streamed_split(manifest, quotas, train.split_seed, other_columns)
+            y_valid = X_valid["Is shower?"]
+        else:
+            if(train.ingested_store is not None):
+                dataframe, ingested_normaliser = train.ingested_dataframe()
+            else:
+                dataframe = train.preprocessed_dataframe()
+            X_train, X_valid, y_train, y_valid = train_test_balanced(dataframe, train.equalised_columns, train_columns + other_columns, random_state=train.split_seed)
+        return load_normaliser(model_filepath).transform(X_valid[train_columns]), y_valid, X_valid[list(columns)]
+
+def load_validation_scores(model_filepath):
+    """
+    Reads the cached validation scores of a model, scoring its validation set once if there are none or the model is newer.
+
+    Arguments
+    ---------
+    model_filepath : str
+        Path of the saved classifier
+
+    Returns
+    -------
+    validation : pd.DataFrame
+        Slice columns, labels, scores and predictions per validation event
+
+    Raises
+    ------
+    ValueError
+        If there are no cached scores and the validation set cannot be recreated exactly, see `validation_set`
+    """
+    from registry import load_model
+
+    filepath = validation_scores_filepath(model_filepath)
+    if(os.path.isfile(filepath) and os.path.getmtime(filepath) >= os.path.getmtime(model_filepath)):
+        return pd.read_parquet(filepath)
+
+    print("Scoring the validation set of {}".format(model_filepath))
+    #scoring a different split would mix training events into the slice metrics, so this fails instead
+    try:
+        X_valid, y_valid, slices = validation_set(model_filepath, slice_columns)
+    except ValueError as error:
+        raise ValueError("No cached validation scores for {}, and they cannot be recomputed: {}".format(model_filepath, error)) from error
+    scores, predictions = classifier_scores(load_model(model_filepath), X_valid)
+    return save_validation_scores(filepath, scores, predictions, y_valid, slices)
+
+def slice_codes(validation, energy_bins, inelasticity_bins):
+    """
+    Assigns every validation event to its energy bin, inelasticity bin and flavour.
+
+    Arguments
+    ---------
+    validation : pd.DataFrame
+        Cached validation scores, see `load_validation_scores`
+    energy_bins, inelasticity_bins : np.ndarray
+        Bin edges
+
+    Returns
+    -------
+    slices : dict
+        Per variable ("Energy", "Inelasticity", "Flavour"): the bin code of each event (-1 outside the bins)
+        and a table of the bins with their label and edges
+    """
+    slices = {}
+    for variable, column, bins in [("Energy", "energy", energy_bins), ("Inelasticity", "Inelasticity", inelasticity_bins)]:
+        bins = np.asarray(bins, dtype=np.float64)
+        values = validation[column].to_numpy(dtype=np.float64)
+        codes = np.searchsorted(bins, values, side="right") - 1
+        #the last edge belongs to the last bin
+        codes[values == bins[-1]] = len(bins) - 2
+        codes[(codes < 0) | (codes >= len(bins) - 1) | np.isnan(values)] = -1
+        labels = ["{:.3g} - {:.3g}".format(low, high) for low, high in zip(bins[:-1], bins[1:])]
+        slices[variable] = (codes, pd.DataFrame({"Slice": labels, "Low": bins[:-1], "High": bins[1:]}))
+
+    codes, keys = group_codes(validation, ["Particle name", "is_cc"])
+    labels = ["{} {}".format(name, "CC" if is_cc else "NC") for name, is_cc in keys]
+    slices["Flavour"] = (codes, pd.DataFrame({"Slice": labels, "Low": np.nan, "High": np.nan}))
+    return slices
+
+def auc_per_bin(codes, scores, positive, n_bins):
+    """
+    Computes the area under the ROC curve of every bin at once, from the ranks of the scores (Mann-Whitney U), with tied scores sharing their average rank.
+
+    Arguments
+    ---------
+    codes : np.ndarray
+        Bin of each event, -1 for events outside the bins
+    scores : np.ndarray
+        Score of each event
+    positive : np.ndarray
+        Whether each event belongs to the positive class
+    n_bins : int
+        Number of bins
+
+    Returns
+    -------
+    auc : np.ndarray
+        AUC per bin, NaN for bins without events of both classes
+    """
+    inside = codes >= 0
+    order = np.lexsort((scores[inside], codes[inside]))
+    codes, scores, positive = codes[inside][order], scores[inside][order], positive[inside][order]
+
+    #rank of each event within its bin, averaged over tied scores
+    bin_starts = np.searchsorted(codes, np.arange(n_bins))
+    ranks = np.arange(len(codes)) - bin_starts[codes] + 1
+    new_tie = np.ones(len(codes), dtype=bool)
+    new_tie[1:] = (codes[1:] != codes[:-1]) | (scores[1:] != scores[:-1])
+    ties = np.cumsum(new_tie) - 1
+    ranks = (np.bincount(ties, weights=ranks) / np.bincount(ties))[ties]
+
+    n_positive = np.bincount(codes, weights=positive, minlength=n_bins)
+    n_negative = np.bincount(codes, minlength=n_bins) - n_positive
+    rank_sums = np.bincount(codes, weights=ranks * positive, minlength=n_bins)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        auc = (rank_sums - n_positive * (n_positive + 1) / 2) / (n_positive * n_negative)
+    auc[(n_positive == 0) | (n_negative == 0)] = np.nan
+    return auc
+
+def selection_curves(codes, scores, positive, n_bins, thresholds):
+    """
+    Counts, for every bin and threshold at once, the positive and negative events with a score of at least the threshold.
+
+    Arguments
+    ---------
+    codes : np.ndarray
+        Bin of each event, -1 for events outside the bins
+    scores : np.ndarray
+        Score of each event
+    positive : np.ndarray
+        Whether each event belongs to the positive class
+    n_bins : int
+        Number of bins
+    thresholds : np.ndarray
+        Sorted thresholds
+
+    Returns
+    -------
+    selected_positive, selected_negative : np.ndarray
+        Selected events per bin and threshold, of shape (bins, thresholds)
+    """
+    inside = codes >= 0
+    #events below the lowest threshold are never selected
+    threshold_codes = np.searchsorted(thresholds, scores[inside], side="right") - 1
+    selectable = threshold_codes >= 0
+    cells = (codes[inside] * len(thresholds) + threshold_codes)[selectable]
+    shape = (n_bins, len(thresholds))
+
+    counts = np.bincount(cells, minlength=n_bins * len(thresholds)).reshape(shape)
+    counts_positive = np.bincount(cells, weights=positive[inside][selectable], minlength=n_bins * len(thresholds)).reshape(shape)
+    #events with a score in threshold cell k are selected by thresholds 0 to k
+    selected = counts[:, ::-1].cumsum(axis=1)[:, ::-1]
+    selected_positive = counts_positive[:, ::-1].cumsum(axis=1)[:, ::-1]
+    return selected_positive, selected - selected_positive
+
+def evaluate_slices(validation, energy_bins, inelasticity_bins, n_thresholds=200):
+    """
+    Computes the performance per energy bin, inelasticity bin and flavour from the cached validation scores, without calling the model.
+
+    Showers are the positive class: the shower efficiency is the fraction of showers classified as showers, and the shower purity
+    the fraction of events classified as showers which are showers.
+
+    Arguments
+    ---------
+    validation : pd.DataFrame
+        Cached validation scores, see `load_validation_scores`
+    energy_bins, inelasticity_bins : np.ndarray
+        Bin edges
+    n_thresholds : int
+        Number of thresholds of the curves, at quantiles of all scores
+
+    Returns
+    -------
+    table : pd.DataFrame
+        Per slice: the number of events, showers and tracks, the accuracy and its standard error, the AUC,
+        and the shower efficiency and purity of the predictions
+    curves : dict
+        Per variable: the thresholds and, per bin and threshold, the true and false positive rates and the shower purity
+    """
+    scores = validation["Score"].to_numpy()
+    positive = validation["Is shower?"].to_numpy(dtype=bool)
+    predicted = validation["Prediction"].to_numpy(dtype=bool)
+    thresholds = np.unique(np.quantile(scores, np.linspace(0, 1, n_thresholds)))
+
+    tables = []
+    curves = {}
+    for variable, (codes, bins) in slice_codes(validation, energy_bins, inelasticity_bins).items():
+        n_bins = len(bins)
+        inside = codes >= 0
+        events = np.bincount(codes[inside], minlength=n_bins)
+        showers = np.bincount(codes[inside], weights=positive[inside], minlength=n_bins)
+        correct = np.bincount(codes[inside], weights=predicted[inside] == positive[inside], minlength=n_bins)
+        selected = np.bincount(codes[inside], weights=predicted[inside], minlength=n_bins)
+        selected_showers = np.bincount(codes[inside], weights=predicted[inside] & positive[inside], minlength=n_bins)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            accuracy = correct / events
+            table = bins.assign(Variable=variable, Events=events, Showers=showers.astype(np.int64), Tracks=(events - showers).astype(np.int64),
+                                Accuracy=accuracy, **{"Accuracy error": np.sqrt(accuracy * (1 - accuracy) / events),
+                                                      "AUC": auc_per_bin(codes, scores, positive, n_bins),
+                                                      "Shower efficiency": selected_showers / showers,
+                                                      "Shower purity": selected_showers / selected})
+
+            selected_positive, selected_negative = selection_curves(codes, scores, positive, n_bins, thresholds)
+            curves[variable] = {"labels": list(bins["Slice"]), "thresholds": thresholds,
+                                "true positive rate": selected_positive / showers[:, None],
+                                "false positive rate": selected_negative / (events - showers)[:, None],
+                                "purity": selected_positive / (selected_positive + selected_negative)}
+        tables.append(table)
+
+    columns = ["Variable", "Slice", "Low", "High", "Events", "Showers", "Tracks", "Accuracy", "Accuracy error", "AUC", "Shower efficiency", "Shower purity"]
+    return pd.concat(tables, ignore_index=True)[columns], curves
+
+def plot_slices(table, curves):
+    """
+    Plots the accuracy and AUC per slice, and the ROC and efficiency-purity curves of every slice, one figure per variable.
+
+    Returns
+    -------
+    figures : dict
+        Figure per variable
+    """
+    #imported here, so that train.py can cache the validation scores without importing matplotlib
+    import matplotlib.pyplot as plt
+
+    figures = {}
+    for variable, variable_curves in curves.items():
+        rows = table[table["Variable"] == variable]
+        fig, [ax1, ax2, ax3] = plt.subplots(1, 3, figsize=(18, 6), constrained_layout=True)
+        fig.suptitle("Performance per {} slice".format(variable.lower()))
+
+        positions = np.arange(len(rows))
+        ax1.errorbar(positions, rows["Accuracy"], yerr=rows["Accuracy error"], marker="o", linestyle="", label="Accuracy")
+        ax1.plot(positions, rows["AUC"], marker="s", linestyle="", label="AUC")
+        ax1.set_xticks(positions, rows["Slice"], rotation=45, ha="right")
+        ax1.set_xlabel(variable)
+        ax1.legend()
+
+        for index, label in enumerate(variable_curves["labels"]):
+            ax2.plot(variable_curves["false positive rate"][index], variable_curves["true positive rate"][index], label=label)
+            ax3.plot(variable_curves["true positive rate"][index], variable_curves["purity"][index], label=label)
+        ax2.plot([0, 1], [0, 1], color="grey", linestyle="--")
+        ax2.set_xlabel("False positive rate (tracks classified as showers)")
+        ax2.set_ylabel("True positive rate (shower efficiency)")
+        ax3.set_xlabel("Shower efficiency")
+        ax3.set_ylabel("Shower purity")
+        ax3.legend(fontsize="small")
+        figures[variable] = fig
+    return figures
+
+def main():
+    model_filepath = os.path.join("models", model_filename)
+    root = os.path.splitext(model_filepath)[0]
+
+    validation = load_validation_scores(model_filepath)
+    table, curves = evaluate_slices(validation, energy_bins, inelasticity_bins, n_thresholds)
+    print(table.to_string(index=False, float_format="{:.3f}".format))
+
+    print("Saving the table at {}".format(root + "_slices.csv"))
+    table.to_csv(root + "_slices.csv", index=False)
+    for variable, fig in plot_slices(table, curves).items():
+        fig.savefig("{}_slices_{}.png".format(root, variable.lower()))
+    if(show_plots):
+        import matplotlib.pyplot as plt
+        plt.show()
+
+
+if(__name__ == "__main__"):
+    main()
@@ -0,0 +1,148 @@
+import inspect
+import numpy as np
+import pandas as pd
+
+from cache import stage_key, cached_stage
+
+#derived features by name, declared with `derived_feature`; each has its dependencies and the function computing it
+derived_features = {}
+
+
+def derived_feature(name, dependencies):
+    """
+    Declares a derived feature, computed from other (renamed) columns with a vectorised NumPy expression.
+
+    The decorated function gets the dependencies as NumPy arrays, in the order given, and returns the feature as an array.
+    Dependencies can be columns of the data files or other derived features. A derived feature is only computed if it
+    (or a feature depending on it) is requested, e.g. by adding its name to `used_columns` in `utils.py`.
+
+    Arguments
+    ---------
+    name : str
+        Column name of the feature
+    dependencies : list
+        Column names the feature is computed from
+    """
+    def register(function):
+        derived_features[name] = {"dependencies": list(dependencies), "function": function}
+        return function
+    return register
+
+@derived_feature("Track-shower opening angle", ["Track x-direction", "Track y-direction", "Track z-direction",
+                                               "Shower x-direction", "Shower y-direction", "Shower z-direction"])
+def opening_angle(track_x, track_y, track_z, shower_x, shower_y, shower_z):
+    #in radians; the directions are normalised, as they are not always exactly unit vectors
+    dot = track_x * shower_x + track_y * shower_y + track_z * shower_z
+    norms = np.sqrt((track_x**2 + track_y**2 + track_z**2) * (shower_x**2 + shower_y**2 + shower_z**2))
+    return np.arccos(np.clip(dot / norms, -1, 1))
+
+@derived_feature("Track end x-position", ["Track x-position", "Track x-direction", "Track length"])
+def track_end_x(position, direction, length):
+    return position + direction * length
+
+@derived_feature("Track end y-position", ["Track y-position", "Track y-direction", "Track length"])
+def track_end_y(position, direction, length):
+    return position + direction * length
+
+@derived_feature("Track end z-position", ["Track z-position", "Track z-direction", "Track length"])
+def track_end_z(position, direction, length):
+    return position + direction * length
+
+
+def feature_order(columns):
+    """
+    Lists the derived features needed for some columns, each once, with every feature after the features it depends on.
+
+    Arguments
+    ---------
+    columns : list
+        Requested column names
+
+    Returns
+    -------
+    features : list
+        Names of the derived features to compute, in order
+    """
+    features = []
+    def visit(column, path):
+        if(column not in derived_features or column in features):
+            return
+        if(column in path):
+            raise ValueError("Derived features depend on each other in a cycle: {}".format(" -> ".join(path + [column])))
+        for dependency in derived_features[column]["dependencies"]:
+            visit(dependency, path + [column])
+        features.append(column)
+
+    for column in columns:
+        visit(column, [])
+    return features
+
+def base_columns(columns):
+    """
+    Replaces the derived features among some columns by the (non-derived) columns they are computed from.
+
+    Arguments
+    ---------
+    columns : list
+        Requested column names
+
+    Returns
+    -------
+    columns : list
+        The requested columns which are not derived, followed by the other columns needed for the derived ones, without duplicates
+    """
+    needed = [column for column in columns if column not in derived_features]
+    for feature in feature_order(columns):
+        needed += [dependency for dependency in derived_features[feature]["dependencies"]
+                   if dependency not in derived_features and dependency not in needed]
+    return needed
+
+def feature_key(name):
+    """
+    Returns a key identifying the definition of a derived feature, which changes when its function or dependencies are
+    edited, including the definitions of the derived features it depends on.
+    """
+    feature = derived_features[name]
+    dependency_keys = [feature_key(dependency) for dependency in feature["dependencies"] if dependency in derived_features]
+    return stage_key(name, feature["dependencies"], inspect.getsource(feature["function"]), *dependency_keys)
+
+def add_derived_features(dataframe, columns, cache_dir=None, base_key=None, max_bytes=None):
+    """
+    Computes the derived features among `columns` (and the derived features they depend on), each only once.
+
+    With a `cache_dir`, each feature is cached as a column of its own, keyed by `base_key` (the key of the data it is
+    computed from) and the definition of the feature, so that adding or changing one feature only computes that feature.
+
+    Arguments
+    ---------
+    dataframe : pd.DataFrame
+        Data containing the columns the features are computed from
+    columns : list
+        Requested column names; columns which are not derived features, or already in `dataframe`, are ignored
+    cache_dir : str or None
+        Directory in which the features are cached, see `cache.cached_stage`. If None, nothing is cached
+    base_key : str or None
+        Key of `dataframe`, required with a `cache_dir`
+    max_bytes : int or None
+        Maximum total size of the cache in bytes
+
+    Returns
+    -------
+    dataframe : pd.DataFrame
+        Copy of `dataframe` with the derived features added, if any were computed
+    """
+    features = [feature for feature in feature_order(columns) if feature not in dataframe.columns]
+    if(not features):
+        return dataframe
+
+    dataframe = dataframe.copy()
+    for feature in features:
+        def compute(feature=feature):
+            arguments = [dataframe[dependency].to_numpy() for dependency in derived_features[feature]["dependencies"]]
+            return pd.DataFrame({feature: derived_features[feature]["function"](*arguments)})
+        if(cache_dir is None):
+            values = compute()
+        else:
+            values = cached_stage(cache_dir, "feature", stage_key(base_key, feature_key(feature)), compute, max_bytes)
+        dataframe[feature] = values[feature].to_numpy()
+    return dataframe
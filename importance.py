@@ -0,0 +1,168 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.model_selection import train_test_split
+
+from registry import load_model, is_forest
+from compiled_model import ensure_compiled, compiled_forest_max_events
+from cache import file_fingerprint, stage_key
+
+#model, validation data and baseline predictions of each worker process, set once by _init_worker
+_worker_state = {}
+
+
+def stratified_subsample(X, y, n_samples=None, random_state=None):
+    """
+    Draws a random subsample with the same fraction of each class as the full set.
+
+    Arguments
+    ---------
+    X : pd.DataFrame
+        Features
+    y : pd.Series
+        Labels
+    n_samples : int or None
+        Size of the subsample. If None or larger than the set, the full set is returned
+    random_state : int or None
+        Seed for the subsample
+
+    Returns
+    -------
+    X, y : pd.DataFrame, pd.Series
+        Subsample
+    """
+    if(n_samples is None or n_samples >= len(X)):
+        return X, y
+    X_subsample, X_rest, y_subsample, y_rest = train_test_split(X, y, train_size=n_samples, stratify=y, random_state=random_state)
+    return X_subsample, y_subsample
+
+def _prediction_model(model_filepath, n_events):
+    #the compiled predictor of a forest shares its memory-mapped arrays between the workers, but is about twice as slow
+    #as sklearn for larger batches, so forests are only loaded as their predictor for small ones
+    return load_model(model_filepath, predictor=n_events < compiled_forest_max_events)
+
+def _init_worker(model_filepath, X, y, baseline):
+    _worker_state["classifier"] = _prediction_model(model_filepath, len(X))
+    _worker_state["X"] = X
+    _worker_state["y"] = y
+    _worker_state["baseline"] = baseline
+
+def _permuted_accuracy_drops(feature, seeds):
+    """Permutes one feature once per seed and returns the drop in accuracy compared to the baseline predictions."""
+    classifier = _worker_state["classifier"]
+    X, y = _worker_state["X"], _worker_state["y"]
+    baseline_accuracy = np.mean(_worker_state["baseline"] == y)
+
+    drops = []
+    column = X.columns[feature]
+    original = X[column].to_numpy()
+    permuted = X.copy(deep=False)
+    for seed in seeds:
+        permuted[column] = original[np.random.default_rng(seed).permutation(len(original))]
+        drops.append(baseline_accuracy - np.mean(classifier.predict(permuted) == y))
+    return feature, drops
+
+def _converged(drops, min_repeats, max_repeats, tolerance):
+    """Whether a feature has had enough repeats, or the 95% confidence interval of its importance is narrow enough."""
+    n = len(drops)
+    if(n >= max_repeats):
+        return True
+    return n >= min_repeats and 1.96 * np.std(drops, ddof=1) / np.sqrt(n) < tolerance
+
+def baseline_predictions(model_filepath, X, cache_filepath=None):
+    """
+    Predicts the unpermuted data once; all permutations are compared with these predictions.
+
+    Arguments
+    ---------
+    model_filepath : str
+        Path of the saved classifier
+    X : pd.DataFrame
+        Features
+    cache_filepath : str or None
+        If given, the predictions are saved to (and reused from) this .npz file, as long as the model file and the data are unchanged
+
+    Returns
+    -------
+    predictions : np.ndarray
+        Predicted label per row of `X`
+    """
+    key = stage_key(file_fingerprint(model_filepath), list(X.columns), int(pd.util.hash_pandas_object(X).sum()))
+    if(cache_filepath is not None and os.path.isfile(cache_filepath)):
+        with np.load(cache_filepath, allow_pickle=False) as saved:
+            if(str(saved["key"]) == key):
+                return saved["predictions"]
+
+    predictions = np.asarray(_prediction_model(model_filepath, len(X)).predict(X))
+    if(cache_filepath is not None):
+        os.makedirs(os.path.dirname(os.path.abspath(cache_filepath)), exist_ok=True)
+        np.savez(cache_filepath, key=key, predictions=predictions)
+    return predictions
+
+def permutation_importance(model_filepath, X, y, min_repeats=5, max_repeats=50, repeats_per_round=5, tolerance=0.002,
+                           n_jobs=None, random_state=None, baseline_cache_filepath=None):
+    """
+    Computes the permutation importance of each feature of a saved classifier: the drop in accuracy when the values of
+    the feature are shuffled between events, which works for any model.
+
+    Features and repeats are divided over a process pool; every worker loads the model (memory-mapped) and receives
+    the data once. Repeats run in rounds, and a feature stops once the 95% confidence interval of its importance is
+    narrower than +/- `tolerance`, so clearly (un)important features do not use up all repeats.
+
+    Arguments
+    ---------
+    model_filepath : str
+        Path of the saved classifier
+    X : pd.DataFrame
+        Normalised features, e.g. a stratified subsample of the validation set (see `stratified_subsample`)
+    y : pd.Series
+        Labels
+    min_repeats : int
+        Number of repeats before a feature can stop
+    max_repeats : int
+        Maximum number of repeats per feature
+    repeats_per_round : int
+        Number of repeats per feature between checks of the confidence intervals
+    tolerance : float
+        Half-width of the 95% confidence interval at which a feature stops
+    n_jobs : int or None
+        Number of worker processes. If None, one per CPU
+    random_state : int or None
+        Seed for the permutations
+    baseline_cache_filepath : str or None
+        File in which the baseline predictions are cached, see `baseline_predictions`
+
+    Returns
+    -------
+    importances : pd.DataFrame
+        Per feature: mean importance, its standard deviation, the half-width of the 95% confidence interval
+        and the number of repeats, sorted by importance
+    """
+    y = np.asarray(y)
+    baseline = baseline_predictions(model_filepath, X, baseline_cache_filepath)
+    #compiled here if needed, so that the workers do not all compile the forest at once
+    if(is_forest(model_filepath) and len(X) < compiled_forest_max_events):
+        ensure_compiled(model_filepath)
+    seeds = np.random.SeedSequence(random_state)
+    drops = {feature: [] for feature in range(X.shape[1])}
+    active = list(drops)
+
+    with ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=(model_filepath, X, y, baseline)) as executor:
+        while(active):
+            futures = []
+            for feature in active:
+                n_repeats = min(repeats_per_round, max_repeats - len(drops[feature]))
+                futures.append(executor.submit(_permuted_accuracy_drops, feature, [seed.generate_state(1)[0] for seed in seeds.spawn(n_repeats)]))
+            for future in futures:
+                feature, feature_drops = future.result()
+                drops[feature].extend(feature_drops)
+            active = [feature for feature in active if not _converged(drops[feature], min_repeats, max_repeats, tolerance)]
+
+    rows = []
+    for feature, feature_drops in drops.items():
+        n = len(feature_drops)
+        std = np.std(feature_drops, ddof=1) if n > 1 else 0.0
+        rows.append({"Feature": X.columns[feature], "Importance": np.mean(feature_drops), "Std": std,
+                     "CI half-width": 1.96 * std / np.sqrt(n), "Repeats": n})
+    return pd.DataFrame(rows).sort_values("Importance", ascending=False, ignore_index=True)
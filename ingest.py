@@ -0,0 +1,408 @@
+import os
+import json
+import urllib.parse
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed, dump, load
+
+from utils import load_from_h5, group_codes, balanced_targets
+from cache import file_fingerprint, stage_key
+from normaliser import QuantileNormaliser
+
+#name of the manifest in the store directory, listing the ingested files
+manifest_filename = "manifest.json"
+#version of the layout of the store; files ingested with another layout are ingested again
+store_layout = 2
+
+
+def read_manifest(store_dir):
+    """
+    Reads which files have been ingested into a store.
+
+    Arguments
+    ---------
+    store_dir : str
+        Directory of the store
+
+    Returns
+    -------
+    manifest : dict
+        Per ingested file name: its fingerprint, the key of the ingest settings, the number of rows, the sketch file name,
+        and per group its values, number of rows and partition file
+    """
+    manifest_filepath = os.path.join(store_dir, manifest_filename)
+    if(not os.path.isfile(manifest_filepath)):
+        return {}
+    with open(manifest_filepath) as manifest_file:
+        return json.load(manifest_file)
+
+def _write_manifest(store_dir, manifest):
+    #written to a temporary file first, so that an interrupted ingest never leaves a half-written manifest
+    temporary_filepath = os.path.join(store_dir, manifest_filename + ".tmp")
+    with open(temporary_filepath, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(temporary_filepath, os.path.join(store_dir, manifest_filename))
+
+def _plain_key(key):
+    #numpy scalars, e.g. of downcast integer columns, are not JSON serialisable
+    return tuple(value.item() if isinstance(value, np.generic) else value for value in key)
+
+def partition_dirname(key, equalised_columns):
+    """
+    Returns the directory of a group in the store, in the hive layout, e.g. "Particle name=Muon neutrino/is_cc=1".
+
+    Arguments
+    ---------
+    key : tuple
+        Values of the group
+    equalised_columns : list
+        Columns defining the groups
+
+    Returns
+    -------
+    dirname : str
+        Path relative to the store directory
+    """
+    return os.path.join(*["{}={}".format(urllib.parse.quote(column, safe=" "), urllib.parse.quote(str(value), safe=" "))
+                          for column, value in zip(equalised_columns, key)])
+
+def ingest_file(filepath, store_dir, columns, equalised_columns, sketch_columns, filters=None, float32=False, n_quantiles=1000, sketch_size=2000):
+    """
+    Processes one source file into its own partitions of the store, one per group, along with its statistics.
+
+    The rows are loaded with the missing values and filtered rows dropped (see `load_from_h5`), and the rows of each
+    group of `equalised_columns` are written to `<group directory>/<file name>.parquet` (see `partition_dirname`), so
+    that readers only open the groups they need. The statistics are the number of rows per group, and per group a
+    quantile sketch of `sketch_columns` (a `QuantileNormaliser` fitted with `partial_fit`), saved as `<file name>_sketches.joblib`.
+
+    Arguments
+    ---------
+    filepath : str
+        Path to the HDF file
+    store_dir : str
+        Directory of the store
+    columns : list
+        (Renamed) column names which are stored, e.g. `used_columns`
+    equalised_columns : list
+        Columns defining the groups which are balanced downstream
+    sketch_columns : list
+        Columns which can be normalised downstream, i.e. all features
+    filters : list of tuple or None
+        Filters the rows have to pass, see `utils.filter_mask`
+    float32 : bool
+        Whether to store the floating point features as float32
+    n_quantiles, sketch_size : int
+        Parameters of the quantile sketches, see `QuantileNormaliser`
+
+    Returns
+    -------
+    entry : dict
+        Manifest entry of the file, without fingerprint and settings key
+    """
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    dataframe = load_from_h5([filepath], columns=columns, filters=filters, dropna=True, float32=float32)[columns]
+
+    codes, keys = group_codes(dataframe, equalised_columns)
+    groups = []
+    sketches = {}
+    for code, key in enumerate(keys):
+        rows = dataframe[codes == code]
+        #the group columns are kept in the files, where they are constant and take next to no space
+        partition = os.path.join(partition_dirname(_plain_key(key), equalised_columns), name + ".parquet")
+        os.makedirs(os.path.join(store_dir, os.path.dirname(partition)), exist_ok=True)
+        rows.to_parquet(os.path.join(store_dir, partition), index=False)
+        groups.append({"key": list(_plain_key(key)), "count": len(rows), "partition": partition})
+        sketches[_plain_key(key)] = QuantileNormaliser(n_quantiles=n_quantiles, sketch_size=sketch_size).partial_fit(rows[sketch_columns])
+    dump(sketches, os.path.join(store_dir, name + "_sketches.joblib"))
+
+    return {"sketches": name + "_sketches.joblib", "rows": len(dataframe), "groups": groups}
+
+def _remove_partitions(store_dir, entry):
+    #a file which is ingested again may no longer have rows in some of its old groups; the first layout had one partition per file
+    partitions = [group.get("partition") for group in entry.get("groups", [])] + [entry.get("partition")]
+    for partition in partitions:
+        if(partition is not None and os.path.isfile(os.path.join(store_dir, partition))):
+            os.remove(os.path.join(store_dir, partition))
+
+def ingest(filepaths, store_dir, columns, equalised_columns, sketch_columns, filters=None, float32=False, n_quantiles=1000, sketch_size=2000,
+           hash_input_files=False, n_jobs=None):
+    """
+    Ingests the files which are new or changed since they were last ingested, leaving all other partitions untouched.
+
+    A file is ingested again if its fingerprint (see `cache.file_fingerprint`) or the ingest settings changed.
+
+    Arguments
+    ---------
+    filepaths : list
+        Paths to the HDF files
+    store_dir : str
+        Directory of the store
+    columns, equalised_columns, sketch_columns, filters, float32, n_quantiles, sketch_size
+        See `ingest_file`
+    hash_input_files : bool
+        Whether to identify the files by the hash of their contents instead of size and modification time
+    n_jobs : int or None
+        Number of processes ingesting files in parallel. If None, one per new file
+
+    Returns
+    -------
+    manifest : dict
+        Updated manifest, see `read_manifest`
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    manifest = read_manifest(store_dir)
+    settings_key = stage_key(store_layout, columns, equalised_columns, sketch_columns, filters, float32, n_quantiles, sketch_size)
+
+    fingerprints = {filepath: list(file_fingerprint(filepath, hash_input_files)) for filepath in filepaths}
+    new_filepaths = [filepath for filepath in filepaths
+                     if manifest.get(os.path.basename(filepath), {}).get("fingerprint") != fingerprints[filepath]
+                     or manifest[os.path.basename(filepath)].get("settings") != settings_key]
+    print("{} of {} files already ingested, ingesting {}".format(len(filepaths) - len(new_filepaths), len(filepaths), len(new_filepaths)))
+    if(not new_filepaths):
+        return manifest
+
+    for filepath in new_filepaths:
+        _remove_partitions(store_dir, manifest.get(os.path.basename(filepath), {}))
+    arguments = (store_dir, columns, equalised_columns, sketch_columns, filters, float32, n_quantiles, sketch_size)
+    entries = Parallel(n_jobs=n_jobs or len(new_filepaths))(delayed(ingest_file)(filepath, *arguments) for filepath in new_filepaths)
+    for filepath, entry in zip(new_filepaths, entries):
+        entry.update(fingerprint=fingerprints[filepath], settings=settings_key)
+        manifest[os.path.basename(filepath)] = entry
+        print("Ingested {} ({} rows)".format(os.path.basename(filepath), entry["rows"]))
+    _write_manifest(store_dir, manifest)
+    return manifest
+
+def group_counts(manifest, filenames):
+    """
+    Counts the rows per group over the partitions of some ingested files, from the manifest alone.
+
+    Arguments
+    ---------
+    manifest : dict
+        See `read_manifest`
+    filenames : list
+        Names of the ingested files to include
+
+    Returns
+    -------
+    counts : pd.DataFrame
+        Rows per group (columns) and file (rows); the columns form a sorted MultiIndex of the groups
+    """
+    counts = pd.DataFrame([{tuple(group["key"]): group["count"] for group in manifest[filename]["groups"]} for filename in filenames], index=filenames)
+    counts = counts.fillna(0).astype(np.int64)
+    counts = counts[counts.columns.sort_values()]
+    counts.columns = pd.MultiIndex.from_tuples(counts.columns)
+    return counts
+
+def select_groups(counts, equalised_columns, selection=None):
+    """
+    Keeps the groups with the selected values, e.g. to train on a single flavour.
+
+    Arguments
+    ---------
+    counts : pd.DataFrame
+        Rows per group and file, as returned by `group_counts`
+    equalised_columns : list
+        Columns defining the groups
+    selection : dict or None
+        Allowed values per column, e.g. {"Particle name": ["Muon neutrino", "Anti muon neutrino"]}. If None, all groups are kept
+
+    Returns
+    -------
+    counts : pd.DataFrame
+        Rows per selected group and file
+    """
+    if(selection is None):
+        return counts
+    keep = np.ones(counts.shape[1], dtype=bool)
+    for column, values in selection.items():
+        keep &= counts.columns.get_level_values(equalised_columns.index(column)).isin(values)
+    return counts.loc[:, keep]
+
+def read_partitions(store_dir, manifest, counts, columns=None):
+    """
+    Reads the partitions of some groups and files, and only the requested columns of them.
+
+    Arguments
+    ---------
+    store_dir : str
+        Directory of the store
+    manifest : dict
+        See `read_manifest`
+    counts : pd.DataFrame
+        Groups (columns) and files (rows) to read, e.g. as returned by `group_counts` and `select_groups`
+    columns : list or None
+        Columns to read. If None, all stored columns are read
+
+    Yields
+    ------
+    filename : str
+        Name of the ingested file
+    key : tuple
+        Values of the group
+    partition : pd.DataFrame
+        Rows of the group in the file
+    """
+    for filename in counts.index:
+        partitions = {tuple(group["key"]): group["partition"] for group in manifest[filename]["groups"]}
+        for key in counts.columns:
+            if(counts.loc[filename, key] > 0):
+                yield filename, key, pd.read_parquet(os.path.join(store_dir, partitions[key]), columns=columns)
+
+def balanced_quotas(counts, ratios=None):
+    """
+    Divides the rows to keep per group (see `utils.balanced_targets`) over the partitions, in proportion to the rows each partition has.
+
+    Arguments
+    ---------
+    counts : pd.DataFrame
+        Rows per group and file, as returned by `group_counts`
+    ratios : dict, list or None
+        Relative amount of rows to keep per group, see `utils.balanced_targets`
+
+    Returns
+    -------
+    quotas : pd.DataFrame
+        Rows to keep per group (columns) and file (rows)
+    """
+    keys = pd.MultiIndex.from_tuples(counts.columns)
+    totals = counts.to_numpy().sum(axis=0)
+    targets = balanced_targets(totals, keys, ratios)
+
+    exact = counts.to_numpy() * (targets / np.maximum(totals, 1))
+    quotas = np.floor(exact).astype(np.int64)
+    #the remaining rows of each group go to the partitions with the largest remainders
+    for group in range(len(keys)):
+        missing = targets[group] - quotas[:, group].sum()
+        if(missing > 0):
+            quotas[np.argsort(quotas[:, group] - exact[:, group], kind="stable")[:missing], group] += 1
+    return pd.DataFrame(quotas, index=counts.index, columns=counts.columns)
+
+def load_balanced(store_dir, manifest, quotas, columns=None, random_state=None):
+    """
+    Loads the rows to keep from each partition, reading only the partitions of groups with rows to keep, and only `columns`.
+
+    Arguments
+    ---------
+    store_dir : str
+        Directory of the store
+    manifest : dict
+        See `read_manifest`
+    quotas : pd.DataFrame
+        Rows to keep per group and file, as returned by `balanced_quotas`
+    columns : list or None
+        Columns to load. If None, all stored columns are loaded
+    random_state : int or None
+        Seed for sampling the kept rows. If None, the first rows of each group in each partition are kept
+
+    Returns
+    -------
+    dataframe : pd.DataFrame
+        Balanced data
+    """
+    rng = None if random_state is None else np.random.default_rng(random_state)
+    df_list = [_kept_rows(partition, quotas.loc[filename, key], rng)
+               for filename, key, partition in read_partitions(store_dir, manifest, quotas, columns)]
+    return pd.concat(df_list, ignore_index=True)
+
+def _kept_rows(partition, quota, rng):
+    #every partition holds a single group, so the rows to keep are sampled locally
+    if(rng is None):
+        return partition.iloc[:quota]
+    return partition.iloc[np.sort(rng.choice(len(partition), quota, replace=False))]
+
+def iter_balanced_split(store_dir, manifest, quotas, columns=None, test_size=0.25, random_state=None, split_seed=None):
+    """
+    Reads the rows to keep one ingested file at a time, divided into training and validation rows, so that the balanced
+    data never has to be in memory at once.
+
+    The same rows are kept as by `load_balanced` with the same `random_state`. The validation rows are drawn per group
+    and file, so the validation set is balanced like the training set. Every pass with the same seeds yields the same
+    rows in the same order, so the training rows can be read again for every epoch.
+
+    Arguments
+    ---------
+    store_dir : str
+        Directory of the store
+    manifest : dict
+        See `read_manifest`
+    quotas : pd.DataFrame
+        Rows to keep per group and file, as returned by `balanced_quotas`
+    columns : list or None
+        Columns to load. If None, all stored columns are loaded
+    test_size : float
+        Fraction of the kept rows of each group and file used for validation
+    random_state : int or None
+        Seed for sampling the kept rows, see `load_balanced`
+    split_seed : int or None
+        Seed for drawing the validation rows and shuffling the training rows
+
+    Yields
+    ------
+    filename : str
+        Name of the ingested file
+    training : pd.DataFrame
+        Training rows of the file, shuffled
+    validation : pd.DataFrame
+        Validation rows of the file
+    """
+    rng = None if random_state is None else np.random.default_rng(random_state)
+    split_rng = np.random.default_rng(split_seed)
+    for filename in quotas.index:
+        training, validation = [], []
+        for filename, key, partition in read_partitions(store_dir, manifest, quotas.loc[[filename]], columns):
+            rows = _kept_rows(partition, quotas.loc[filename, key], rng)
+            permutation = split_rng.permutation(len(rows))
+            n_valid = int(round(test_size * len(rows)))
+            validation.append(rows.iloc[np.sort(permutation[:n_valid])])
+            training.append(rows.iloc[permutation[n_valid:]])
+        if(training):
+            training = pd.concat(training, ignore_index=True)
+            yield filename, training.iloc[split_rng.permutation(len(training))].reset_index(drop=True), pd.concat(validation, ignore_index=True)
+
+def balanced_normaliser(store_dir, manifest, counts, quotas, n_quantiles=1000, columns=None):
+    """
+    Combines the quantile sketches of the partitions into a normaliser for the balanced data, without reading any data.
+
+    The sketch of each group in each partition is weighted by the fraction of its rows which are kept.
+
+    Arguments
+    ---------
+    store_dir : str
+        Directory of the store
+    manifest : dict
+        See `read_manifest`
+    counts, quotas : pd.DataFrame
+        Rows per group and file, and rows to keep, see `group_counts` and `balanced_quotas`
+    n_quantiles : int
+        Number of quantiles of the normaliser
+    columns : list or None
+        Columns to normalise, out of the sketched columns. If None, all sketched columns
+
+    Returns
+    -------
+    normaliser : QuantileNormaliser
+        Normaliser approximating one fitted on the balanced data
+    """
+    normaliser = QuantileNormaliser(n_quantiles=n_quantiles)
+    for filename in quotas.index:
+        sketches = load(os.path.join(store_dir, manifest[filename]["sketches"]))
+        for key, sketch in sketches.items():
+            if(key in quotas.columns and quotas.loc[filename, key] > 0):
+                normaliser.merge(sketch, weight=quotas.loc[filename, key] / counts.loc[filename, key])
+    if(columns is not None):
+        normaliser = normaliser.select_columns(columns)
+    return normaliser
+
+
+if(__name__ == "__main__"):
+    from train import filenames, used_columns, equalised_columns, load_filters, float32_features, n_quantiles
+    from utils import label_columns
+
+    store_dir = os.path.join("data", "processed")
+    n_jobs = None
+
+    sketch_columns = [x for x in used_columns if x not in label_columns and x not in equalised_columns]
+    manifest = ingest([os.path.join("data", filename) for filename in filenames], store_dir, used_columns, equalised_columns, sketch_columns,
+                      filters=load_filters, float32=float32_features, n_quantiles=n_quantiles, n_jobs=n_jobs)
+    print(group_counts(manifest, list(manifest)).T)
@@ -0,0 +1,228 @@
+import os
+import time
+import pickle
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sklearn.ensemble import RandomForestClassifier
+
+from sweep import classifiers, array_names, write_arrays
+from utils import group_ranks
+
+#directory in which the training and validation arrays are saved for the worker processes
+curve_dir = os.path.join("models", "learning_curve")
+
+#tree-count scan: trees are added in steps to one warm-started forest
+tree_counts = [10, 25, 50, 100, 150, 200, 300]
+forest_params = {"max_depth": None, "n_jobs": -1}
+
+#training-set scan: one model per nested subset of the training set, trained in parallel
+subset_fractions = [0.05, 0.1, 0.2, 0.35, 0.5, 0.75, 1.0]
+subset_params = {"classifier": "RandomForestClassifier", "n_estimators": 200}
+n_jobs = None
+
+#the cheapest configuration reaching this validation accuracy is reported
+target_score = 0.9
+random_state = 0
+show_plots = True
+
+#memory-mapped training and validation arrays and subset order of each worker process, loaded once by _init_worker
+_worker_arrays = {}
+
+
+def model_size(classifier):
+    """Returns the size of a pickled classifier in bytes."""
+    return len(pickle.dumps(classifier))
+
+def tree_count_scan(X_train, y_train, X_valid, y_valid, tree_counts, params=None, random_state=None):
+    """
+    Grows a random forest with `warm_start`, adding trees in steps, and scores it on the validation set after each step.
+
+    Every tree is fitted and applied to the validation set once: the class probabilities of the new trees are added to a
+    running sum, so the whole scan costs about as much as fitting and scoring the largest forest.
+
+    Arguments
+    ---------
+    X_train, y_train, X_valid, y_valid : array-like
+        Normalised training and validation sets
+    tree_counts : list
+        Numbers of trees at which the forest is scored
+    params : dict or None
+        Other parameters of the `RandomForestClassifier`
+    random_state : int or None
+        Seed of the forest
+
+    Returns
+    -------
+    results : pd.DataFrame
+        Per number of trees: the validation accuracy, the total fit time up to that step, and the model size
+    """
+    classifier = RandomForestClassifier(warm_start=True, random_state=random_state, **(params or {}))
+    y_valid = np.asarray(y_valid)
+    probabilities = None
+    fit_time = 0
+    rows = []
+    for n_trees in sorted(tree_counts):
+        n_fitted = len(getattr(classifier, "estimators_", []))
+        start = time.perf_counter()
+        classifier.set_params(n_estimators=n_trees).fit(X_train, y_train)
+        fit_time += time.perf_counter() - start
+
+        #the forest averages the probabilities of its trees, so the running sum gives the same predictions
+        for tree in classifier.estimators_[n_fitted:]:
+            tree_probabilities = tree.predict_proba(np.asarray(X_valid, dtype=np.float32))
+            probabilities = tree_probabilities if probabilities is None else probabilities + tree_probabilities
+        score = np.mean(classifier.classes_[np.argmax(probabilities, axis=1)] == y_valid)
+
+        rows.append({"Trees": n_trees, "Score": score, "Fit time (s)": fit_time, "Model size (bytes)": model_size(classifier)})
+        print("{:>5} trees: score {:.4f}, fit time {:.1f} s".format(n_trees, score, fit_time))
+    return pd.DataFrame(rows)
+
+def nested_subset_order(strata, random_state=None):
+    """
+    Orders the training rows so that every prefix is a stratified random subset, and smaller subsets are contained in larger ones.
+
+    Rows are shuffled within each stratum and ordered by their rank within the stratum relative to its size, so the
+    first n rows contain (up to rounding) the same fraction of every stratum.
+
+    Arguments
+    ---------
+    strata : np.ndarray
+        Stratum of each row, e.g. the group codes of the equalised columns (see `utils.group_codes`) or the labels
+    random_state : int or None
+        Seed of the shuffling. If None, the rows are still shuffled, with an unpredictable seed
+
+    Returns
+    -------
+    order : np.ndarray
+        Row positions; the subset of n rows is order[:n]
+    """
+    codes = np.unique(np.asarray(strata), return_inverse=True)[1]
+    #a generator is always passed, as group_ranks keeps the rows in file order for a None seed
+    order, sorted_codes, ranks = group_ranks(codes, np.random.default_rng(random_state))
+    sizes = np.bincount(sorted_codes)
+    #the middle of each row's share of its stratum, so that strata of different sizes interleave evenly
+    return order[np.argsort((ranks + 0.5) / sizes[sorted_codes], kind="stable")]
+
+def _init_worker(curve_dir):
+    for name in array_names + ["subset_order"]:
+        _worker_arrays[name] = np.load(os.path.join(curve_dir, name + ".npy"), mmap_mode="r")
+
+def _fit_subset(n_samples, params):
+    params = dict(params)
+    classifier = classifiers[params.pop("classifier")](**params)
+    positions = np.sort(_worker_arrays["subset_order"][:n_samples])
+
+    start = time.perf_counter()
+    classifier.fit(_worker_arrays["X_train"][positions], _worker_arrays["y_train"][positions])
+    fit_time = time.perf_counter() - start
+
+    score = classifier.score(_worker_arrays["X_valid"], _worker_arrays["y_valid"])
+    return {"Training samples": n_samples, "Score": score, "Fit time (s)": fit_time, "Model size (bytes)": model_size(classifier)}
+
+def subset_scan(curve_dir, fractions, params, n_jobs=None):
+    """
+    Trains one model per nested, stratified subset of the training set, in parallel, and scores each on the full validation set.
+
+    Expects the arrays written by `write_arrays` and the subset order of `nested_subset_order` (as "subset_order.npy")
+    in `curve_dir`; every worker memory-maps them once.
+
+    Arguments
+    ---------
+    curve_dir : str
+        Directory containing the arrays
+    fractions : list
+        Fractions of the training set to train on
+    params : dict
+        Classifier type ("classifier", see `sweep.classifiers`) and its parameters
+    n_jobs : int or None
+        Number of worker processes. If None, one per CPU
+
+    Returns
+    -------
+    results : pd.DataFrame
+        Per subset size: the validation accuracy, the fit time, and the model size
+    """
+    n_rows = len(np.load(os.path.join(curve_dir, "subset_order.npy"), mmap_mode="r"))
+    sizes = sorted({max(1, int(round(fraction * n_rows))) for fraction in fractions})
+
+    rows = []
+    with ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=(curve_dir,)) as executor:
+        #the largest subsets take longest, so they are started first
+        futures = [executor.submit(_fit_subset, n_samples, params) for n_samples in sizes[::-1]]
+        for future in as_completed(futures):
+            rows.append(future.result())
+            print("{:>9} samples: score {:.4f}, fit time {:.1f} s".format(rows[-1]["Training samples"], rows[-1]["Score"], rows[-1]["Fit time (s)"]))
+    return pd.DataFrame(rows).sort_values("Training samples", ignore_index=True)
+
+def cheapest(results, target_score, cost="Fit time (s)"):
+    """
+    Returns the configuration with the lowest cost which reaches the target validation accuracy, or None if none does.
+
+    Arguments
+    ---------
+    results : pd.DataFrame
+        Results of `tree_count_scan` or `subset_scan`
+    target_score : float
+        Validation accuracy to reach
+    cost : str
+        Column to minimise, e.g. "Fit time (s)" or "Model size (bytes)"
+
+    Returns
+    -------
+    row : pd.Series or None
+    """
+    reached = results[results["Score"] >= target_score]
+    if(len(reached) == 0):
+        return None
+    return reached.loc[reached[cost].idxmin()]
+
+def plot_curves(tree_results, subset_results):
+    """Plots the validation accuracy and fit time against the number of trees and the training set size."""
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(1, 2, figsize=(14, 6), constrained_layout=True)
+    for ax, results, x in [(axes[0], tree_results, "Trees"), (axes[1], subset_results, "Training samples")]:
+        ax.plot(results[x], results["Score"], marker="o", color="C0")
+        ax.set_xlabel(x)
+        ax.set_ylabel("Validation accuracy", color="C0")
+        time_ax = ax.twinx()
+        time_ax.plot(results[x], results["Fit time (s)"], marker="s", color="C1")
+        time_ax.set_ylabel("Fit time (s)", color="C1")
+    plt.show()
+
+def main():
+    import train
+    from utils import train_test_balanced, group_codes
+    from normaliser import QuantileNormaliser
+
+    dataframe = train.preprocessed_dataframe()
+    train_columns = [x for x in train.used_columns if x not in train.excluded_columns]
+    split_columns = train_columns + [x for x in train.equalised_columns if x not in train_columns]
+    X_train, X_valid, y_train, y_valid = train_test_balanced(dataframe, train.equalised_columns, split_columns, random_state=train.split_seed)
+    strata, keys = group_codes(X_train, train.equalised_columns)
+    normaliser = QuantileNormaliser(n_quantiles=train.n_quantiles).fit(X_train[train_columns])
+    X_train, X_valid = normaliser.transform(X_train[train_columns]), normaliser.transform(X_valid[train_columns])
+
+    print("Tree-count scan")
+    tree_results = tree_count_scan(X_train, y_train, X_valid, y_valid, tree_counts, forest_params, random_state)
+
+    print("Training-set scan")
+    write_arrays(curve_dir, X_train, X_valid, y_train, y_valid)
+    np.save(os.path.join(curve_dir, "subset_order.npy"), nested_subset_order(strata, random_state))
+    subset_results = subset_scan(curve_dir, subset_fractions, subset_params, n_jobs)
+
+    for name, results in [("trees", tree_results), ("training samples", subset_results)]:
+        print(results.to_string(index=False))
+        best = cheapest(results, target_score)
+        if(best is None):
+            print("No number of {} reaches a score of {}".format(name, target_score))
+        else:
+            print("Cheapest number of {} reaching a score of {}:\n{}".format(name, target_score, best.to_string()))
+
+    if(show_plots):
+        plot_curves(tree_results, subset_results)
+
+
+if(__name__ == "__main__"):
+    main()
@@ -0,0 +1,288 @@
+import os
+import numpy as np
+from scipy.special import ndtri
+from joblib import dump, load
+
+#values within this distance of the outer quantiles are mapped to the bounds, as in sklearn
+BOUNDS_THRESHOLD = 1e-7
+
+
+def _columnwise_interp(x, xp, fp, side="right"):
+    """
+    Applies `np.interp` to every column at once.
+
+    Columns are separated by mapping each of them onto [2j, 2j + 1] before a single `np.searchsorted` over all knots.
+
+    Arguments
+    ---------
+    x : np.ndarray
+        Values to be interpolated, shape (n, f)
+    xp : np.ndarray
+        Knots, sorted within each column, shape (k, f)
+    fp : np.ndarray
+        Values at the knots, shape (k, f)
+    side : str
+        "right" or "left", decides which knot is used when a value equals several knots
+
+    Returns
+    -------
+    y : np.ndarray
+        Interpolated values, shape (n, f). Values outside the knots get the value of the nearest knot
+    """
+    k, f = xp.shape
+    lower = xp[0]
+    scale = xp[-1] - lower
+    scale[scale == 0] = 1
+    columns = np.arange(f)
+
+    flat_xp = (np.clip((xp - lower) / scale, 0, 1) + 2 * columns).T.ravel()
+    scaled_x = np.clip((x - lower) / scale, 0, 1) + 2 * columns
+    index = np.searchsorted(flat_xp, scaled_x, side=side)
+    index = np.clip(index, columns * k + 1, columns * k + k - 1)
+
+    xp_flat, fp_flat = xp.T.ravel(), fp.T.ravel()
+    x_low, x_high = xp_flat[index - 1], xp_flat[index]
+    f_low, f_high = fp_flat[index - 1], fp_flat[index]
+    width = x_high - x_low
+    t = np.divide(x - x_low, width, out=np.zeros_like(width, dtype=float), where=width != 0)
+    return f_low + np.clip(t, 0, 1) * (f_high - f_low)
+
+def _weighted_quantiles(knots, weights, probabilities):
+    """
+    Computes quantiles of weighted points for every column at once.
+
+    Arguments
+    ---------
+    knots : np.ndarray
+        Points, shape (k, f)
+    weights : np.ndarray
+        Weight of each row of points, shape (k,)
+    probabilities : np.ndarray
+        Probabilities at which the quantiles are computed, shape (q,)
+
+    Returns
+    -------
+    quantiles : np.ndarray
+        Quantiles, shape (q, f)
+    """
+    order = np.argsort(knots, axis=0)
+    sorted_knots = np.take_along_axis(knots, order, axis=0)
+    sorted_weights = weights[order]
+    cumulative = np.cumsum(sorted_weights, axis=0)
+    #each point represents the probability mass around it
+    positions = (cumulative - sorted_weights / 2) / cumulative[-1]
+
+    targets = np.broadcast_to(probabilities[:, None], (len(probabilities), knots.shape[1]))
+    return _columnwise_interp(targets, positions, sorted_knots)
+
+
+class QuantileNormaliser:
+    """
+    Maps each feature to a standard normal distribution through its quantiles.
+
+    Same mapping as sklearn's `quantile_transform(output_distribution="normal")`, but fitted once (on the training set) and reusable on new data.
+    Can be fitted on the whole dataset with `fit`, or in one streaming pass over chunks with `partial_fit`,
+    which keeps a bounded-memory sketch of at most `max_summaries` x `sketch_size` points per feature.
+
+    Arguments
+    ---------
+    n_quantiles : int
+        Number of quantiles used for the mapping
+    sketch_size : int
+        Number of points kept per feature to summarise each chunk in `partial_fit`
+    max_summaries : int
+        Number of chunk summaries kept before they are merged into one
+    excluded_columns : list
+        Names of columns which are passed through unchanged by `transform`
+    """
+
+    def __init__(self, n_quantiles=1000, sketch_size=2000, max_summaries=16, excluded_columns=()):
+        self.n_quantiles = n_quantiles
+        self.sketch_size = sketch_size
+        self.max_summaries = max_summaries
+        self.excluded_columns = list(excluded_columns)
+
+    def _feature_values(self, dataframe):
+        if(not hasattr(self, "columns_")):
+            self.columns_ = [column for column in dataframe.columns if column not in self.excluded_columns]
+        return dataframe[self.columns_].to_numpy(dtype=float)
+
+    def fit(self, dataframe):
+        """
+        Fits the quantiles exactly on a dataframe held in memory.
+
+        Arguments
+        ---------
+        dataframe : pd.DataFrame
+            Training data
+
+        Returns
+        -------
+        self : QuantileNormaliser
+        """
+        for attribute in ("columns_", "summaries_", "n_samples_"):
+            self.__dict__.pop(attribute, None)
+        values = self._feature_values(dataframe)
+
+        n_quantiles = min(self.n_quantiles, len(values))
+        self.references_ = np.linspace(0, 1, n_quantiles)
+        self.quantiles_ = np.quantile(values, self.references_, axis=0)
+        self.n_samples_ = len(values)
+        return self
+
+    def partial_fit(self, dataframe):
+        """
+        Adds a chunk of data to the quantile sketch and updates the quantiles.
+
+        Arguments
+        ---------
+        dataframe : pd.DataFrame
+            Chunk of training data
+
+        Returns
+        -------
+        self : QuantileNormaliser
+        """
+        values = self._feature_values(dataframe)
+        if(len(values) == 0):
+            return self
+
+        if(len(values) <= self.sketch_size):
+            knots = np.sort(values, axis=0)
+        else:
+            knots = np.quantile(values, np.linspace(0, 1, self.sketch_size), axis=0)
+        weights = np.full(len(knots), len(values) / len(knots))
+
+        self.summaries_ = getattr(self, "summaries_", []) + [(knots, weights)]
+        self.n_samples_ = getattr(self, "n_samples_", 0) + len(values)
+        if(len(self.summaries_) > self.max_summaries):
+            self.summaries_ = [self._merged_summary(self.sketch_size)]
+
+        self._update_quantiles()
+        return self
+
+    def merge(self, other, weight=1.0):
+        """
+        Combines the sketch of another normaliser, fitted with `partial_fit` on other data, into this one.
+
+        Arguments
+        ---------
+        other : QuantileNormaliser
+            Normaliser fitted on the same columns
+        weight : float
+            Fraction of the data of `other` to count, e.g. the fraction of a group which is kept when balancing
+
+        Returns
+        -------
+        self : QuantileNormaliser
+        """
+        if(not hasattr(self, "columns_")):
+            self.columns_ = list(other.columns_)
+        self.summaries_ = getattr(self, "summaries_", []) + [(knots, weights * weight) for knots, weights in other.summaries_]
+        self.n_samples_ = getattr(self, "n_samples_", 0) + other.n_samples_ * weight
+        if(len(self.summaries_) > self.max_summaries):
+            self.summaries_ = [self._merged_summary(self.sketch_size)]
+
+        self._update_quantiles()
+        return self
+
+    def select_columns(self, columns):
+        """
+        Restricts the normaliser to some of the columns it was fitted on, e.g. a feature subset.
+
+        Arguments
+        ---------
+        columns : list
+            Names of the columns to keep
+
+        Returns
+        -------
+        normaliser : QuantileNormaliser
+            New normaliser, which leaves the other columns unchanged in `transform`
+        """
+        positions = [self.columns_.index(column) for column in columns]
+        normaliser = QuantileNormaliser(self.n_quantiles, self.sketch_size, self.max_summaries, self.excluded_columns)
+        normaliser.columns_ = list(columns)
+        normaliser.references_ = self.references_
+        normaliser.quantiles_ = self.quantiles_[:, positions]
+        normaliser.n_samples_ = self.n_samples_
+        if(hasattr(self, "summaries_")):
+            normaliser.summaries_ = [(knots[:, positions], weights) for knots, weights in self.summaries_]
+        return normaliser
+
+    def fit_chunks(self, chunks):
+        """
+        Fits the normaliser in one streaming pass over an iterable of dataframes.
+
+        Arguments
+        ---------
+        chunks : iterable
+            Iterable of dataframes
+
+        Returns
+        -------
+        self : QuantileNormaliser
+        """
+        for chunk in chunks:
+            self.partial_fit(chunk)
+        return self
+
+    def _merged_summary(self, size):
+        knots = np.concatenate([knots for knots, weights in self.summaries_])
+        weights = np.concatenate([weights for knots, weights in self.summaries_])
+        if(len(knots) <= size):
+            return knots, weights
+        merged_knots = _weighted_quantiles(knots, weights, np.linspace(0, 1, size))
+        return merged_knots, np.full(size, weights.sum() / size)
+
+    def _update_quantiles(self):
+        knots, weights = self._merged_summary(np.inf)
+        n_quantiles = int(min(self.n_quantiles, self.n_samples_))
+        self.references_ = np.linspace(0, 1, n_quantiles)
+        self.quantiles_ = _weighted_quantiles(knots, weights, self.references_)
+
+    def transform(self, dataframe):
+        """
+        Maps the features of a dataframe to a standard normal distribution.
+
+        Arguments
+        ---------
+        dataframe : pd.DataFrame
+            Data containing at least the columns the normaliser was fitted on
+
+        Returns
+        -------
+        dataframe : pd.DataFrame
+            Copy of the data with normalised feature columns; other columns are unchanged
+        """
+        values = dataframe[self.columns_].to_numpy(dtype=float)
+        references = np.broadcast_to(self.references_[:, None], self.quantiles_.shape)
+
+        #average of interpolating from both sides, so that repeated quantiles map to the middle of their range
+        probabilities = 0.5 * (_columnwise_interp(values, self.quantiles_, references, side="right")
+                               + _columnwise_interp(values, self.quantiles_, references, side="left"))
+        probabilities[values + BOUNDS_THRESHOLD > self.quantiles_[-1]] = 1
+        probabilities[values - BOUNDS_THRESHOLD < self.quantiles_[0]] = 0
+        probabilities = np.clip(probabilities, BOUNDS_THRESHOLD - np.spacing(1), 1 - (BOUNDS_THRESHOLD - np.spacing(1)))
+
+        dataframe = dataframe.copy()
+        dataframe[self.columns_] = ndtri(probabilities)
+        return dataframe
+
+    def fit_transform(self, dataframe):
+        """Fits the normaliser on a dataframe and returns the normalised dataframe."""
+        return self.fit(dataframe).transform(dataframe)
+
+    def save(self, filepath):
+        """Saves the fitted normaliser with joblib."""
+        dump(self, filepath)
+
+
+def normaliser_filepath(model_filepath):
+    """Returns the path at which the normaliser of a model is saved, e.g. models/m9_normaliser.joblib for models/m9.joblib."""
+    root, extension = os.path.splitext(model_filepath)
+    return root + "_normaliser" + extension
+
+def load_normaliser(model_filepath):
+    """Loads the normaliser saved next to a model."""
+    return load(normaliser_filepath(model_filepath))
@@ -1,39 +1,229 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.stats as st
-import pandas as pd
+from scipy.signal import fftconvolve
 import os
 
-from utils import column_renamer, is_shower, pdgid_converter, clear_line
+from utils import load_from_h5, clear_line
+from cache import file_fingerprint, stage_key
+from spatial_index import GridIndex, build_index, cached_index, uniform_sample
 
 
-def plot_density(dataframe, *, gridsize = 100, datapoint_count = 1000, xmin = 300, xmax = 600, ymin = 450, ymax = 700):
+xmin, xmax = 300, 600
+ymin, ymax = 450, 700
+datapoint_count = None #random sample of the points in view; None uses all
+margin = 0.1 #points up to this fraction of the window size outside it are used too, so the density does not drop at the edges
+gridsize = 400
+method = "fft"
+position = "Track" #"Track" for the track positions of track events, "Shower" for the shower positions of shower events
+sample_seed = 0
+
+#directory in which the spatial index of the positions is saved, so that it is built once per set of files
+index_dir = os.path.join("data", "cache")
+cache_max_bytes = 20 * 1024**3 #shared with the other cached files in `index_dir`, see `cache.evict_cache`
+
+#files in the "data" subfolder
+filenames = ["neutrino11x.h5", "neutrino12x.h5", "neutrino13x.h5"]
+
+
+def kde_bandwidth_factor(n, bw_method="scott", d=2):
     """
-    Plot the density of track reconstructions in the x-y plane and display the plot.
+    Bandwidth factor by which the data covariance is scaled, following the rules of `scipy.stats.gaussian_kde`.
+
+    Arguments:
+    ----------
+    n : int
+        Number of datapoints
+    bw_method : str or float
+        "scott", "silverman", or a fixed factor
+    d : int
+        Number of dimensions
+
+    Returns:
+    --------
+    factor : float
+        Bandwidth factor
+    """
+    if(bw_method == "scott"):
+        return n**(-1 / (d + 4))
+    elif(bw_method == "silverman"):
+        return (n * (d + 2) / 4)**(-1 / (d + 4))
+    elif(np.isscalar(bw_method) and not isinstance(bw_method, str)):
+        return bw_method
+    raise ValueError("bw_method should be 'scott', 'silverman' or a number, not {}".format(bw_method))
+
+def binned_kde(x, y, *, gridsize = 100, xmin = 300, xmax = 600, ymin = 450, ymax = 700, bw_method = "scott", max_padding = 1000):
+    """
+    Gaussian kernel density estimate on a regular grid, computed by binning the points onto the grid and convolving with the kernel using FFT.
+
+    Matches `scipy.stats.gaussian_kde` evaluated on the same grid (same covariance and bandwidth rules) up to the binning error,
+    but costs O(N + G² log G) instead of O(N · G²), so all points can be used.
+    The grid is extended beyond the window by four kernel widths (at most `max_padding` cells), so points outside the window still contribute.
+
+    Arguments:
+    ----------
+    x, y : array-like
+        Coordinates of the points
+    gridsize : int
+        Resolution of the grid, resulting in a gridsize x gridsize array of density values
+    xmin, xmax, ymin, ymax : floats
+        Window in which the density is evaluated (grid points on the edges included, as in np.mgrid)
+    bw_method : str or float
+        "scott", "silverman", or a fixed bandwidth factor, as in `gaussian_kde`
+    max_padding : int
+        Maximum number of grid cells added on each side of the window
+
+    Returns:
+    --------
+    Z : np.ndarray
+        gridsize x gridsize array of density values, indexed as [x, y]
+    """
+    points = np.vstack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+    n = points.shape[1]
+    covariance = np.cov(points) * kde_bandwidth_factor(n, bw_method)**2
+
+    dx = (xmax - xmin) / (gridsize - 1)
+    dy = (ymax - ymin) / (gridsize - 1)
+    pad_x = int(min(np.ceil(4 * np.sqrt(covariance[0, 0]) / dx), max_padding))
+    pad_y = int(min(np.ceil(4 * np.sqrt(covariance[1, 1]) / dy), max_padding))
+    shape = (gridsize + 2 * pad_x, gridsize + 2 * pad_y)
+
+    #linear binning: each point is divided over the four surrounding grid points
+    fx = (points[0] - xmin) / dx + pad_x
+    fy = (points[1] - ymin) / dy + pad_y
+    inside = (fx >= 0) & (fx < shape[0] - 1) & (fy >= 0) & (fy < shape[1] - 1)
+    fx, fy = fx[inside], fy[inside]
+    ix, iy = np.floor(fx).astype(np.int64), np.floor(fy).astype(np.int64)
+    tx, ty = fx - ix, fy - iy
+
+    counts = np.zeros(shape)
+    for offset_x, offset_y, weights in [(0, 0, (1 - tx) * (1 - ty)), (1, 0, tx * (1 - ty)), (0, 1, (1 - tx) * ty), (1, 1, tx * ty)]:
+        counts += np.bincount((ix + offset_x) * shape[1] + iy + offset_y, weights=weights, minlength=shape[0] * shape[1]).reshape(shape)
+
+    #normalised Gaussian kernel on the grid offsets
+    kx, ky = np.mgrid[-pad_x:pad_x + 1, -pad_y:pad_y + 1]
+    offsets = np.vstack([kx.ravel() * dx, ky.ravel() * dy])
+    inverse = np.linalg.inv(covariance)
+    exponent = np.einsum("in,ij,jn->n", offsets, inverse, offsets)
+    kernel = (np.exp(-0.5 * exponent) / (2 * np.pi * np.sqrt(np.linalg.det(covariance)))).reshape(kx.shape)
+
+    density = fftconvolve(counts, kernel, mode="same") / n
+    return np.clip(density[pad_x:pad_x + gridsize, pad_y:pad_y + gridsize], 0, None)
+
+def window_points(data, *, xmin = 300, xmax = 600, ymin = 450, ymax = 700, margin = 0.1, datapoint_count = None, position = "Track", random_state = None):
+    """
+    Selects the points in the window, extended by `margin` times its size on each side.
+
+    With a `GridIndex`, only the points in the grid cells covering the window are read, so zooming in costs time proportional to the points in view.
+
+    Arguments:
+    ----------
+    data : pd.Dataframe or GridIndex
+        Dataframe containing the particle data, or a spatial index of the positions (see `spatial_index.build_index`)
+    xmin, xmax, ymin, ymax : floats
+        Window
+    margin : float
+        Fraction of the window width (height) by which the window is extended on the left and right (bottom and top)
+    datapoint_count : int or None
+        Amount of datapoints to draw uniformly at random from the points in the extended window. If None, all of them are used
+    position : str
+        "Track" or "Shower", the position columns of the dataframe to be used
+    random_state : int, np.random.Generator or None
+        Seed of the sample
+
+    Returns:
+    --------
+    x, y : np.ndarray
+        Coordinates of the selected points
+    """
+    pad_x, pad_y = margin * (xmax - xmin), margin * (ymax - ymin)
+    window = (xmin - pad_x, xmax + pad_x, ymin - pad_y, ymax + pad_y)
+    if(isinstance(data, GridIndex)):
+        return data.points(*window, sample_size=datapoint_count, random_state=random_state)
+
+    x = data["{} x-position".format(position)].to_numpy()
+    y = data["{} y-position".format(position)].to_numpy()
+    inside = np.flatnonzero((x >= window[0]) & (x <= window[1]) & (y >= window[2]) & (y <= window[3]))
+    inside = uniform_sample(inside, datapoint_count, random_state)
+    return x[inside], y[inside]
+
+def density_grid(data, *, gridsize = 100, datapoint_count = None, xmin = 300, xmax = 600, ymin = 450, ymax = 700, margin = 0.1, method = "fft", bw_method = "scott", position = "Track", random_state = None):
+    """
+    Compute the density of track reconstructions in the x-y plane on a grid.
+
+    Only the points in (and within `margin` around) the window are used, see `window_points`, so the bandwidth follows the spread of the points in view.
 
-    Only uses the first `datapoint_count` particles. This is implemented as a time-saving feature.
-    
     Arguments:
     ----------
-    dataframe : pd.Dataframe
-        Dataframe containing the particle data to be analysed
+    data : pd.Dataframe or GridIndex
+        Dataframe containing the particle data to be analysed, or a spatial index of the positions
     gridsize : int
         Resolution of the density plot, resulting in a gridsize x gridsize array of density values
-    datapoint_count : int
-        Amount of datapoints to be used for the density plot
+    datapoint_count : int or None
+        Amount of datapoints to be used for the density plot, sampled at random from the points in view. If None, all of them are used
     xmin, xmax, ymin, ymax : ints
         Parameters indicating the x-y location of the density plot
+    margin : float
+        Fraction of the window size around the window from which points are used too
+    method : str
+        "fft" for the binned estimate of `binned_kde`, "exact" for evaluating `scipy.stats.gaussian_kde` at every grid point
+    bw_method : str or float
+        "scott", "silverman", or a fixed bandwidth factor, as in `gaussian_kde`
+    position : str
+        "Track" or "Shower", the position columns to be used if `data` is a dataframe
+    random_state : int, np.random.Generator or None
+        Seed of the sample of `datapoint_count` points
+
+    Returns:
+    --------
+    Z : np.ndarray
+        gridsize x gridsize array of density values, indexed as [x, y]
     """
+    x, y = window_points(data, xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax, margin=margin, datapoint_count=datapoint_count, position=position, random_state=random_state)
+    if(len(x) < 2):
+        raise ValueError("Only {} points in the window, at least 2 are needed for the density".format(len(x)))
 
-    x = dataframe[0:datapoint_count]["Track x-position"]
-    y = dataframe[0:datapoint_count]["Track y-position"]
+    if(method == "fft"):
+        return binned_kde(x, y, gridsize=gridsize, xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax, bw_method=bw_method)
 
     X, Y = np.mgrid[xmin:xmax:gridsize * 1j, ymin:ymax:gridsize * 1j]
     positions = np.vstack([X.ravel(), Y.ravel()])
     values = np.vstack([x, y])
-    kernel = st.gaussian_kde(values)
+    kernel = st.gaussian_kde(values, bw_method=bw_method)
     Z = np.reshape(kernel(positions).T, X.shape)
 
+    return Z
+
+def plot_density(data, *, gridsize = 100, datapoint_count = None, xmin = 300, xmax = 600, ymin = 450, ymax = 700, margin = 0.1, method = "fft", bw_method = "scott", position = "Track", random_state = None):
+    """
+    Plot the density of track reconstructions in the x-y plane and display the plot.
+
+    With the default "fft" method all particles in view can be used. The "exact" method is slow, so `datapoint_count` can limit it to a random sample of them.
+    
+    Arguments:
+    ----------
+    data : pd.Dataframe or GridIndex
+        Dataframe containing the particle data to be analysed, or a spatial index of the positions
+    gridsize : int
+        Resolution of the density plot, resulting in a gridsize x gridsize array of density values
+    datapoint_count : int or None
+        Amount of datapoints to be used for the density plot, sampled at random from the points in view. If None, all of them are used
+    xmin, xmax, ymin, ymax : ints
+        Parameters indicating the x-y location of the density plot
+    margin : float
+        Fraction of the window size around the window from which points are used too
+    method : str
+        "fft" (binned, fast) or "exact" (`scipy.stats.gaussian_kde`), see `density_grid`
+    bw_method : str or float
+        "scott", "silverman", or a fixed bandwidth factor, as in `gaussian_kde`
+    position : str
+        "Track" or "Shower", the position columns to be used if `data` is a dataframe
+    random_state : int, np.random.Generator or None
+        Seed of the sample of `datapoint_count` points
+    """
+    Z = density_grid(data, gridsize=gridsize, datapoint_count=datapoint_count, xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax, margin=margin,
+                     method=method, bw_method=bw_method, position=position, random_state=random_state)
+
     fig, ax = plt.subplots()
     ax.imshow(np.rot90(Z), cmap=plt.cm.gist_earth_r, extent=[xmin, xmax, ymin, ymax])
     #ax.plot(x, y, 'k.', markersize=2)
@@ -42,34 +232,48 @@ def plot_density(dataframe, *, gridsize = 100, datapoint_count = 1000, xmin = 30
     plt.show()
 
 
-if(__name__ == "__main__"):
-    xmin, xmax = 300, 600
-    ymin, ymax = 450, 700
-    datapoint_count = 1000
-    gridsize = 100
-    
-    filenames = ["neutrino11x.h5", "neutrino12x.h5", "neutrino13x.h5"]
-    filepaths = [os.path.join("data", filename) for filename in filenames]
+def load_positions(filepaths, position = "Track"):
+    """
+    Loads the x and y positions of the tracks of track events, or of the showers of shower events, from HDF files.
+
+    Only the position columns and the columns needed for the labels are read.
 
+    Arguments:
+    ----------
+    filepaths : list
+        Paths of the HDF files
+    position : str
+        "Track" or "Shower"
+
+    Returns:
+    --------
+    x, y : np.ndarray
+        Coordinates of the positions
+    """
     print("Loading database...", end="\r")
-    df_list = []
-    for filepath in filepaths:
-        df_list.append(pd.read_hdf(filepath))
-    dataframe = pd.concat(df_list)
+    columns = ["{} x-position".format(position), "{} y-position".format(position)]
+    dataframe = load_from_h5(filepaths, columns=columns)
     
     clear_line()
-    print("Renaming columns...", end="\r")
-    dataframe.rename(column_renamer, axis="columns", inplace=True)
-    #dataframe["Particle name"] = dataframe.apply(lambda row: pdgid_converter(row["pdgid"]), axis=1)
-    dataframe["Is shower?"] = dataframe.apply(is_shower, axis=1)
-    
+    print("Extracing {} data...".format("muon" if position == "Track" else "shower"), end="\r")
+    selected = dataframe[dataframe["Is shower?"] == (position == "Shower")]
+
     clear_line()
-    print("Extracing muon data...", end="\r")
-    df_muon = dataframe[dataframe["Is shower?"] == False]
-    df_else = dataframe[dataframe["Is shower?"] == True]
+    return selected[columns[0]].to_numpy(), selected[columns[1]].to_numpy()
+
+def main():
+    filepaths = [os.path.join("data", filename) for filename in filenames]
+
+    #the index is saved per set of files (by size and modification time) and position, so later plots skip loading the data
+    key = stage_key([file_fingerprint(filepath) for filepath in filepaths], position)
+    index = cached_index(index_dir, key, lambda: build_index(*load_positions(filepaths, position)), cache_max_bytes)
     
-    clear_line()
     print("Plotting density...", end="\r")
-    plot_density(df_muon, gridsize=gridsize, datapoint_count=datapoint_count, xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax)
+    plot_density(index, gridsize=gridsize, datapoint_count=datapoint_count, xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax, margin=margin,
+                 method=method, position=position, random_state=sample_seed)
 
-    clear_line()
\ No newline at end of file
+    clear_line()
+
+
+if(__name__ == "__main__"):
+    main()
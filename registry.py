@@ -0,0 +1,267 @@
+import os
+import json
+import datetime
+from contextlib import contextmanager
+import pandas as pd
+from joblib import dump, load
+
+try:
+    import fcntl
+except ImportError:
+    #not available on Windows, where the index is updated without a lock
+    fcntl = None
+
+#name of the index file in the models directory, holding the metadata of all registered models
+index_filename = "index.json"
+
+#classifier types which `load_model` can load as their compiled predictor, see `compiled_model.py`
+forest_types = ("RandomForestClassifier", "ExtraTreesClassifier")
+
+
+def metadata_filepath(model_filepath):
+    """Returns the path of the metadata sidecar of a model, e.g. models/m9.json for models/m9.joblib."""
+    return os.path.splitext(model_filepath)[0] + ".json"
+
+def classifier_type(classifier):
+    """Returns the name of the classifier type, with the steps of a pipeline, e.g. "Nystroem+SGDClassifier"."""
+    steps = getattr(classifier, "steps", None)
+    if(steps is not None):
+        return "+".join(type(step).__name__ for name, step in steps)
+    return type(classifier).__name__
+
+def model_metadata(classifier, model_filepath, **values):
+    """
+    Describes a fitted classifier.
+
+    Arguments
+    ---------
+    classifier
+        Fitted sklearn classifier
+    model_filepath : str
+        Path at which the classifier is saved
+    **values
+        Other metadata, e.g. score, fit_time and data_key
+
+    Returns
+    -------
+    metadata : dict
+        Classifier type, parameters, feature names, file size, save time and `values`
+    """
+    feature_names = getattr(classifier, "feature_names_in_", None)
+    metadata = {
+        "filename": os.path.basename(model_filepath),
+        "classifier_type": classifier_type(classifier),
+        "params": {key: value for key, value in classifier.get_params(deep=False).items() if key != "steps"},
+        "feature_names": None if feature_names is None else list(feature_names),
+        "file_size": os.path.getsize(model_filepath),
+        "saved": datetime.datetime.fromtimestamp(os.path.getmtime(model_filepath)).isoformat(timespec="seconds")
+    }
+    metadata.update(values)
+    return metadata
+
+def _write_json(filepath, data):
+    #written to a temporary file first, so that readers never see a half-written file
+    temporary_filepath = filepath + ".tmp"
+    try:
+        with open(temporary_filepath, "w") as json_file:
+            json.dump(data, json_file, indent=1, default=str)
+        os.replace(temporary_filepath, filepath)
+    except BaseException:
+        if(os.path.isfile(temporary_filepath)):
+            os.remove(temporary_filepath)
+        raise
+
+@contextmanager
+def _locked_index(models_dir):
+    """
+    Holds an exclusive lock on the index of a directory while it is read, changed and rewritten, so that models saved at
+    the same time do not drop each other's entries. Without `fcntl` (on Windows), nothing is locked, and the index
+    should be rebuilt with `rebuild_index` after models were saved in parallel.
+    """
+    if(fcntl is None):
+        yield
+        return
+    with open(os.path.join(models_dir, index_filename + ".lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def read_index(models_dir):
+    """
+    Reads the metadata of all registered models from the index, without loading any model.
+
+    Arguments
+    ---------
+    models_dir : str
+        Directory containing the models
+
+    Returns
+    -------
+    index : dict
+        Metadata per model, keyed by the file name of the model
+    """
+    index_filepath = os.path.join(models_dir, index_filename)
+    if(not os.path.isfile(index_filepath)):
+        return {}
+    with open(index_filepath) as index_file:
+        return json.load(index_file)
+
+def register_model(model_filepath, metadata):
+    """
+    Writes the metadata sidecar of a saved model and adds it to the index of its directory.
+
+    Arguments
+    ---------
+    model_filepath : str
+        Path of the saved model
+    metadata : dict
+        Metadata of the model, see `model_metadata`
+    """
+    _write_json(metadata_filepath(model_filepath), metadata)
+    models_dir = os.path.dirname(model_filepath)
+    with _locked_index(models_dir):
+        index = read_index(models_dir)
+        index[os.path.basename(model_filepath)] = metadata
+        _write_json(os.path.join(models_dir, index_filename), index)
+
+def save_model(classifier, model_filepath, **values):
+    """
+    Saves a classifier along with its metadata, and registers it in the index.
+
+    The model is saved uncompressed, so that `load_model` can memory-map its arrays.
+
+    Arguments
+    ---------
+    classifier
+        Fitted sklearn classifier
+    model_filepath : str
+        Path to save the classifier at
+    **values
+        Other metadata, e.g. score, fit_time and data_key
+
+    Returns
+    -------
+    metadata : dict
+        Metadata of the model
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(model_filepath)), exist_ok=True)
+    dump(classifier, model_filepath)
+    metadata = model_metadata(classifier, model_filepath, **values)
+    register_model(model_filepath, metadata)
+    return metadata
+
+def is_forest(model_filepath):
+    """Checks from the metadata sidecar, without loading the model, whether a saved classifier is a forest (see `forest_types`)."""
+    if(not os.path.isfile(metadata_filepath(model_filepath))):
+        return False
+    with open(metadata_filepath(model_filepath)) as metadata_file:
+        return json.load(metadata_file).get("classifier_type") in forest_types
+
+def load_model(model_filepath, mmap=True, predictor=False):
+    """
+    Loads a saved classifier.
+
+    With `mmap`, the numpy arrays in the file (e.g. the support vectors of an SVC or the coefficients of a linear model)
+    are memory-mapped read-only instead of copied, so processes loading the same model share these pages. sklearn copies
+    the nodes of decision trees into memory of their own, so the sklearn object of a forest is never shared. Where only
+    predictions are needed, `predictor` loads registered forests as their compiled predictor instead (`CompiledForest`,
+    compiled next to the model first if needed, see `compiled_model.ensure_compiled`), whose arrays are memory-mapped too.
+    It gives the same predictions, but has none of the other attributes of the sklearn model.
+
+    Arguments
+    ---------
+    model_filepath : str
+        Path of the saved classifier
+    mmap : bool
+        Whether to memory-map the arrays of the model
+    predictor : bool
+        Whether to load forests as their memory-mapped compiled predictor
+
+    Returns
+    -------
+    classifier
+        Loaded classifier, or `CompiledForest` for forests with `predictor`
+    """
+    if(predictor and mmap and is_forest(model_filepath)):
+        from compiled_model import ensure_compiled, load_compiled
+        return load_compiled(ensure_compiled(model_filepath))
+    return load(model_filepath, mmap_mode="r" if mmap else None)
+
+def model_features(model_filepath):
+    """Returns the feature names of a saved classifier, from its metadata sidecar if there is one, or by loading it otherwise."""
+    if(os.path.isfile(metadata_filepath(model_filepath))):
+        with open(metadata_filepath(model_filepath)) as metadata_file:
+            feature_names = json.load(metadata_file).get("feature_names")
+        if(feature_names is not None):
+            return feature_names
+    return list(load_model(model_filepath).feature_names_in_)
+
+def rebuild_index(models_dir, describe_unregistered=True):
+    """
+    Rebuilds the index of a directory from the metadata sidecars.
+
+    Models without a sidecar (e.g. saved before the registry existed) are loaded once to describe them, if `describe_unregistered` is True.
+    Their training data and score are unknown.
+
+    Arguments
+    ---------
+    models_dir : str
+        Directory containing the models
+    describe_unregistered : bool
+        Whether to write sidecars for models without one
+
+    Returns
+    -------
+    index : dict
+        Metadata per model, keyed by the file name of the model
+    """
+    #locked while the sidecars are read, so that models saved meanwhile are not left out
+    with _locked_index(models_dir):
+        index = {}
+        for filename in sorted(os.listdir(models_dir)):
+            model_filepath = os.path.join(models_dir, filename)
+            #normalisers and compiled models are saved next to their models, but are not models themselves
+            if(not filename.endswith(".joblib") or filename.endswith(("_normaliser.joblib", "_compiled.joblib"))):
+                continue
+            if(os.path.isfile(metadata_filepath(model_filepath))):
+                with open(metadata_filepath(model_filepath)) as metadata_file:
+                    index[filename] = json.load(metadata_file)
+            elif(describe_unregistered):
+                print("Describing unregistered model {}".format(filename))
+                index[filename] = model_metadata(load_model(model_filepath), model_filepath)
+                _write_json(metadata_filepath(model_filepath), index[filename])
+        _write_json(os.path.join(models_dir, index_filename), index)
+    return index
+
+def list_models(models_dir):
+    """
+    Lists the registered models of a directory, e.g. to select them with `query` or `sort_values`.
+
+    Arguments
+    ---------
+    models_dir : str
+        Directory containing the models
+
+    Returns
+    -------
+    models : pd.DataFrame
+        One row per model: file name, classifier type, score, fit time, file size, number of features, data key and save time
+    """
+    columns = ["filename", "classifier_type", "score", "fit_time", "file_size", "n_features", "data_key", "saved"]
+    rows = []
+    for metadata in read_index(models_dir).values():
+        row = {column: metadata.get(column) for column in columns}
+        row["n_features"] = None if metadata.get("feature_names") is None else len(metadata["feature_names"])
+        rows.append(row)
+    return pd.DataFrame(rows, columns=columns)
+
+
+if(__name__ == "__main__"):
+    models_dir = "models"
+    rebuild = False #True rebuilds the index from the sidecars, describing models which do not have one yet
+
+    if(rebuild or not os.path.isfile(os.path.join(models_dir, index_filename))):
+        rebuild_index(models_dir)
+    print(list_models(models_dir).to_string(index=False))
@@ -0,0 +1,139 @@
+import numpy as np
+from matplotlib.colors import to_rgba
+
+
+def rasterize_points(x, y, extent, shape=(600, 600), classes=None, n_classes=1):
+    """
+    Counts the points falling into each pixel of an image, per class.
+
+    Arguments
+    ---------
+    x, y : array-like
+        Coordinates of the points
+    extent : list
+        [xmin, xmax, ymin, ymax] of the image; points outside are dropped
+    shape : tuple
+        Number of pixels (rows, columns) of the image
+    classes : array-like or None
+        Integer class of each point, from 0 to `n_classes` - 1. If None, all points are of class 0
+    n_classes : int
+        Number of classes
+
+    Returns
+    -------
+    counts : np.ndarray
+        Points per class and pixel, shape (n_classes, rows, columns), with the lowest y in row 0
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    xmin, xmax, ymin, ymax = extent
+    rows, columns = shape
+    column = np.floor((x - xmin) / (xmax - xmin) * columns).astype(np.int64)
+    row = np.floor((y - ymin) / (ymax - ymin) * rows).astype(np.int64)
+    #points exactly on the upper edge belong to the last pixel
+    column[x == xmax] = columns - 1
+    row[y == ymax] = rows - 1
+
+    inside = (column >= 0) & (column < columns) & (row >= 0) & (row < rows)
+    classes = np.zeros(len(x), dtype=np.int64) if classes is None else np.asarray(classes, dtype=np.int64)
+    flat = (classes[inside] * rows + row[inside]) * columns + column[inside]
+    return np.bincount(flat, minlength=n_classes * rows * columns).reshape(n_classes, rows, columns)
+
+def blend_classes(counts, colours):
+    """
+    Colours each pixel by the mix of classes in it, with an opacity increasing logarithmically with the number of points.
+
+    Arguments
+    ---------
+    counts : np.ndarray
+        Points per class and pixel, as returned by `rasterize_points`
+    colours : list
+        Matplotlib colour of each class
+
+    Returns
+    -------
+    image : np.ndarray
+        RGBA image of shape (rows, columns, 4)
+    """
+    rgb = np.array([to_rgba(colour)[:3] for colour in colours])
+    total = counts.sum(axis=0)
+    image = np.zeros(total.shape + (4,))
+    image[..., :3] = np.einsum("crw,ck->rwk", counts, rgb) / np.maximum(total, 1)[..., None]
+    #a single point stays visible, the densest pixel is opaque
+    image[..., 3] = np.where(total > 0, 0.25 + 0.75 * np.log1p(total) / np.log1p(max(total.max(), 1)), 0)
+    return image
+
+def decimate(n_points, max_points, random_state=None):
+    """
+    Picks a uniform random subset of points, which preserves their density up to a constant factor.
+
+    Arguments
+    ---------
+    n_points : int
+        Number of points
+    max_points : int
+        Maximum number of points to keep
+    random_state : int, np.random.Generator or None
+        Seed for the selection
+
+    Returns
+    -------
+    positions : np.ndarray
+        Sorted positions of the kept points
+    """
+    if(n_points <= max_points):
+        return np.arange(n_points)
+    return np.sort(np.random.default_rng(random_state).choice(n_points, max_points, replace=False))
+
+def draw_points(ax, groups, render_mode="scatter", shape=(600, 600), max_points=100000, random_state=0, **scatter_kwargs):
+    """
+    Draws one or more groups of points on an axis, as a scatter plot or as a rasterized image.
+
+    Arguments
+    ---------
+    ax : matplotlib.axes.Axes
+        Axis to draw on
+    groups : list of tuple
+        (x, y, colour, label) per group of points; label may be None
+    render_mode : str
+        "scatter" draws every point with `ax.scatter`.
+        "raster" counts the points per pixel and class and shows the blended image with `ax.imshow`; the cost depends on the pixel count, not the number of points.
+        "decimate" draws a scatter plot of a uniform random subset of at most `max_points` points, taking the same fraction of every group
+    shape : tuple
+        Number of pixels (rows, columns) for "raster"
+    max_points : int
+        Maximum total number of points for "decimate"
+    random_state : int or None
+        Seed for "decimate"
+    **scatter_kwargs
+        Passed to `ax.scatter`, e.g. marker and s
+    """
+    if(render_mode == "raster"):
+        xs = [np.asarray(x, dtype=float) for x, y, colour, label in groups]
+        ys = [np.asarray(y, dtype=float) for x, y, colour, label in groups]
+        all_x, all_y = np.concatenate(xs), np.concatenate(ys)
+        if(len(all_x) == 0):
+            return
+        extent = [all_x.min(), all_x.max(), all_y.min(), all_y.max()]
+        if(extent[0] == extent[1]):
+            extent[0:2] = [extent[0] - 0.5, extent[1] + 0.5]
+        if(extent[2] == extent[3]):
+            extent[2:4] = [extent[2] - 0.5, extent[3] + 0.5]
+        classes = np.repeat(np.arange(len(groups)), [len(x) for x in xs])
+
+        counts = rasterize_points(all_x, all_y, extent, shape, classes, len(groups))
+        ax.imshow(blend_classes(counts, [colour for x, y, colour, label in groups]), origin="lower", extent=extent, aspect="auto", interpolation="nearest")
+        #empty scatter plots, so that a legend of the axis shows the classes
+        for x, y, colour, label in groups:
+            ax.scatter([], [], c=colour, label=label, marker="s")
+
+    elif(render_mode in ("scatter", "decimate")):
+        total = sum(len(x) for x, y, colour, label in groups)
+        rng = np.random.default_rng(random_state)
+        for x, y, colour, label in groups:
+            if(render_mode == "decimate"):
+                keep = decimate(len(x), int(np.ceil(max_points * len(x) / max(total, 1))), rng)
+                x, y = np.asarray(x)[keep], np.asarray(y)[keep]
+            ax.scatter(x, y, c=colour, label=label, **scatter_kwargs)
+
+    else:
+        raise ValueError("Unknown render mode '{}'".format(render_mode))
@@ -0,0 +1,142 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import datetime
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: #not available on Windows
+    resource = None
+
+
+def max_rss_bytes():
+    """Returns the peak resident memory of this process so far in bytes, or None if it cannot be determined."""
+    if(resource is None):
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+def data_shape(data):
+    """Returns the number of rows and columns of a dataframe, series or array, or (None, None) for anything else."""
+    shape = getattr(data, "shape", None)
+    if(shape is None):
+        return None, None
+    return shape[0], (shape[1] if len(shape) > 1 else 1)
+
+
+class Stage:
+    """Measurements of a single stage, filled in by `RunReport.stage`."""
+
+    def __init__(self, name, parent=None):
+        self.record = {"stage": name, "parent": parent}
+
+    def output(self, data):
+        """Records the number of rows and columns of the output of the stage."""
+        self.record["rows"], self.record["columns"] = data_shape(data)
+
+    def note(self, **values):
+        """Adds other values to the record of the stage, e.g. whether it was read from the cache."""
+        self.record.update(values)
+
+
+class RunReport:
+    """
+    Measures the stages of a run and writes them to a JSON report.
+
+    Each stage records its wall time, CPU time of this process (not of worker processes), peak resident memory of the
+    process so far, and optionally the peak memory traced by tracemalloc during the stage, which covers numpy and pandas
+    allocations but not memory allocated by compiled libraries such as libsvm. Stages may be nested.
+
+    Arguments
+    ---------
+    trace_memory : bool
+        Whether to trace the peak memory of each stage with tracemalloc, which slows down allocation-heavy code
+    settings : dict or None
+        Settings of the run, included in the report
+    """
+
+    def __init__(self, trace_memory=False, settings=None):
+        self.trace_memory = trace_memory
+        self.settings = {} if settings is None else settings
+        self.stages = []
+        self.started = datetime.datetime.now().isoformat(timespec="seconds")
+        self._start = time.perf_counter()
+        #peak traced memory of each open stage, as tracemalloc only keeps a single peak
+        self._open_peaks = []
+        self._open_names = []
+
+    @contextmanager
+    def stage(self, name, profile_filepath=None):
+        """
+        Measures the code within the `with` block as a stage.
+
+        Arguments
+        ---------
+        name : str
+            Name of the stage
+        profile_filepath : str or None
+            If given, the stage is also run under cProfile, and the statistics are saved to this file
+            (readable with `pstats` or snakeviz) and the slowest functions are printed
+
+        Yields
+        ------
+        stage : Stage
+            Used to record the output shape and other values of the stage
+        """
+        stage = Stage(name, self._open_names[-1] if self._open_names else None)
+        if(self.trace_memory):
+            if(not tracemalloc.is_tracing()):
+                tracemalloc.start()
+            current, peak = tracemalloc.get_traced_memory()
+            if(self._open_peaks):
+                self._open_peaks[-1] = max(self._open_peaks[-1], peak)
+            tracemalloc.reset_peak()
+            stage.record["start_traced_bytes"] = current
+            self._open_peaks.append(current)
+        self._open_names.append(name)
+
+        profiler = cProfile.Profile() if profile_filepath is not None else None
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            if(profiler is not None):
+                profiler.enable()
+            yield stage
+        finally:
+            if(profiler is not None):
+                profiler.disable()
+            stage.record["wall_time"] = time.perf_counter() - wall_start
+            stage.record["cpu_time"] = time.process_time() - cpu_start
+            stage.record["max_rss_bytes"] = max_rss_bytes()
+            self._open_names.pop()
+            if(self.trace_memory):
+                peak = max(self._open_peaks.pop(), tracemalloc.get_traced_memory()[1])
+                stage.record["peak_traced_bytes"] = peak
+                #the peak of this stage is also a peak of the enclosing stage
+                if(self._open_peaks):
+                    self._open_peaks[-1] = max(self._open_peaks[-1], peak)
+            self.stages.append(stage.record)
+
+            if(profiler is not None):
+                os.makedirs(os.path.dirname(os.path.abspath(profile_filepath)), exist_ok=True)
+                profiler.dump_stats(profile_filepath)
+                stage.record["profile"] = profile_filepath
+                pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+
+            print("[{}] {:.2f} s wall, {:.2f} s CPU".format(name, stage.record["wall_time"], stage.record["cpu_time"]))
+
+    def to_dict(self):
+        """Returns the report as a dictionary."""
+        return {"started": self.started, "total_wall_time": time.perf_counter() - self._start,
+                "settings": self.settings, "stages": self.stages}
+
+    def save(self, filepath):
+        """Writes the report to a JSON file."""
+        os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+        with open(filepath, "w") as report_file:
+            json.dump(self.to_dict(), report_file, indent=1, default=str)
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+
+def downcast_integers(series):
+    """
+    Converts a column of whole numbers to the smallest integer type holding all of its values.
+
+    Columns with missing or non-integer values are returned unchanged.
+
+    Arguments
+    ---------
+    series : pd.Series
+        Column to be converted
+
+    Returns
+    -------
+    series : pd.Series
+        Converted column
+    """
+    values = series.to_numpy()
+    if(len(values) == 0 or values.dtype.kind not in "iuf"):
+        return series
+    if(values.dtype.kind == "f" and not (np.isfinite(values).all() and np.array_equal(values, np.round(values)))):
+        return series
+
+    minimum, maximum = values.min(), values.max()
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        if(np.iinfo(dtype).min <= minimum and maximum <= np.iinfo(dtype).max):
+            return series.astype(dtype)
+    return series
+
+def compact_dtypes(dataframe, integer_columns=(), float32=False):
+    """
+    Stores the columns of a dataframe in compact types.
+
+    Columns in `integer_columns` are downcast to the smallest integer type (if they have no missing values),
+    and the remaining floating point columns are optionally stored as float32, which halves their memory.
+
+    Arguments
+    ---------
+    dataframe : pd.Dataframe
+        Dataframe to be converted; it is not modified
+    integer_columns : iterable
+        Names of columns holding whole numbers, e.g. hit counts. Columns not in the dataframe are ignored
+    float32 : bool
+        Whether to store the other floating point columns as float32
+
+    Returns
+    -------
+    dataframe : pd.Dataframe
+        Dataframe with the converted columns
+    """
+    columns = {}
+    for column in dataframe.columns:
+        if(column in integer_columns):
+            series = downcast_integers(dataframe[column])
+            if(series.dtype != dataframe[column].dtype):
+                columns[column] = series
+                continue
+        if(float32 and dataframe[column].dtype == np.float64):
+            columns[column] = dataframe[column].astype(np.float32)
+    if(not columns):
+        return dataframe
+    return dataframe.assign(**columns)
+
+def memory_usage(dataframe):
+    """Returns the memory used by a dataframe in bytes, including its index and the contents of string columns."""
+    return int(dataframe.memory_usage(index=True, deep=True).sum())
+
+def format_bytes(n_bytes):
+    """Formats a number of bytes for printing, e.g. 1.5 GiB."""
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if(abs(n_bytes) < 1024):
+            return "{:.1f} {}".format(n_bytes, unit)
+        n_bytes /= 1024
+    return "{:.1f} TiB".format(n_bytes)
+
+def memory_report(dataframe):
+    """
+    Lists the type and memory of each column of a dataframe.
+
+    Arguments
+    ---------
+    dataframe : pd.Dataframe
+        Dataframe to be analysed
+
+    Returns
+    -------
+    report : pd.Dataframe
+        Type and memory (bytes) per column, largest first
+    """
+    usage = dataframe.memory_usage(index=False, deep=True)
+    report = pd.DataFrame({"Type": dataframe.dtypes.astype(str), "Memory (bytes)": usage})
+    return report.sort_values("Memory (bytes)", ascending=False)
+
+def print_memory(stage, dataframe):
+    """Prints the memory used by a dataframe after a processing stage."""
+    print("Memory after {}: {} ({} rows, {} columns)".format(stage, format_bytes(memory_usage(dataframe)), *dataframe.shape))
@@ -0,0 +1,152 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor
+from joblib import load
+
+from normaliser import normaliser_filepath
+from registry import load_model, model_features, is_forest
+from compiled_model import compiled_filepath, load_compiled, ensure_compiled
+from utils import iter_h5_chunks, h5_row_count
+
+#model and normaliser of each worker process, loaded once by _init_worker
+_worker_state = {}
+
+
+def _init_worker(model_filepath, compiled=False):
+    #memory-mapped, so that the workers share the arrays of the model; forests are loaded as their compiled predictor,
+    #as sklearn copies the nodes of the trees into every worker
+    if(compiled):
+        _worker_state["classifier"] = load_compiled(compiled_filepath(model_filepath))
+    else:
+        _worker_state["classifier"] = load_model(model_filepath, predictor=True)
+    if(os.path.isfile(normaliser_filepath(model_filepath))):
+        _worker_state["normaliser"] = load(normaliser_filepath(model_filepath))
+
+def _empty_result(index=None):
+    #same columns and types as a scored chunk, so that an input without scorable events still gives an output file
+    result = pd.DataFrame({"Prediction": np.array([], dtype=bool), "Score": np.array([], dtype=float)},
+                          index=pd.Index([], dtype=np.int64) if index is None else index)
+    result.index.name = "Event"
+    return result
+
+def _score_chunk(chunk):
+    """
+    Scores one chunk of events in a worker process.
+
+    Events with missing feature values are dropped, as in training.
+
+    Returns
+    -------
+    result : pd.DataFrame
+        Prediction and score per event, indexed by the event number in the input file
+    """
+    classifier = _worker_state["classifier"]
+    chunk = chunk[list(classifier.feature_names_in_)].dropna()
+    if("normaliser" in _worker_state):
+        chunk = _worker_state["normaliser"].transform(chunk)
+
+    if(len(chunk) == 0):
+        return _empty_result(chunk.index)
+
+    result = pd.DataFrame(index=chunk.index)
+    result.index.name = "Event"
+
+    result["Prediction"] = classifier.predict(chunk)
+    if(hasattr(classifier, "decision_function")):
+        result["Score"] = classifier.decision_function(chunk)
+    else:
+        result["Score"] = classifier.predict_proba(chunk)[:, 1]
+    return result
+
+def score_file(model_filepath, input_filepath, output_filepath, chunksize=100000, n_jobs=None, max_pending=None, compiled=False):
+    """
+    Applies a trained model to an HDF file in chunks and writes the predictions and scores to a parquet file.
+
+    Uses the same column selection and renaming as in training, and the normaliser saved next to the model if present.
+    At most `max_pending` chunks are in memory at once, so memory use does not depend on the size of the input.
+
+    Arguments
+    ---------
+    model_filepath : str
+        Path to the .joblib file of the model
+    input_filepath : str
+        Path to the HDF file containing the events to be scored
+    output_filepath : str
+        Path to the parquet file the predictions and scores are written to
+    chunksize : int
+        Number of events read and scored at once
+    n_jobs : int or None
+        Number of worker processes. If None, one per CPU
+    max_pending : int or None
+        Maximum number of chunks being scored at once. If None, twice the number of workers
+    compiled : bool
+        Whether to score with the compiled version of the model (see `compiled_model.py`), which is compiled first if
+        it does not exist yet or is older than the model. Faster for linear models and for small chunks.
+        Forests are always scored with their compiled version, so that the workers share its memory
+
+    Returns
+    -------
+    events_per_second : float
+        Throughput of the scored events (without those dropped for missing values), including reading and writing
+    """
+    n_jobs = n_jobs or os.cpu_count()
+    max_pending = max_pending or 2 * n_jobs
+    features = model_features(model_filepath)
+    if(not os.path.isfile(normaliser_filepath(model_filepath))):
+        print("Warning: no normaliser found at {}, features are scored without normalisation".format(normaliser_filepath(model_filepath)))
+    n_rows = h5_row_count(input_filepath)
+    #compiled here if needed, so that the workers do not all compile the forest at once
+    if(compiled or is_forest(model_filepath)):
+        ensure_compiled(model_filepath)
+
+    start_time = time.perf_counter()
+    n_scored = 0
+    writer = None
+    pending = []
+
+    def write_oldest():
+        nonlocal writer, n_scored
+        result = pending.pop(0).result()
+        table = pa.Table.from_pandas(result)
+        if(writer is None):
+            writer = pq.ParquetWriter(output_filepath, table.schema)
+        writer.write_table(table)
+        n_scored += len(result)
+        print("Scored {}/{} events ({:.0f} events/s)".format(n_scored, n_rows, n_scored / (time.perf_counter() - start_time)), end="\r")
+
+    with ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=(model_filepath, compiled)) as executor:
+        for chunk in iter_h5_chunks(input_filepath, features, chunksize):
+            if(len(pending) >= max_pending):
+                write_oldest()
+            pending.append(executor.submit(_score_chunk, chunk))
+        while(pending):
+            write_oldest()
+
+    if(writer is None):
+        #no chunks were read, e.g. from an empty input file, so an empty file with the same columns is written
+        writer = pq.ParquetWriter(output_filepath, pa.Table.from_pandas(_empty_result()).schema)
+    writer.close()
+
+    events_per_second = n_scored / (time.perf_counter() - start_time)
+    print()
+    print("Scored {} events at {:.0f} events/s, written to {}".format(n_scored, events_per_second, output_filepath))
+    return events_per_second
+
+
+if(__name__ == "__main__"):
+    model_filename = "m9.joblib"
+    model_filepath = os.path.join("models", model_filename)
+
+    input_filename = "new_neutrino11x.h5"
+    input_filepath = os.path.join("data", input_filename)
+    output_filepath = os.path.join("data", os.path.splitext(input_filename)[0] + "_" + os.path.splitext(model_filename)[0] + "_scores.parquet")
+
+    chunksize = 100000
+    n_jobs = None
+    compiled = False #True scores with the compiled model, see compiled_model.py
+
+    score_file(model_filepath, input_filepath, output_filepath, chunksize=chunksize, n_jobs=n_jobs, compiled=compiled)
@@ -0,0 +1,215 @@
+import os
+import numpy as np
+from joblib import dump, load
+
+from cache import evict_cache, write_atomic
+
+
+class GridIndex:
+    """
+    Spatial index of points in a plane, bucketed into a regular grid of cells.
+
+    The points are stored sorted by cell (row-major, x then y), with the offset of the first point of every cell in `starts`,
+    so the points of a cell are x[starts[c]:starts[c + 1]]. A window covers a block of cells, which is one contiguous range
+    of points per grid column; only those ranges are read, so a query costs time proportional to the points in the covered
+    cells, i.e. the points in the window plus those in the partly covered cells along its edges.
+
+    Arguments
+    ---------
+    origin : tuple
+        Lower x and y edge of the grid
+    cell_size : tuple
+        Width and height of a cell
+    shape : tuple
+        Number of cells along x and y
+    starts : np.ndarray
+        Offset of the first point of each cell in the sorted arrays, followed by the number of points
+    rows : np.ndarray
+        Position of each sorted point in the data the index was built on
+    x, y : np.ndarray
+        Coordinates of the sorted points
+    """
+
+    def __init__(self, origin, cell_size, shape, starts, rows, x, y):
+        self.origin = tuple(float(value) for value in origin)
+        self.cell_size = tuple(float(value) for value in cell_size)
+        self.shape = tuple(int(value) for value in shape)
+        self.starts = starts
+        self.rows = rows
+        self.x = x
+        self.y = y
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def nbytes(self):
+        """Memory used by the arrays of the index in bytes."""
+        return sum(array.nbytes for array in [self.starts, self.rows, self.x, self.y])
+
+    def _cell_range(self, low, high, axis):
+        #cells overlapping [low, high] along one axis, or None if the range misses the grid
+        first = int(np.floor((low - self.origin[axis]) / self.cell_size[axis]))
+        last = int(np.floor((high - self.origin[axis]) / self.cell_size[axis]))
+        if(last < 0 or first >= self.shape[axis] or high < low):
+            return None
+        return max(first, 0), min(last, self.shape[axis] - 1)
+
+    def _select(self, xmin, xmax, ymin, ymax):
+        #positions in the sorted arrays of the points inside the window
+        x_cells, y_cells = self._cell_range(xmin, xmax, 0), self._cell_range(ymin, ymax, 1)
+        if(x_cells is None or y_cells is None):
+            return np.empty(0, dtype=np.int64)
+
+        #one contiguous range of sorted points per grid column
+        first_cells = np.arange(x_cells[0], x_cells[1] + 1) * self.shape[1] + y_cells[0]
+        lows = np.asarray(self.starts[first_cells])
+        highs = np.asarray(self.starts[first_cells + y_cells[1] - y_cells[0] + 1])
+        ranges = [(low, high) for low, high in zip(lows, highs) if high > low]
+        if(not ranges):
+            return np.empty(0, dtype=np.int64)
+
+        #slices are copied contiguously, which is faster than gathering the points one by one
+        candidates = np.concatenate([np.arange(low, high) for low, high in ranges])
+        x = np.concatenate([self.x[low:high] for low, high in ranges])
+        y = np.concatenate([self.y[low:high] for low, high in ranges])
+        return candidates[(x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)]
+
+    def query(self, xmin, xmax, ymin, ymax, sample_size=None, random_state=None):
+        """
+        Finds the points inside a window (edges included).
+
+        Arguments
+        ---------
+        xmin, xmax, ymin, ymax : floats
+            Window
+        sample_size : int or None
+            If given, returns a uniform random sample of this many of the points in the window (all of them if there are fewer)
+        random_state : int, np.random.Generator or None
+            Seed of the sample
+
+        Returns
+        -------
+        rows : np.ndarray
+            Positions of the points in the data the index was built on, e.g. for `dataframe.iloc`
+        """
+        selected = uniform_sample(self._select(xmin, xmax, ymin, ymax), sample_size, random_state)
+        return np.asarray(self.rows[selected])
+
+    def points(self, xmin, xmax, ymin, ymax, sample_size=None, random_state=None):
+        """
+        Returns the coordinates of the points inside a window, or of a uniform random sample of them, see `query`.
+
+        Returns
+        -------
+        x, y : np.ndarray
+            Coordinates of the points
+        """
+        selected = uniform_sample(self._select(xmin, xmax, ymin, ymax), sample_size, random_state)
+        return np.asarray(self.x[selected]), np.asarray(self.y[selected])
+
+    def count(self, xmin, xmax, ymin, ymax):
+        """Returns the number of points inside a window."""
+        return len(self._select(xmin, xmax, ymin, ymax))
+
+
+def uniform_sample(positions, sample_size=None, random_state=None):
+    """
+    Draws a uniform random sample without replacement, keeping the original order.
+
+    Arguments
+    ---------
+    positions : np.ndarray
+        Positions to sample from
+    sample_size : int or None
+        Size of the sample. If None, or at least the number of positions, all positions are returned
+    random_state : int, np.random.Generator or None
+        Seed of the sample
+
+    Returns
+    -------
+    positions : np.ndarray
+        Sampled positions
+    """
+    if(sample_size is None or sample_size >= len(positions)):
+        return positions
+    chosen = np.random.default_rng(random_state).choice(len(positions), sample_size, replace=False)
+    return positions[np.sort(chosen)]
+
+def build_index(x, y, points_per_cell=64):
+    """
+    Builds a `GridIndex` over points, with the grid spanning their bounding box and about `points_per_cell` points per cell on average.
+
+    Points with a missing coordinate are left out.
+
+    Arguments
+    ---------
+    x, y : array-like
+        Coordinates of the points
+    points_per_cell : int
+        Average number of points per cell; smaller cells make queries read fewer points outside the window,
+        at the cost of a larger `starts` array
+
+    Returns
+    -------
+    index : GridIndex
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    rows = np.flatnonzero(~(np.isnan(x) | np.isnan(y)))
+    x, y = x[rows], y[rows]
+    if(len(rows) == 0):
+        return GridIndex((0, 0), (1, 1), (1, 1), np.zeros(2, dtype=np.int64), rows, x, y)
+
+    origin = np.array([x.min(), y.min()], dtype=float)
+    extent = np.array([x.max(), y.max()], dtype=float) - origin
+    #square-ish cells: the number of cells per axis follows the aspect ratio of the bounding box
+    n_cells = max(len(rows) / points_per_cell, 1)
+    if(extent[0] > 0 and extent[1] > 0):
+        shape = np.clip(np.round(np.sqrt(n_cells * extent / extent[::-1])), 1, np.ceil(n_cells)).astype(np.int64)
+    else:
+        shape = np.where(extent > 0, int(np.ceil(n_cells)), 1).astype(np.int64)
+    cell_size = np.where(extent > 0, extent / shape, 1)
+
+    x_cells = np.minimum(((x - origin[0]) / cell_size[0]).astype(np.int64), shape[0] - 1)
+    y_cells = np.minimum(((y - origin[1]) / cell_size[1]).astype(np.int64), shape[1] - 1)
+    cells = x_cells * shape[1] + y_cells
+    order = np.argsort(cells, kind="stable")
+    starts = np.concatenate(([0], np.cumsum(np.bincount(cells, minlength=shape[0] * shape[1])))).astype(np.int64)
+
+    return GridIndex(origin, cell_size, shape, starts, rows[order].astype(np.int64), x[order], y[order])
+
+def cached_index(cache_dir, key, compute, max_bytes=None):
+    """
+    Returns a spatial index, building and saving it only if it is not saved yet.
+
+    Indexes are saved uncompressed as `index-<key>.joblib` in `cache_dir` and loaded with their arrays memory-mapped,
+    so opening a saved index does not read the points until they are queried. They share the size limit of the cached
+    stages in the same directory (see `cache.evict_cache`), and opening one marks it as recently used.
+
+    Arguments
+    ---------
+    cache_dir : str
+        Directory containing the saved indexes
+    key : str
+        Key of the indexed data, see `cache.stage_key`
+    compute : callable
+        Function without arguments which builds the index if it is not saved yet, e.g. with `build_index`
+    max_bytes : int or None
+        Maximum total size of the cache in bytes. If None, nothing is evicted
+
+    Returns
+    -------
+    index : GridIndex
+    """
+    filepath = os.path.join(cache_dir, "index-{}.joblib".format(key))
+    if(os.path.isfile(filepath)):
+        print("Using saved spatial index ({})".format(key))
+        os.utime(filepath)
+        return load(filepath, mmap_mode="r")
+
+    index = compute()
+    os.makedirs(cache_dir, exist_ok=True)
+    write_atomic(filepath, lambda temporary_filepath: dump(index, temporary_filepath))
+    if(max_bytes is not None):
+        evict_cache(cache_dir, max_bytes)
+    return index
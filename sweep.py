@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import pickle
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sklearn.model_selection import ParameterGrid, ParameterSampler
+from sklearn.svm import LinearSVC, SVC
+from sklearn.ensemble import RandomForestClassifier
+
+from cache import stage_key
+
+classifiers = {
+    "LinearSVC": LinearSVC,
+    "SVC": SVC,
+    "RandomForestClassifier": RandomForestClassifier
+}
+
+array_names = ["X_train", "X_valid", "y_train", "y_valid"]
+
+#memory-mapped training and validation arrays of each worker process, loaded once by _init_worker
+_worker_arrays = {}
+
+
+def sweep_trials(search_space, n_iter=None, random_state=None):
+    """
+    Lists the parameter combinations of a sweep.
+
+    Arguments
+    ---------
+    search_space : list of dict
+        One dictionary per classifier type, mapping "classifier" and the classifier parameters to lists of values
+        (or to distributions with an `rvs` method for random search)
+    n_iter : int or None
+        If None, every combination is tried (grid search). Otherwise, `n_iter` random combinations are drawn
+    random_state : int or None
+        Seed for random search
+
+    Returns
+    -------
+    trials : list of dict
+        Parameters of each trial, including the classifier type
+    """
+    if(n_iter is None):
+        return list(ParameterGrid(search_space))
+    return list(ParameterSampler(search_space, n_iter, random_state=random_state))
+
+def seeded_trial(params, random_state):
+    """Adds `random_state` to the parameters of a trial if its classifier accepts one and the trial does not set it."""
+    accepts_seed = "random_state" in classifiers[params["classifier"]]().get_params()
+    if(accepts_seed and "random_state" not in params):
+        params = dict(params, random_state=random_state)
+    return params
+
+def trial_id(params, data_key):
+    """Identifies a trial by its parameters and the data it is trained on."""
+    return stage_key(sorted(params.items()), data_key)
+
+def write_arrays(sweep_dir, X_train, X_valid, y_train, y_valid):
+    """
+    Saves the training and validation sets as .npy files, so that worker processes can memory-map them instead of each holding a copy.
+
+    Arguments
+    ---------
+    sweep_dir : str
+        Directory of the sweep
+    X_train, X_valid, y_train, y_valid : pd.DataFrame, pd.Series
+        Training and validation sets
+
+    Returns
+    -------
+    data_key : str
+        Key identifying the data, used to recognise finished trials when resuming
+    """
+    os.makedirs(sweep_dir, exist_ok=True)
+    arrays = [np.ascontiguousarray(data.to_numpy()) for data in (X_train, X_valid, y_train, y_valid)]
+    for name, array in zip(array_names, arrays):
+        np.save(os.path.join(sweep_dir, name + ".npy"), array)
+    return stage_key(*[array.shape for array in arrays], *[pd.util.hash_array(array.ravel()).sum() for array in arrays])
+
+def _init_worker(sweep_dir):
+    for name in array_names:
+        _worker_arrays[name] = np.load(os.path.join(sweep_dir, name + ".npy"), mmap_mode="r")
+
+def _run_trial(params):
+    params = dict(params)
+    classifier = classifiers[params.pop("classifier")](**params)
+
+    start = time.perf_counter()
+    classifier.fit(_worker_arrays["X_train"], _worker_arrays["y_train"])
+    fit_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    score = classifier.score(_worker_arrays["X_valid"], _worker_arrays["y_valid"])
+    predict_time = time.perf_counter() - start
+
+    return {"score": score, "fit_time": fit_time, "predict_time": predict_time, "model_size": len(pickle.dumps(classifier))}
+
+def read_ledger(ledger_filepath):
+    """
+    Reads the results of all finished trials.
+
+    Arguments
+    ---------
+    ledger_filepath : str
+        Path to the ledger, a file with one JSON record per line
+
+    Returns
+    -------
+    results : pd.DataFrame
+        One row per finished trial: its parameters, score, fit time, predict time and model size (bytes)
+    """
+    if(not os.path.isfile(ledger_filepath)):
+        return pd.DataFrame()
+    with open(ledger_filepath) as ledger:
+        records = [json.loads(line) for line in ledger if line.strip()]
+    return pd.json_normalize(records)
+
+def run_sweep(sweep_dir, trials, data_key, n_jobs=None, random_state=0):
+    """
+    Runs the trials of a sweep in a process pool and appends each result to the ledger as soon as it finishes.
+
+    Trials which are already in the ledger for the same data are skipped, so an interrupted sweep can be resumed by running it again.
+    Classifiers which accept a seed get `random_state`, which is part of the parameters of the trial, so that the
+    scores in the ledger can be reproduced and a resumed sweep compares trials with the same seeds.
+
+    Arguments
+    ---------
+    sweep_dir : str
+        Directory of the sweep, containing the arrays written by `write_arrays` and the ledger "ledger.jsonl"
+    trials : list of dict
+        Parameters of each trial, see `sweep_trials`
+    data_key : str
+        Key of the data, as returned by `write_arrays`
+    n_jobs : int or None
+        Number of worker processes. If None, one per CPU
+    random_state : int
+        Seed of the classifiers of trials which do not set one
+
+    Returns
+    -------
+    results : pd.DataFrame
+        The results of the requested trials, sorted by score
+    """
+    trials = [seeded_trial(params, random_state) for params in trials]
+    ledger_filepath = os.path.join(sweep_dir, "ledger.jsonl")
+    finished = read_ledger(ledger_filepath)
+    finished_ids = set(finished["id"]) if len(finished) > 0 else set()
+    todo = [params for params in trials if trial_id(params, data_key) not in finished_ids]
+    print("{} of {} trials finished, running {}".format(len(trials) - len(todo), len(trials), len(todo)))
+
+    with ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=(sweep_dir,)) as executor:
+        futures = {executor.submit(_run_trial, params): params for params in todo}
+        for future in as_completed(futures):
+            params = futures[future]
+            record = {"id": trial_id(params, data_key), "data": data_key, "params": params}
+            record.update(future.result())
+            with open(ledger_filepath, "a") as ledger:
+                ledger.write(json.dumps(record, default=str) + "\n")
+            print("Score {:.4f} in {:.1f} s: {}".format(record["score"], record["fit_time"], params))
+
+    results = read_ledger(ledger_filepath)
+    if(len(results) == 0):
+        return results
+    #the ledger also holds other trials and data of the sweep, which are not returned
+    results = results[results["id"].isin([trial_id(params, data_key) for params in trials])]
+    return results.sort_values("score", ascending=False)
+
+
+if(__name__ == "__main__"):
+    from train import preprocessed_dataframe, used_columns, excluded_columns, equalised_columns, n_quantiles
+    from utils import train_test_balanced
+    from normaliser import QuantileNormaliser
+
+    sweep_dir = os.path.join("models", "sweep")
+    n_jobs = None
+
+    #grid search over every combination; set n_iter to draw that many random combinations instead
+    search_space = [
+        {"classifier": ["LinearSVC"], "dual": ["auto"], "C": [0.1, 1, 10]},
+        {"classifier": ["SVC"], "kernel": ["linear", "poly", "rbf"], "C": [0.1, 1, 10]},
+        {"classifier": ["RandomForestClassifier"], "n_estimators": [50, 100, 200], "max_depth": [None, 10, 20]}
+    ]
+    n_iter = None
+    random_state = None #seed for drawing random combinations
+    trial_seed = 0 #seed of the classifiers
+
+    #fixed, so that an interrupted sweep resumes on the same training/validation split
+    split_seed = 0
+
+    dataframe = preprocessed_dataframe()
+    train_columns = [x for x in used_columns if x not in excluded_columns]
+    X_train, X_valid, y_train, y_valid = train_test_balanced(dataframe, equalised_columns, train_columns, random_state=split_seed)
+    normaliser = QuantileNormaliser(n_quantiles=n_quantiles).fit(X_train)
+    data_key = write_arrays(sweep_dir, normaliser.transform(X_train), normaliser.transform(X_valid), y_train, y_valid)
+
+    results = run_sweep(sweep_dir, sweep_trials(search_space, n_iter, random_state), data_key, n_jobs, trial_seed)
+    print(results.to_string(index=False))
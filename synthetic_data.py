@@ -0,0 +1,116 @@
+import os
+import numpy as np
+import pandas as pd
+
+from utils import used_columns, raw_column_names, pdgid_dict
+
+
+def generate_events(n_events, random_state=None, missing_fraction=1e-3):
+    """
+    Generates synthetic events with the raw column names of the KM3NeT simulation files.
+
+    The values roughly follow the real distributions (detector positions, unit direction vectors, integer hit counts,
+    likelihood ranges), and track events (CC (anti) muon neutrino interactions) get longer tracks, more hits and
+    larger track likelihoods, so that classifiers have something to learn. Not suitable for physics, only for testing and benchmarking.
+
+    Arguments
+    ---------
+    n_events : int
+        Number of events
+    random_state : int or None
+        Seed of the generator
+    missing_fraction : float
+        Fraction of track lengths set to NaN, to exercise the removal of missing values
+
+    Returns
+    -------
+    dataframe : pd.DataFrame
+        Events with raw (not renamed) column names
+    """
+    rng = np.random.default_rng(random_state)
+    columns = {}
+
+    pdgid = rng.choice(list(pdgid_dict), n_events)
+    is_cc = rng.choice([0.0, 1.0], n_events, p=[0.3, 0.7])
+    is_track = (np.abs(pdgid) == 14) & (is_cc == 1.0)
+    columns["pdgid"] = pdgid
+    columns["is_cc"] = is_cc
+    columns["energy"] = 10**rng.uniform(2, 7, n_events)
+    columns["T.sum_mc_nu.by"] = rng.uniform(0, 1, n_events)
+
+    for track in (0, 1):
+        direction = rng.normal(size=(3, n_events))
+        direction /= np.linalg.norm(direction, axis=0)
+        for axis, coordinate in enumerate("xyz"):
+            columns["E.trks.dir.{}[:,{}]".format(coordinate, track)] = direction[axis]
+        columns["E.trks.pos.x[:,{}]".format(track)] = rng.normal(450, 60, n_events)
+        columns["E.trks.pos.y[:,{}]".format(track)] = rng.normal(575, 50, n_events)
+        columns["E.trks.pos.z[:,{}]".format(track)] = rng.uniform(0, 700, n_events)
+
+    columns["E.trks.len[:,0]"] = rng.exponential(np.where(is_track, 400, 100))
+    columns["E.trks.lik[:,0]"] = rng.gamma(2, np.where(is_track, 500, 250))
+    columns["E.trks.lik[:,1]"] = -rng.gamma(2, np.where(is_track, 250, 400))
+    columns["angle_shfit_gandalf"] = rng.uniform(0, np.pi, n_events)
+    columns["distance_shfit_gandalf"] = rng.exponential(np.where(is_track, 80, 30))
+    columns["dt_shfit_gandalf"] = rng.normal(0, 50, n_events)
+
+    #integer hit counts, more for tracks
+    hits = rng.poisson(np.where(is_track, 60, 35)[None, :] * rng.uniform(0.5, 1.5, (10, 1)), (10, n_events)).astype(float)
+    hit_columns = ["crkv_nhits100[:,0,0]", "crkv_nhits100[:,0,2]", "crkv_nhits100[:,1,2]", "crkv_nhits50[:,0,0]",
+                   "T.feat_Neutrino2020.cherCond_n_doms", "T.feat_Neutrino2020.gandalf_nHits", "T.feat_Neutrino2020.n_hits_earlyTrig",
+                   "T.sum_hits.ndoms", "T.sum_jppshower.n_selected_hits"]
+    for column, values in zip(hit_columns, hits):
+        columns[column] = values
+
+    #any remaining column of used_columns gets a continuous value
+    for column in raw_column_names(used_columns):
+        if(column not in columns):
+            columns[column] = rng.normal(np.where(is_track, 0.5, 0), 1)
+
+    dataframe = pd.DataFrame(columns)
+    dataframe.loc[rng.random(n_events) < missing_fraction, "E.trks.len[:,0]"] = np.nan
+    return dataframe
+
+def write_synthetic_files(directory, n_events, n_files=3, file_format="fixed", random_state=None, prefix="synthetic_neutrino"):
+    """
+    Writes synthetic events to HDF files which can be used in place of the real data files.
+
+    Arguments
+    ---------
+    directory : str
+        Directory the files are written to
+    n_events : int
+        Total number of events, divided evenly over the files
+    n_files : int
+        Number of files
+    file_format : str
+        HDF format, "fixed" or "table"
+    random_state : int or None
+        Seed of the generator
+    prefix : str
+        Start of the file names, followed by the file number
+
+    Returns
+    -------
+    filepaths : list
+        Paths to the written files
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(random_state)
+    filepaths = []
+    for index, n_file_events in enumerate(np.diff(np.linspace(0, n_events, n_files + 1).astype(int))):
+        filepath = os.path.join(directory, "{}{}x.h5".format(prefix, 11 + index))
+        generate_events(n_file_events, random_state=rng).to_hdf(filepath, key="df", mode="w", format=file_format)
+        filepaths.append(filepath)
+    return filepaths
+
+
+if(__name__ == "__main__"):
+    directory = "data"
+    n_events = 300000
+    n_files = 3
+    file_format = "fixed"
+    random_state = 0
+
+    for filepath in write_synthetic_files(directory, n_events, n_files, file_format, random_state):
+        print("Written {}".format(filepath))
@@ -1,87 +1,443 @@
 import os
+import json
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
 
 from sklearn.model_selection import train_test_split
 from sklearn.svm import LinearSVC, SVC
 from sklearn.ensemble import RandomForestClassifier
-from utils import load_from_h5, used_columns, normalise_dataframe, equal_entries_df, train_test_balanced
-from joblib import dump
+from utils import load_from_h5, used_columns, equal_entries_df, train_test_balanced, rename_dict, label_columns, integer_columns
+from schema import compact_dtypes, print_memory
+from run_report import RunReport
+from ingest import ingest, group_counts, select_groups, balanced_quotas, load_balanced, balanced_normaliser, iter_balanced_split
+from cache import file_fingerprint, stage_key, cached_stage, is_cached
+from normaliser import QuantileNormaliser, normaliser_filepath
+from approximate_kernel import make_feature_map, fit_approximate, array_chunks, compare_with_exact
+from registry import save_model
+from evaluation import slice_columns, classifier_scores, save_validation_scores, validation_scores_filepath
+from features import base_columns, feature_order, feature_key, add_derived_features
 
 
+#files in the "data" subfolder
 filenames = ["new_neutrino11x.h5", "new_neutrino12x.h5", "new_neutrino13x.h5"]
-filepaths = [os.path.join("data", filename) for filename in filenames]
 
-parquet_filepath = os.path.join("data", "neutrino_processed.parquet")
+#preprocessed stages are cached here, keyed by the input files and the preprocessing settings
+cache_dir = os.path.join("data", "cache")
+cache_max_bytes = 20 * 1024**3
+hash_input_files = False #True hashes the file contents instead of using size and modification time
 
-excluded_columns = ["Is shower?", "Particle name", "Inelasticity", "is_cc"]
+excluded_columns = ["Is shower?", "Particle name", "Inelasticity", "energy", "is_cc"]
 
+#rows are filtered while the files are read, so that only the selected events are ever held in memory
+#e.g. [("energy", ">", 1000)] for a minimal energy; rows with missing values are always dropped
+load_filters = []
+load_chunksize = 1000000
+
+#if set (e.g. os.path.join("data", "processed")), each data file is ingested once into this store, partitioned by the groups of
+#equalised_columns, along with its group counts and quantile sketches, and is balanced from there instead of through the cache stages
+ingested_store = None
+#with an ingested store, only the partitions of these groups are read, e.g. {"Particle name": ["Muon neutrino", "Anti muon neutrino"]}
+ingested_groups = None
+#with an ingested store, True builds the normaliser from the quantile sketches of the kept rows instead of fitting it on the training set
+sketch_normaliser = False
+
+#True stores the features as float32 instead of float64, which halves the memory of the data
+float32_features = False
+
+#file in the "models" subfolder
 model_filename = "model.joblib"
-model_filepath = os.path.join("models", model_filename)
+#the normaliser is fitted on the training set and saved next to the model, e.g. models/model_normaliser.joblib
+n_quantiles = 1000
 
 equalise_columns = True
 equalised_columns = ["Particle name", "is_cc"]
+equalised_ratios = None #e.g. {("Muon neutrino", 1.0): 2} (or [[["Muon neutrino", 1.0], 2]] in a config file) to keep twice as many CC muon neutrinos
+equalise_seed = None #None keeps the first rows of each group, an int samples them randomly
+split_seed = None #seed for the training/validation split; if None, a seed is drawn and saved with the model
+
 
+#a report of the wall time, CPU time, memory and output size of each stage is saved next to the model, e.g. models/model_report.json
+trace_memory = False #True also traces the peak memory of each stage with tracemalloc, which slows down the run
+profile_fit = False #True runs the fit under cProfile and saves the statistics next to the model, e.g. models/model_fit.prof
 
 #classifier parameters
+classifier_type = "SVC" #"LinearSVC", "SVC" or "RandomForestClassifier"
+
 ## linear SVM
 dual="auto"
 
 ## SVC
 kernel = "poly"
 
+## approximate kernel (Nystroem or random polynomial features followed by a linear SVM trained in chunks)
+#"exact" trains the classifier chosen below, "approximate" the approximate-kernel model,
+#"compare" trains both and reports accuracy and wall-clock time side by side
+training_mode = "exact"
+approximation = {"method": "nystroem", "n_components": 1000, "n_epochs": 5} #method is "nystroem" or "count_sketch"
+approximate_chunksize = 100000
+exact_max_samples = None #limits the training samples of the exact SVC when comparing
+
 ## RandomForestClassifier
 n_estimators=200
 max_depth=None
 
 
-if(not os.path.isfile(parquet_filepath)):
-    #load data
+def input_filepaths():
+    return [os.path.join("data", filename) for filename in filenames]
+
+def load_stage(report):
+    #load data; derived features are computed in the next stage, so only the columns they are computed from are loaded
     print("Loading dataframe")
-    dataframe = load_from_h5(filepaths)
-    
+    with report.stage("load") as stage:
+        dataframe = load_from_h5(input_filepaths(), columns=base_columns(used_columns), float32=float32_features, filters=load_filters, dropna=True, chunksize=load_chunksize)
+        stage.output(dataframe)
+
     #exclude data which is not used
     print("Excluding unused data")
-    dataframe = dataframe[used_columns]
-    
-    #remove rows with missing values
-    print("Removing missing values ({} now)".format(dataframe.isnull().values.sum()))
-    dataframe.dropna(inplace=True)
-    print("Missing values: {}".format(dataframe.isnull().values.sum()))
+    with report.stage("exclude columns") as stage:
+        dataframe = dataframe[base_columns(used_columns)]
+        stage.output(dataframe)
+    return dataframe
+
+def filter_stage(dataframe, report, loaded_key):
+    #compute the derived features, each cached on its own, so that trying a new feature does not reload the data
+    if(feature_order(used_columns)):
+        print("Computing derived features")
+        with report.stage("derive") as stage:
+            dataframe = add_derived_features(dataframe, used_columns, cache_dir, loaded_key, cache_max_bytes)[used_columns]
+            stage.output(dataframe)
 
+    #remove rows with missing values, which are normally already dropped while loading
+    with report.stage("dropna") as stage:
+        print("Removing missing values ({} now)".format(dataframe.isnull().values.sum()))
+        n_rows = len(dataframe)
+        dataframe = dataframe.dropna()
+        print("Removed {} rows".format(n_rows - len(dataframe)))
+        #integer columns with missing values could not be downcast before
+        dataframe = compact_dtypes(dataframe, integer_columns, float32_features)
+        stage.output(dataframe)
+    return dataframe
+
+def balance_stage(dataframe, report):
     #drop rows to get equal amounts of data from each particle type
     if equalise_columns == True:
         print('Equalizing distribution per particle')
-        dataframe = equal_entries_df(equalised_columns, dataframe, used_columns)
-
-    #normalise data
-    print("Normalising data")
-    dataframe = normalise_dataframe(dataframe, excluded_columns)
-
-    #save to parquet file
-    dataframe.to_parquet(parquet_filepath)
-else:
-    print("Loading preprocessed data")
-    dataframe = pd.read_parquet(parquet_filepath)
-
-#divide data into training/validation sets
-print("Dividing data into training and validation sets")
-train_columns = [x for x in used_columns if x not in excluded_columns]
-X_train, X_valid, y_train, y_valid = train_test_balanced(dataframe, equalised_columns, train_columns)
-#X_train, X_valid, y_train, y_valid = train_test_split(dataframe[train_columns], dataframe["Is shower?"])
-
-print("Training samples:\t{}".format(X_train.shape[0]))
-print("Validation samples:\t{}".format(X_valid.shape[0]))
-
-#train model
-print("Training model")
-#classifier = RandomForestClassifier(n_estimators, max_depth=None)
-#classifier = LinearSVC(dual=dual)
-classifier = SVC(kernel=kernel)
-classifier.fit(X_train, y_train)
-
-#validate model
-print("Score: {}".format(classifier.score(X_valid, y_valid)))
-
-#save model
-print("Saving model at {}".format(model_filepath))
-dump(classifier, model_filepath)
\ No newline at end of file
+        with report.stage("equalise") as stage:
+            dataframe = equal_entries_df(equalised_columns, dataframe, used_columns, ratios=equalised_ratios, random_state=equalise_seed)
+            stage.output(dataframe)
+    return dataframe
+
+def stage_keys():
+    """Returns the cache keys of the preprocessing stages (loaded, filtered, balanced) for the current files and settings."""
+    fingerprints = [file_fingerprint(filepath, hash_input_files) for filepath in input_filepaths()]
+    loaded_key = stage_key(fingerprints, base_columns(used_columns), rename_dict, label_columns, integer_columns, float32_features, saved_setting("load_filters"), "dropna")
+    filtered_key = stage_key(loaded_key, *[feature_key(feature) for feature in feature_order(used_columns)], "dropna")
+    balanced_key = stage_key(filtered_key, equalise_columns, equalised_columns, saved_setting("equalised_ratios"), equalise_seed)
+    return loaded_key, filtered_key, balanced_key
+
+def preprocessed_dataframe(report=None):
+    """
+    Runs the preprocessing stages (loaded, filtered, balanced), reusing cached results.
+
+    Each stage is keyed by the key of the previous stage and its own settings, so changing a late stage reuses the earlier ones.
+    Normalisation is not part of the preprocessing, as the normaliser is fitted on the training set only.
+
+    Arguments
+    ---------
+    report : RunReport or None
+        Report in which the stages are measured
+
+    Returns
+    -------
+    dataframe : pd.DataFrame
+        Preprocessed data
+    """
+    if(report is None):
+        report = RunReport()
+
+    loaded_key, filtered_key, balanced_key = stage_keys()
+
+    stages = [
+        ("loaded", loaded_key, lambda dataframe: load_stage(report)),
+        ("filtered", filtered_key, lambda dataframe: filter_stage(dataframe, report, loaded_key)),
+        ("balanced", balanced_key, lambda dataframe: balance_stage(dataframe, report))
+    ]
+
+    #start from the latest stage which is already cached
+    first_stage = 0
+    for index, (stage, key, compute) in enumerate(stages):
+        if(is_cached(cache_dir, stage, key)):
+            first_stage = index
+
+    dataframe = None
+    for stage, key, compute in stages[first_stage:]:
+        #includes computing the stage and writing it to the cache, or reading it from the cache
+        with report.stage("{} stage".format(stage)) as measured:
+            measured.note(cached=is_cached(cache_dir, stage, key))
+            dataframe = cached_stage(cache_dir, stage, key, lambda: compute(dataframe), cache_max_bytes)
+            measured.output(dataframe)
+        print_memory(stage, dataframe)
+
+    return dataframe
+
+
+def ingested_dataframe(report=None):
+    """
+    Ingests new data files into `ingested_store` and loads the balanced data from its partitions.
+
+    Only files which are new or changed are processed. The balancing uses the group counts in the manifest, and only
+    the partitions of the selected groups (see `ingested_groups`) and the columns needed for training are read.
+
+    Arguments
+    ---------
+    report : RunReport or None
+        Report in which the stages are measured
+
+    Returns
+    -------
+    dataframe : pd.DataFrame
+        Balanced data
+    normaliser : QuantileNormaliser
+        Normaliser combined from the quantile sketches of the kept rows
+    """
+    if(report is None):
+        report = RunReport()
+
+    train_columns = [x for x in used_columns if x not in excluded_columns]
+    manifest, counts, quotas = ingested_quotas(report)
+    with report.stage("equalise") as stage:
+        columns = train_columns + [x for x in dict.fromkeys(equalised_columns + slice_columns + ["Is shower?"]) if x not in train_columns]
+        dataframe = load_balanced(ingested_store, manifest, quotas, columns, random_state=equalise_seed)
+        stage.output(dataframe)
+    print_memory("balanced", dataframe)
+
+    return dataframe, balanced_normaliser(ingested_store, manifest, counts, quotas, n_quantiles, train_columns)
+
+def ingested_quotas(report=None):
+    """Ingests new data files into `ingested_store` and returns the manifest, the rows per selected group and file, and the rows to keep."""
+    if(report is None):
+        report = RunReport()
+
+    #all features are sketched, so that training on another feature subset does not need a new ingest
+    sketch_columns = [x for x in used_columns if x not in label_columns and x not in equalised_columns]
+    with report.stage("ingest"):
+        manifest = ingest(input_filepaths(), ingested_store, used_columns, equalised_columns, sketch_columns, filters=load_filters,
+                          float32=float32_features, n_quantiles=n_quantiles, hash_input_files=hash_input_files)
+
+    counts = select_groups(group_counts(manifest, filenames), equalised_columns, ingested_groups)
+    if(equalise_columns == True):
+        print('Equalizing distribution per particle')
+        quotas = balanced_quotas(counts, equalised_ratios)
+    else:
+        quotas = counts
+    print(f'Smallest count number : {counts.sum().min()}')
+    return manifest, counts, quotas
+
+def streamed_split(manifest, quotas, seed, columns=(), normaliser=None):
+    """
+    Divides the balanced data of `ingested_store` into training and validation rows, reading one ingested file at a time.
+
+    Used by the "approximate" training mode, so that the training set never has to be in memory: only the validation
+    rows are kept, and the training rows are read again from the store for every pass (see `ingest.iter_balanced_split`).
+
+    Arguments
+    ---------
+    manifest : dict
+        Manifest of `ingested_store`, see `ingest.read_manifest`
+    quotas : pd.DataFrame
+        Rows to keep per group and file, see `ingested_quotas`
+    seed : int
+        Seed of the training/validation split
+    columns : list
+        Other columns to keep for the validation events, e.g. `slice_columns`
+    normaliser : QuantileNormaliser or None
+        If given, fitted with `partial_fit` on the training rows while they are read
+
+    Returns
+    -------
+    training_files : callable
+        Function without arguments returning a fresh iterator of the training rows, one dataframe per ingested file
+    validation : pd.DataFrame
+        Validation rows, with the features, "Is shower?" and `columns`
+    n_training : int
+        Number of training rows
+    """
+    train_columns = [x for x in used_columns if x not in excluded_columns]
+    columns = train_columns + [x for x in dict.fromkeys(list(columns) + ["Is shower?"]) if x not in train_columns]
+    split_files = lambda: iter_balanced_split(ingested_store, manifest, quotas, columns, random_state=equalise_seed, split_seed=seed)
+
+    validation, n_training = [], 0
+    for filename, training, valid in split_files():
+        validation.append(valid)
+        n_training += len(training)
+        if(normaliser is not None):
+            normaliser.partial_fit(training[train_columns])
+    validation = pd.concat(validation, ignore_index=True)
+    return lambda: (training for filename, training, valid in split_files()), validation, n_training
+
+def training_data_key(seed):
+    """
+    Returns the key identifying the training and validation data of a run with the current settings: the input files,
+    the preprocessing (see `stage_keys`), the features, the split and the normalisation.
+    """
+    data_key = stage_key(stage_keys()[-1], [x for x in used_columns if x not in excluded_columns], seed, n_quantiles)
+    if(ingested_store is not None):
+        data_key = stage_key(data_key, "ingested", ingested_groups, sketch_normaliser)
+        if(training_mode == "approximate"):
+            data_key = stage_key(data_key, "streamed")
+    return data_key
+
+def make_classifier():
+    """Creates the classifier chosen by `classifier_type`, with the parameters set above."""
+    if(classifier_type == "RandomForestClassifier"):
+        return RandomForestClassifier(n_estimators, max_depth=max_depth)
+    elif(classifier_type == "LinearSVC"):
+        return LinearSVC(dual=dual)
+    elif(classifier_type == "SVC"):
+        return SVC(kernel=kernel)
+    raise ValueError("Unknown classifier type '{}'".format(classifier_type))
+
+def run_settings(**overrides):
+    """Returns the settings of this run, which are saved in the run report, with `overrides` replacing some of them (e.g. the drawn `split_seed`)."""
+    names = ["filenames", "hash_input_files", "ingested_store", "ingested_groups", "sketch_normaliser", "load_filters", "float32_features", "n_quantiles",
+             "equalise_columns", "equalised_columns", "equalised_ratios", "equalise_seed",
+             "split_seed", "classifier_type", "dual", "kernel", "training_mode", "approximation", "approximate_chunksize", "n_estimators", "max_depth"]
+    settings = {name: globals()[name] for name in names}
+    settings.update(overrides)
+    #JSON cannot have tuples as keys, so the ratios are saved as the list of (key, ratio) pairs also accepted from config files
+    if(isinstance(equalised_ratios, dict)):
+        settings["equalised_ratios"] = [[list(key) if isinstance(key, tuple) else key, ratio] for key, ratio in equalised_ratios.items()]
+    return settings
+
+def saved_setting(name):
+    """
+    Returns a setting in the form it is saved with a model (JSON, which turns tuples into lists), so that keys computed
+    from it are the same once the saved settings are applied again, see `applied_settings`.
+    """
+    return json.loads(json.dumps(run_settings()[name], default=str))
+
+@contextmanager
+def applied_settings(settings):
+    """
+    Applies saved settings (see `run_settings`), e.g. of a model, to this module within a `with` block, and restores the previous values after it.
+
+    Settings which no longer exist in this module are ignored.
+    """
+    settings = {name: value for name, value in settings.items() if name in globals()}
+    previous = {name: globals()[name] for name in settings}
+    globals().update(settings)
+    try:
+        yield
+    finally:
+        globals().update(previous)
+
+def main():
+    model_filepath = os.path.join("models", model_filename)
+    model_root = os.path.splitext(model_filepath)[0]
+    #a random split gets a drawn seed, which is saved with the model so that its validation set can be recreated
+    seed = split_seed if split_seed is not None else int(np.random.default_rng().integers(2**32))
+    report = RunReport(trace_memory=trace_memory, settings=run_settings(split_seed=seed))
+
+    train_columns = [x for x in used_columns if x not in excluded_columns]
+    #with an ingested store, the approximate model is trained out of core, reading the training rows from the store in chunks
+    streamed = training_mode == "approximate" and ingested_store is not None
+
+    if(streamed):
+        print("Dividing data into training and validation sets, reading the ingested files one at a time")
+        manifest, counts, quotas = ingested_quotas(report)
+        with report.stage("split") as stage:
+            #the normaliser is fitted on the training rows while they are read, or built from the quantile sketches
+            if(sketch_normaliser):
+                normaliser = balanced_normaliser(ingested_store, manifest, counts, quotas, n_quantiles, train_columns)
+            else:
+                normaliser = QuantileNormaliser(n_quantiles=n_quantiles)
+            training_files, validation, n_training = streamed_split(manifest, quotas, seed, slice_columns, None if sketch_normaliser else normaliser)
+            X_valid, y_valid, valid_slices = normaliser.transform(validation[train_columns]), validation["Is shower?"], validation[slice_columns]
+            stage.output(validation)
+            stage.note(training_rows=n_training)
+    else:
+        if(ingested_store is not None):
+            dataframe, ingested_normaliser = ingested_dataframe(report)
+        else:
+            dataframe = preprocessed_dataframe(report)
+
+        #divide data into training/validation sets
+        print("Dividing data into training and validation sets")
+        with report.stage("split") as stage:
+            #the columns to slice the validation performance by are split along with the features
+            split_columns = train_columns + [x for x in slice_columns if x not in train_columns]
+            X_train, X_valid, y_train, y_valid = train_test_balanced(dataframe, equalised_columns, split_columns, random_state=seed)
+            #X_train, X_valid, y_train, y_valid = train_test_split(dataframe[train_columns], dataframe["Is shower?"])
+            valid_slices = X_valid[slice_columns]
+            X_train, X_valid = X_train[train_columns], X_valid[train_columns]
+            stage.output(X_train)
+
+        #normalise data, using quantiles of the training set only
+        print("Normalising data")
+        with report.stage("normalise") as stage:
+            if(ingested_store is not None and sketch_normaliser):
+                normaliser = ingested_normaliser
+            else:
+                normaliser = QuantileNormaliser(n_quantiles=n_quantiles).fit(X_train)
+            X_train = normaliser.transform(X_train)
+            X_valid = normaliser.transform(X_valid)
+            stage.output(X_train)
+        print_memory("normalising (training set)", X_train)
+        n_training = X_train.shape[0]
+
+    print("Training samples:\t{}".format(n_training))
+    print("Validation samples:\t{}".format(X_valid.shape[0]))
+
+    if(training_mode == "compare"):
+        print("Comparing exact and approximate kernel")
+        with report.stage("compare"):
+            results = compare_with_exact(X_train, y_train, X_valid, y_valid, [dict(approximation, kernel=kernel)], chunksize=approximate_chunksize,
+                                         exact_kernel=kernel, exact_max_samples=exact_max_samples, random_state=seed)
+        print(results.to_string(index=False))
+    else:
+        #train model
+        print("Training model")
+        with report.stage("fit", profile_filepath=model_root + "_fit.prof" if profile_fit else None) as fit_stage:
+            if(training_mode == "approximate"):
+                #seeded with the split seed unless `approximation` sets one, so that the model can be reproduced from its saved settings
+                approximate_settings = dict({"random_state": seed}, **approximation)
+                fit_kwargs = {key: value for key, value in approximate_settings.items() if key in ("n_epochs", "alpha", "random_state")}
+                feature_map = make_feature_map(kernel=kernel, **{key: value for key, value in approximate_settings.items() if key not in ("n_epochs", "alpha")})
+                if(streamed):
+                    chunks = lambda: ((normaliser.transform(training[train_columns].iloc[start:start + approximate_chunksize]),
+                                       training["Is shower?"].iloc[start:start + approximate_chunksize])
+                                      for training in training_files() for start in range(0, len(training), approximate_chunksize))
+                else:
+                    chunks = array_chunks(X_train, y_train, approximate_chunksize, random_state=seed)
+                classifier = fit_approximate(chunks, feature_map, classes=(False, True), **fit_kwargs)
+            else:
+                classifier = make_classifier()
+                classifier.fit(X_train, y_train)
+            if(streamed):
+                fit_stage.note(rows=n_training)
+            else:
+                fit_stage.output(X_train)
+
+        #validate model, scoring the validation set once; the scores are kept for the evaluation per slice (see evaluation.py)
+        with report.stage("score") as stage:
+            valid_scores, valid_predictions = classifier_scores(classifier, X_valid)
+            score = float((valid_predictions == y_valid.to_numpy()).mean())
+            stage.output(X_valid)
+            stage.note(score=score)
+        print("Score: {}".format(score))
+
+        #save model
+        print("Saving model at {}".format(model_filepath))
+        with report.stage("dump"):
+            save_model(classifier, model_filepath, score=score, fit_time=fit_stage.record["wall_time"], data_key=training_data_key(seed),
+                       training_samples=n_training, validation_samples=X_valid.shape[0], settings=run_settings(split_seed=seed),
+                       normaliser=os.path.basename(normaliser_filepath(model_filepath)), report=os.path.basename(model_root + "_report.json"))
+            normaliser.save(normaliser_filepath(model_filepath))
+            save_validation_scores(validation_scores_filepath(model_filepath), valid_scores, valid_predictions, y_valid, valid_slices)
+
+    print("Saving run report at {}".format(model_root + "_report.json"))
+    report.save(model_root + "_report.json")
+
+if(__name__ == "__main__"):
+    main()
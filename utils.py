@@ -1,8 +1,15 @@
 import os
+import numbers
+import operator
+import numpy as np
 import pandas as pd
 from sklearn.preprocessing import quantile_transform
-from sklearn.model_selection import train_test_split
+from joblib import Parallel, delayed
 
+from schema import compact_dtypes
+from features import derived_features, feature_order, base_columns, add_derived_features
+
+#besides the columns in the files, derived features (see features.py) can be used by their name, e.g. "Track-shower opening angle"
 used_columns = ["crkv_nhits100[:,0,0]",
                 "crkv_nhits100[:,0,2]",
                 "crkv_nhits100[:,1,2]",
@@ -34,6 +41,7 @@ used_columns = ["crkv_nhits100[:,0,0]",
                 "T.sum_hits.ndoms",
                 "T.sum_jppshower.n_selected_hits",
                 "Inelasticity",
+                "energy",
                 "Particle name",
                 "Is shower?",
                 "is_cc",
@@ -41,12 +49,79 @@ used_columns = ["crkv_nhits100[:,0,0]",
                 "Shower reconstruction likelyhood"
 ]
 
+rename_dict = {
+    "Unnamed: 0": "Run number",
+    "angle_shfit_gandalf": "Angle between direction of shower and track",
+    "distance_shfit_gandalf": "Distance between shower and track start",
+    "dt_shfit_gandalf": "Time difference between shower and track start",
+    "E.trks.len[:,0]": "Track length",
+    "E.trks.dir.x[:,0]": "Track x-direction",
+    "E.trks.dir.y[:,0]": "Track y-direction",
+    "E.trks.dir.z[:,0]": "Track z-direction",
+    "E.trks.pos.x[:,0]": "Track x-position",
+    "E.trks.pos.y[:,0]": "Track y-position",
+    "E.trks.pos.z[:,0]": "Track z-position",
+    "E.trks.dir.x[:,1]": "Shower x-direction",
+    "E.trks.dir.y[:,1]": "Shower y-direction",
+    "E.trks.dir.z[:,1]": "Shower z-direction",
+    "E.trks.pos.x[:,1]": "Shower x-position",
+    "E.trks.pos.y[:,1]": "Shower y-position",
+    "E.trks.pos.z[:,1]": "Shower z-position",
+    "T.feat_Neutrino2020.cherCond_n_doms": "Number of detector spheres with unscattered light signals",
+    "T.feat_Neutrino2020.gandalf_nHits": "Number of hits used in track reconstruction",
+    "T.sum_mc_nu.by": "Inelasticity",
+    "E.trks.lik[:,0]": "Track reconstruction likelyhood",
+    "E.trks.lik[:,1]": "Shower reconstruction likelyhood"
+}
+
+pdgid_dict = {
+    12: "Electron neutrino",
+    14: "Muon neutrino",
+    16: "Tau neutrino",
+    -12: "Anti electron neutrino",
+    -14: "Anti muon neutrino",
+    -16: "Anti tau neutrino"
+}
+
+#columns added by load_from_h5, derived from the raw columns below
+label_columns = {
+    "Particle name": ["pdgid"],
+    "Is shower?": ["pdgid", "is_cc"]
+}
+
+#operators which can be used in filters, see filter_mask
+filter_operators = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne
+}
+
+#the particle names are stored as categorical codes instead of one string per event
+particle_name_dtype = pd.CategoricalDtype(sorted(set(pdgid_dict.values())))
+
+#columns holding whole numbers, stored as the smallest integer type which fits them
+integer_columns = ["pdgid",
+                   "is_cc",
+                   "crkv_nhits100[:,0,0]",
+                   "crkv_nhits100[:,0,2]",
+                   "crkv_nhits100[:,1,2]",
+                   "crkv_nhits50[:,0,0]",
+                   "Number of detector spheres with unscattered light signals",
+                   "Number of hits used in track reconstruction",
+                   "T.feat_Neutrino2020.n_hits_earlyTrig",
+                   "T.sum_hits.ndoms",
+                   "T.sum_jppshower.n_selected_hits"
+]
+
 def column_renamer(input):
     """
     Renames standard column names to something more human-readable.
 
     Returns a human-readable name corresponding to the input column name.
-    If the input column name is not in the dictionary, returns the input column name.
+    If the input column name is not in `rename_dict`, returns the input column name.
 
     Arguments
     --------
@@ -58,30 +133,6 @@ def column_renamer(input):
     newname : string
         New name for the column
     """
-    rename_dict = {
-        "Unnamed: 0": "Run number",
-        "angle_shfit_gandalf": "Angle between direction of shower and track",
-        "distance_shfit_gandalf": "Distance between shower and track start",
-        "dt_shfit_gandalf": "Time difference between shower and track start",
-        "E.trks.len[:,0]": "Track length",
-        "E.trks.dir.x[:,0]": "Track x-direction",
-        "E.trks.dir.y[:,0]": "Track y-direction",
-        "E.trks.dir.z[:,0]": "Track z-direction",
-        "E.trks.pos.x[:,0]": "Track x-position",
-        "E.trks.pos.y[:,0]": "Track y-position",
-        "E.trks.pos.z[:,0]": "Track z-position",
-        "E.trks.dir.x[:,1]": "Shower x-direction",
-        "E.trks.dir.y[:,1]": "Shower y-direction",
-        "E.trks.dir.z[:,1]": "Shower z-direction",
-        "E.trks.pos.x[:,1]": "Shower x-position",
-        "E.trks.pos.y[:,1]": "Shower y-position",
-        "E.trks.pos.z[:,1]": "Shower z-position",
-        "T.feat_Neutrino2020.cherCond_n_doms": "Number of detector spheres with unscattered light signals",
-        "T.feat_Neutrino2020.gandalf_nHits": "Number of hits used in track reconstruction",
-        "T.sum_mc_nu.by": "Inelasticity",
-        "E.trks.lik[:,0]": "Track reconstruction likelyhood",
-        "E.trks.lik[:,1]": "Shower reconstruction likelyhood"
-    }
     try:
         newname = rename_dict[input]
     except KeyError:
@@ -89,6 +140,32 @@ def column_renamer(input):
         
     return newname
 
+def raw_column_names(columns):
+    """
+    Maps (renamed) column names back to the names used in the HDF files.
+
+    Inverse of `column_renamer`. Label columns added by `load_from_h5` and derived features (see `features.py`) are
+    replaced by the raw columns they are derived from.
+
+    Arguments
+    ---------
+    columns : iterable
+        Column names as they appear after loading
+
+    Returns
+    -------
+    raw_columns : list
+        Names of the columns to be read from the HDF files, without duplicates
+    """
+    inverse_dict = {newname: oldname for oldname, newname in rename_dict.items()}
+    raw_columns = []
+    for column in base_columns(list(columns)):
+        for raw_column in label_columns.get(column, [inverse_dict.get(column, column)]):
+            if raw_column not in raw_columns:
+                raw_columns.append(raw_column)
+
+    return raw_columns
+
 def pdgid_converter(id):
     """
     Helper function to find particle name from its Particle Data Group ID (PDGID)
@@ -103,14 +180,6 @@ def pdgid_converter(id):
     string:
         Name of the particle
     """
-    pdgid_dict = {
-        12: "Electron neutrino",
-        14: "Muon neutrino",
-        16: "Tau neutrino",
-        -12: "Anti electron neutrino",
-        -14: "Anti muon neutrino",
-        -16: "Anti tau neutrino"
-    }
     return pdgid_dict[id]
 
 def is_shower(row):
@@ -152,18 +221,153 @@ def count_occurrences(dataframe, columns, silent = True):
     new_df : pd.Dataframe
         Dataframe containing the unique (combinations of) values for the column(s), along with the amount of occurrences for each
     """
-    count_series = dataframe.groupby(columns).size()
+    count_series = dataframe.groupby(columns, observed=True).size()
     new_df = count_series.to_frame(name="Occurrences").reset_index()
     if(not silent):
         print('Counting particle occurrences : ')
         print(new_df)
     return new_df
 
-def equal_entries_df(equalised_columns: list, dataframe: pd.DataFrame, used_columns: list):
+def group_keys(dataframe, columns):
+    """
+    Returns the unique (combinations of) values in the specified columns, sorted.
+
+    Rows with missing values in any of the columns do not form a group.
+
+    Arguments
+    ---------
+    dataframe : pd.Dataframe
+        Dataframe to be analysed
+    columns : list
+        Names of the columns to be grouped on
+
+    Returns
+    -------
+    keys : pd.MultiIndex
+        Sorted unique (combinations of) values, one level per column
+    """
+    #categorical columns also count combinations which do not occur
+    counts = dataframe.value_counts(subset=columns)
+    return counts[counts > 0].index.sort_values()
+
+def group_codes(dataframe, columns, keys=None):
+    """
+    Assigns each row the integer code of its group, i.e. its position in `keys`.
+
+    Arguments
+    ---------
+    dataframe : pd.Dataframe
+        Dataframe to be analysed
+    columns : list
+        Names of the columns to be grouped on
+    keys : pd.MultiIndex or None
+        Groups to assign codes for, as returned by `group_keys`. If None, the groups found in `dataframe` are used
+
+    Returns
+    -------
+    codes : np.ndarray
+        Group code for each row, -1 for rows which do not belong to any of the groups
+    keys : pd.MultiIndex
+        Groups corresponding to the codes
+    """
+    if(keys is None):
+        keys = group_keys(dataframe, columns)
+    codes = keys.get_indexer(pd.MultiIndex.from_frame(dataframe[columns]))
+    return codes, keys
+
+def balanced_targets(counts, keys, ratios=None):
+    """
+    Computes how many rows to keep from each group to get the requested ratio between the groups.
+
+    Arguments
+    ---------
+    counts : np.ndarray
+        Number of available rows per group
+    keys : pd.MultiIndex
+        Groups corresponding to `counts`
+    ratios : dict, list or None
+        Relative amount of rows to keep per group, keyed by group value (or tuple of values when balancing on several columns).
+        A list of (key, weight) pairs, with lists as keys, is accepted too, as JSON cannot have tuples as keys.
+        Groups missing from the dictionary get weight 1. If None, all groups are balanced 1:1
+
+    Returns
+    -------
+    targets : np.ndarray
+        Number of rows to keep per group
+    """
+    weights = np.ones(len(keys))
+    if(ratios is not None):
+        for key, weight in (ratios.items() if isinstance(ratios, dict) else ratios):
+            key = tuple(key) if isinstance(key, (tuple, list)) else (key,)
+            if(key in keys):
+                weights[keys.get_loc(key)] = weight
+
+    used = weights > 0
+    scale = np.min(counts[used] / weights[used])
+    return np.floor(weights * scale + 1e-9).astype(np.int64)
+
+def group_ranks(codes, random_state=None):
+    """
+    Sorts rows by group code and computes the rank of every row within its group.
+
+    Rows which do not belong to a group (code -1) are left out.
+
+    Arguments
+    ---------
+    codes : np.ndarray
+        Group code for each row, as returned by `group_codes`
+    random_state : int, np.random.Generator or None
+        Seed for shuffling the rows within each group. If None, rows keep their original order within each group
+
+    Returns
+    -------
+    order : np.ndarray
+        Row positions, sorted by group code
+    sorted_codes : np.ndarray
+        Group code of each row in `order`
+    ranks : np.ndarray
+        Rank of each row in `order` within its group
+    """
+    if(random_state is None):
+        order = np.argsort(codes, kind="stable")
+    else:
+        permutation = np.random.default_rng(random_state).permutation(len(codes))
+        order = permutation[np.argsort(codes[permutation], kind="stable")]
+    order = order[codes[order] >= 0]
+    sorted_codes = codes[order]
+
+    counts = np.bincount(sorted_codes)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    ranks = np.arange(len(order)) - starts[sorted_codes]
+
+    return order, sorted_codes, ranks
+
+def balanced_positions(codes, targets, random_state=None):
+    """
+    Picks `targets[g]` rows of every group `g` in a single pass.
+
+    Arguments
+    ---------
+    codes : np.ndarray
+        Group code for each row, as returned by `group_codes`
+    targets : np.ndarray
+        Number of rows to keep per group
+    random_state : int, np.random.Generator or None
+        Seed for random sampling. If None, the first rows of each group are kept
+
+    Returns
+    -------
+    positions : np.ndarray
+        Sorted positions of the rows to keep
+    """
+    order, sorted_codes, ranks = group_ranks(codes, random_state)
+    return np.sort(order[ranks < targets[sorted_codes]])
+
+def equal_entries_df(equalised_columns: list, dataframe: pd.DataFrame, used_columns: list, ratios=None, random_state=None):
     '''
     Drops rows of dataframe to get equal amounts of different entry values for the chosen columns.
 
-    Returns truncated dataframe.
+    Returns truncated dataframe, keeping the original row order.
 
     Arguments
     --------
@@ -173,29 +377,174 @@ def equal_entries_df(equalised_columns: list, dataframe: pd.DataFrame, used_colu
         Dataframe to be truncated
     used_columns : list
         Column names as in dataframe
+    ratios : dict or None
+        Relative amount of rows to keep per group, see `balanced_targets`. If None, groups are balanced 1:1
+    random_state : int or None
+        Seed for random sampling of the kept rows. If None, the first rows of each group are kept
 
     Returns
     -------
     new_df : dataframe
         Truncated dataframe
     '''
-    count_df = count_occurrences(dataframe, equalised_columns)
-    min_occurrences = count_df['Occurrences'].min()
-    print(f'Smallest count number : {min_occurrences}')
-
-    grouped = dataframe.groupby(equalised_columns)
-    new_df = pd.DataFrame(columns=used_columns)
+    codes, keys = group_codes(dataframe, equalised_columns)
+    counts = np.bincount(codes[codes >= 0], minlength=len(keys))
+    print(f'Smallest count number : {counts.min()}')
 
-    for particle_name, frame in grouped:
-        frame = frame.reset_index()
-        frame = frame.truncate(after=min_occurrences)
-        new_df = new_df.merge(right=frame, how='outer')
+    targets = balanced_targets(counts, keys, ratios)
+    positions = balanced_positions(codes, targets, random_state)
+    new_df = dataframe.iloc[positions][[column for column in used_columns if column in dataframe.columns]]
+    new_df = new_df.reset_index(drop=True)
 
     print('After dropping rows : ')
     test_count_df = count_occurrences(new_df, equalised_columns)
     return new_df
 
-def train_test_balanced(dataframe, equalised_columns, train_columns):
+def equal_entries_chunks(chunks, equalised_columns: list, ratios=None, random_state=None):
+    '''
+    Out-of-core version of `equal_entries_df` for data which does not fit in memory.
+
+    Makes two passes over the data: the first counts the rows per group, the second yields the kept rows of each chunk.
+    Only the group counts and, when sampling randomly, the ordinals of the kept rows are held in memory.
+
+    Arguments
+    --------
+    chunks : callable
+        Function without arguments returning a fresh iterable of dataframes each time it is called
+    equalised_columns : list
+        List containing the names of the columns to be balanced on
+    ratios : dict or None
+        Relative amount of rows to keep per group, see `balanced_targets`. If None, groups are balanced 1:1
+    random_state : int or None
+        Seed for random sampling of the kept rows. If None, the first rows of each group are kept
+
+    Yields
+    ------
+    chunk : pd.DataFrame
+        Kept rows of each chunk, in the original order
+    '''
+    totals = None
+    for chunk in chunks():
+        chunk_counts = chunk.value_counts(subset=equalised_columns)
+        totals = chunk_counts if totals is None else totals.add(chunk_counts, fill_value=0)
+    keys = totals.index.sort_values()
+    counts = totals.reindex(keys).to_numpy().astype(np.int64)
+    print(f'Smallest count number : {counts.min()}')
+
+    targets = balanced_targets(counts, keys, ratios)
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    if(random_state is not None):
+        #global ordinals (group offset + rank within group) of the rows to keep
+        rng = np.random.default_rng(random_state)
+        kept_ordinals = np.sort(np.concatenate([offset + rng.choice(count, target, replace=False) for offset, count, target in zip(offsets, counts, targets)]))
+
+    seen = np.zeros(len(keys), dtype=np.int64)
+    for chunk in chunks():
+        codes, _ = group_codes(chunk, equalised_columns, keys)
+        valid = codes >= 0
+        ranks = np.full(len(codes), -1, dtype=np.int64)
+        ranks[valid] = seen[codes[valid]] + pd.Series(codes[valid]).groupby(codes[valid]).cumcount().to_numpy()
+        seen += np.bincount(codes[valid], minlength=len(keys))
+
+        if(random_state is None):
+            keep = valid & (ranks < targets[np.maximum(codes, 0)])
+        else:
+            ordinals = offsets[np.maximum(codes, 0)] + ranks
+            found = np.searchsorted(kept_ordinals, ordinals).clip(max=len(kept_ordinals) - 1)
+            keep = valid & (kept_ordinals[found] == ordinals)
+        yield chunk[keep]
+
+def balanced_split_indices(dataframe, equalised_columns, test_size=0.25, random_state=None):
+    """
+    Divides the rows of a dataframe into training and validation sets, while keeping the distribution of the specified columns equal.
+
+    Each group gets ceil(`test_size` * group size) validation rows, like `train_test_split` applied per group.
+
+    Arguments
+    ---------
+    dataframe : pd.Dataframe
+        Dataframe to be divided into training and validation sets
+    equalised_columns : list
+        List containing the column names of which the distribution should be kept equal
+    test_size : float
+        Fraction of each group used for validation
+    random_state : int, np.random.Generator or None
+        Seed for the random split
+
+    Returns
+    -------
+    train_positions, valid_positions : np.ndarray
+        Sorted row positions of the training and validation sets
+    """
+    codes, keys = group_codes(dataframe, equalised_columns)
+    order, sorted_codes, ranks = group_ranks(codes, np.random.default_rng(random_state))
+
+    n_valid = np.ceil(test_size * np.bincount(sorted_codes, minlength=len(keys))).astype(np.int64)
+    is_valid = ranks < n_valid[sorted_codes]
+
+    return np.sort(order[~is_valid]), np.sort(order[is_valid])
+
+def balanced_kfold_indices(dataframe, equalised_columns, n_splits=5, random_state=None):
+    """
+    Stratified k-fold split which keeps the distribution of the specified columns equal in every fold.
+
+    Arguments
+    ---------
+    dataframe : pd.Dataframe
+        Dataframe to be divided into folds
+    equalised_columns : list
+        List containing the column names of which the distribution should be kept equal
+    n_splits : int
+        Number of folds
+    random_state : int, np.random.Generator or None
+        Seed for assigning rows to folds
+
+    Yields
+    ------
+    train_positions, valid_positions : np.ndarray
+        Sorted row positions of the training and validation sets of each fold
+    """
+    codes, keys = group_codes(dataframe, equalised_columns)
+    order, sorted_codes, ranks = group_ranks(codes, np.random.default_rng(random_state))
+
+    folds = ranks % n_splits
+    for fold in range(n_splits):
+        is_valid = folds == fold
+        yield np.sort(order[~is_valid]), np.sort(order[is_valid])
+
+def balanced_repeated_split_indices(dataframe, equalised_columns, n_repeats=5, test_size=0.25, random_state=None):
+    """
+    Repeats `balanced_split_indices` with a different random split each time.
+
+    Arguments
+    ---------
+    dataframe : pd.Dataframe
+        Dataframe to be divided into training and validation sets
+    equalised_columns : list
+        List containing the column names of which the distribution should be kept equal
+    n_repeats : int
+        Number of splits
+    test_size : float
+        Fraction of each group used for validation
+    random_state : int, np.random.Generator or None
+        Seed for the sequence of splits
+
+    Yields
+    ------
+    train_positions, valid_positions : np.ndarray
+        Sorted row positions of the training and validation sets of each split
+    """
+    codes, keys = group_codes(dataframe, equalised_columns)
+    n_rows = np.bincount(codes[codes >= 0], minlength=len(keys))
+    n_valid = np.ceil(test_size * n_rows).astype(np.int64)
+
+    rng = np.random.default_rng(random_state)
+    for repeat in range(n_repeats):
+        order, sorted_codes, ranks = group_ranks(codes, rng)
+        is_valid = ranks < n_valid[sorted_codes]
+        yield np.sort(order[~is_valid]), np.sort(order[is_valid])
+
+def train_test_balanced(dataframe, equalised_columns, train_columns, test_size=0.25, random_state=None):
     """
     Divides a dataframe into training and validation sets, while keeping the distribution of the specified columns equal.
 
@@ -207,36 +556,22 @@ def train_test_balanced(dataframe, equalised_columns, train_columns):
         List containing the column names of which the distribution should be kept equal
     train_columns : list
         List containing the column names of the features used for training
+    test_size : float
+        Fraction of each group used for validation
+    random_state : int or None
+        Seed for the random split
 
     Returns
     -------
     X_train, X_valid, y_train, y_valid : list of pd.Dataframe
         Dataframes containing the features and labels of the training and validation sets
     """
-    X_train_list, X_valid_list, y_train_list, y_valid_list = [], [], [], []
-
-    count_series = count_occurrences(dataframe, equalised_columns, silent=True)
-    for row in count_series.iterrows():
-        #get series with combinations of each value
-        series = row[1][0:-1]
-        
-        #get dataframe with entries which are equal to the specified combination
-        bool_index = pd.DataFrame([dataframe[index] == series[index] for index in series.index]).transpose()
-        temp_df = dataframe.loc[bool_index.apply(all, axis=1)]
-        
-        #split dataframe into training and validation sets
-        X_train_temp, X_valid_temp, y_train_temp, y_valid_temp = train_test_split(temp_df[train_columns], temp_df["Is shower?"])
+    train_positions, valid_positions = balanced_split_indices(dataframe, equalised_columns, test_size, random_state)
 
-        X_train_list.append(X_train_temp)
-        X_valid_list.append(X_valid_temp)
-        y_train_list.append(y_train_temp)
-        y_valid_list.append(y_valid_temp)
-
-    #concatenate dataframe
-    X_train = pd.concat(X_train_list)
-    X_valid = pd.concat(X_valid_list)
-    y_train = pd.concat(y_train_list)
-    y_valid = pd.concat(y_valid_list)
+    X_train = dataframe[train_columns].iloc[train_positions]
+    X_valid = dataframe[train_columns].iloc[valid_positions]
+    y_train = dataframe["Is shower?"].iloc[train_positions]
+    y_valid = dataframe["Is shower?"].iloc[valid_positions]
 
     return X_train, X_valid, y_train, y_valid
 
@@ -271,32 +606,285 @@ def clear_line():
     """Clears the current line in the console."""
     print("\r" + " " * (os.get_terminal_size().columns - 1), end = "\r")
 
+def particle_names(pdgids):
+    """
+    Vectorised version of `pdgid_converter`.
+
+    Arguments
+    ---------
+    pdgids : pd.Series
+        Particle Data Group IDs
+
+    Returns
+    -------
+    names : pd.Series
+        Names of the particles (categorical), with the same index as `pdgids`
+    """
+    names = pdgids.map(pdgid_dict)
+    unknown = names.isnull()
+    if(unknown.any()):
+        raise KeyError("Unknown PDGID(s): {}".format(sorted(pdgids[unknown].unique())))
+    return names.astype(particle_name_dtype)
+
+def shower_mask(pdgids, is_cc):
+    """
+    Vectorised version of `is_shower`.
+
+    Arguments
+    ---------
+    pdgids : pd.Series
+        Particle Data Group IDs
+    is_cc : pd.Series
+        Whether the interaction is a charged current interaction
+
+    Returns
+    -------
+    mask : pd.Series
+        False for charged current interactions of (anti) muon neutrinos, True otherwise
+    """
+    return ~(pdgids.abs().eq(14) & is_cc.eq(1.0))
+
+def _read_h5(filepath, raw_columns=None):
+    """
+    Reads a single HDF file, keeping only `raw_columns` (in file order) if specified.
+
+    Table-format stores are read column by column; fixed-format stores can only be read in their entirety and are projected afterwards.
+    """
+    with pd.HDFStore(filepath, mode="r") as store:
+        key = store.keys()[0]
+        if(raw_columns is None):
+            return store.select(key)
+
+        if(store.get_storer(key).is_table):
+            file_columns = store.select(key, stop=0).columns
+            dataframe = store.select(key, columns=list(raw_columns))
+        else:
+            dataframe = store.select(key)
+            file_columns = dataframe.columns
+
+    missing_columns = [column for column in raw_columns if column not in file_columns]
+    if(missing_columns):
+        raise KeyError("Columns not found in {}: {}".format(filepath, missing_columns))
+    return dataframe[[column for column in file_columns if column in raw_columns]]
+
+def _load_h5(filepath, raw_columns=None, float32=False, derived_columns=()):
+    dataframe = _read_h5(filepath, raw_columns).rename(column_renamer, axis="columns")
+    dataframe = add_derived_features(dataframe, derived_columns)
+    add_labels(dataframe)
+    return compact_dtypes(dataframe, integer_columns, float32)
+
 # technically violates single-responsibility principle
-def load_from_h5(filepaths):
+def load_from_h5(filepaths, columns=None, n_jobs=None, float32=False, filters=None, dropna=False, chunksize=1000000):
     """
     Loads data from multiple HDF files and adds columns for particle name and interaction signature.
 
     Assumes columns in all files are the same.
+    Files are read in parallel, and if `columns` is given only the raw columns needed for them are read.
+    Derived features among `columns` (see `features.py`) are computed from their dependencies.
+    Each file is converted to compact types before the files are combined: categorical particle names, boolean
+    "Is shower?", and the smallest integer type for the columns in `integer_columns`.
+    If `filters` or `dropna` are given, the files are read in chunks which are filtered while reading (see `iter_h5_chunks`),
+    so that only the rows which pass are ever held in memory.
 
     Arguments
     ---------
     filepaths : list
         List containing the paths to the HDF files to be read
+    columns : list or None
+        (Renamed) column names which should be loaded, e.g. `used_columns`. If None, all columns are loaded
+    n_jobs : int or None
+        Number of processes used to read the files. If None, one process per file is used
+    float32 : bool
+        Whether to store the floating point features as float32 instead of float64
+    filters : list of tuple or None
+        Filters the rows have to pass, e.g. [("energy", ">", 1000)], see `filter_mask`
+    dropna : bool
+        Whether to drop rows with missing values in the loaded columns
+    chunksize : int
+        Number of rows read at a time when filtering
     
     Returns
     -------
     dataframe : pd.Dataframe
         Dataframe containing the combined data from all files
     """
-    df_list = []
-    for filepath in filepaths:
-        df_list.append(pd.read_hdf(filepath))
-    dataframe = pd.concat(df_list)
+    if(filters or dropna):
+        if(columns is not None):
+            columns = list(columns) + [column for column in label_columns if column not in columns]
+        load, arguments = _load_filtered_h5, (columns, filters, dropna, chunksize, float32)
+    else:
+        raw_columns = None if columns is None else raw_column_names(list(columns) + list(label_columns))
+        load, arguments = _load_h5, (raw_columns, float32, [] if columns is None else list(columns))
+
+    if(n_jobs is None):
+        n_jobs = len(filepaths)
+    if(n_jobs == 1 or len(filepaths) == 1):
+        df_list = [load(filepath, *arguments) for filepath in filepaths]
+    else:
+        df_list = Parallel(n_jobs=n_jobs)(delayed(load)(filepath, *arguments) for filepath in filepaths)
+
+    #files may have been downcast to different integer types, which concat unifies
+    return pd.concat(df_list)
+
+def add_labels(dataframe):
+    """
+    Adds the "Particle name" and "Is shower?" columns, derived from the "pdgid" and "is_cc" columns, in place.
+
+    Arguments
+    ---------
+    dataframe : pd.Dataframe
+        Dataframe containing the "pdgid" and "is_cc" columns
+    """
+    dataframe["Particle name"] = particle_names(dataframe["pdgid"])
+    dataframe["Is shower?"] = shower_mask(dataframe["pdgid"], dataframe["is_cc"])
 
-    dataframe.rename(column_renamer, axis="columns", inplace=True)
-    dataframe["Particle name"] = dataframe.apply(lambda row: pdgid_converter(row["pdgid"]), axis=1)
-    dataframe["Is shower?"] = dataframe.apply(is_shower, axis=1)
+def h5_row_count(filepath):
+    """Returns the number of rows stored in an HDF file."""
+    with pd.HDFStore(filepath, mode="r") as store:
+        storer = store.get_storer(store.keys()[0])
+        return storer.nrows if storer.is_table else storer.shape[0]
 
+def _split_filters(filters, data_columns):
+    """
+    Divides filters into `where` clauses which an HDF table store can evaluate while reading, and the remaining filters.
+
+    Only columns stored as data columns with names which are valid identifiers can be queried.
+    Label columns and derived features are not stored in the files, so filters on them are never evaluated while reading.
+    """
+    clauses, remaining = [], []
+    for column, comparison, value in filters:
+        raw_column = raw_column_names([column])[0]
+        computed = column in label_columns or column in derived_features
+        if(not computed and raw_column in data_columns and raw_column.isidentifier()
+           and isinstance(value, numbers.Real) and np.isfinite(value)):
+            clauses.append("{} {} {!r}".format(raw_column, comparison, float(value)))
+        else:
+            remaining.append((column, comparison, value))
+    return clauses, remaining
+
+def filter_mask(dataframe, filters):
+    """
+    Evaluates filters on a dataframe.
+
+    Arguments
+    ---------
+    dataframe : pd.Dataframe
+        Dataframe to be filtered
+    filters : list of tuple
+        (column, operator, value) per filter, e.g. ("energy", ">", 1000), where the operator is one of
+        ">", ">=", "<", "<=", "==" and "!="
+
+    Returns
+    -------
+    mask : np.ndarray
+        True for the rows which pass all filters
+    """
+    mask = np.ones(len(dataframe), dtype=bool)
+    for column, comparison, value in filters:
+        if(comparison not in filter_operators):
+            raise ValueError("Unknown filter operator '{}'".format(comparison))
+        mask &= filter_operators[comparison](dataframe[column].to_numpy(), value)
+    return mask
+
+def iter_h5_chunks(filepath, columns=None, chunksize=100000, float32=False, filters=None, dropna=False):
+    """
+    Reads an HDF file in chunks of rows, so that memory use does not depend on the size of the file.
+
+    Rows can be filtered while reading. For table-format stores, filters on data columns are evaluated by PyTables
+    (`where`), so that rows which do not pass are never read; all other filters are applied to each chunk as it is read.
+
+    Arguments
+    ---------
+    filepath : str
+        Path to the HDF file
+    columns : list or None
+        (Renamed) column names which should be loaded. If None, all columns are loaded.
+        Label columns ("Particle name", "Is shower?") are only added if requested; derived features (see `features.py`)
+        are computed from their dependencies, which are only kept if requested as well
+    chunksize : int
+        Number of rows per chunk (before filtering)
+    float32 : bool
+        Whether to store the floating point features as float32, see `load_from_h5`
+    filters : list of tuple or None
+        Filters the rows have to pass, see `filter_mask`. The filtered columns do not have to be in `columns`, and
+        can be label columns or derived features, which are then computed before they are filtered on
+    dropna : bool
+        Whether to drop rows with missing values in the loaded columns
+
+    Yields
+    ------
+    chunk : pd.Dataframe
+        Renamed columns of the next rows which pass the filters, keeping the row numbers of the file as index
+    """
+    filters = [] if filters is None else list(filters)
+    raw_columns = None if columns is None else raw_column_names(columns)
+    filter_columns = [column for column, comparison, value in filters]
+    add_label_columns = columns is not None and any(column in label_columns for column in columns)
+    #labels and derived features which are filtered on have to be computed before those filters are applied
+    label_filtered = any(column in label_columns for column in filter_columns)
+    derived_columns = [] if columns is None else [column for column in columns if column in derived_features]
+    derived_columns += [column for column in filter_columns if column in derived_features and column not in derived_columns]
+    #columns in the chunks: the requested ones and the raw columns of requested labels, or everything in the file
+    kept_columns = None
+    if(columns is not None):
+        kept_columns = list(columns) + [raw_column for column in columns for raw_column in label_columns.get(column, [])]
+
+    with pd.HDFStore(filepath, mode="r") as store:
+        key = store.keys()[0]
+        storer = store.get_storer(key)
+
+        clauses, remaining = [], filters
+        if(storer.is_table):
+            clauses, remaining = _split_filters(filters, storer.data_columns or [])
+        #columns which are only read to be filtered on
+        if(raw_columns is not None):
+            extra_columns = [column for column, comparison, value in remaining if column not in columns]
+            raw_columns = raw_columns + [column for column in raw_column_names(extra_columns) if column not in raw_columns]
+
+        if(storer.is_table):
+            chunks = store.select(key, where=clauses or None, columns=raw_columns, chunksize=chunksize)
+        else:
+            n_rows = storer.shape[0]
+            chunks = (store.select(key, start=start, stop=start + chunksize) for start in range(0, n_rows, chunksize))
+
+        #filters on stored columns are applied first, so that labels and derived features are computed for fewer rows
+        stored_filters, computed_filters = [], []
+        for column, comparison, value in remaining:
+            computed = column in label_columns or column in derived_features
+            (computed_filters if computed else stored_filters).append((column, comparison, value))
+        labels_added = add_label_columns or label_filtered
+
+        for chunk in chunks:
+            if(raw_columns is not None and not storer.is_table):
+                chunk = chunk[[column for column in chunk.columns if column in raw_columns]]
+            chunk = chunk.rename(column_renamer, axis="columns")
+
+            if(stored_filters):
+                chunk = chunk[filter_mask(chunk, stored_filters)]
+            if(labels_added):
+                add_labels(chunk)
+            if(derived_columns):
+                chunk = add_derived_features(chunk, derived_columns)
+            if(computed_filters):
+                chunk = chunk[filter_mask(chunk, computed_filters)]
+            if(kept_columns is None):
+                unrequested = feature_order(derived_columns) + (list(label_columns) if labels_added else [])
+            else:
+                unrequested = [column for column in chunk.columns if column not in kept_columns]
+            if(unrequested):
+                chunk = chunk.drop(columns=unrequested)
+            if(dropna):
+                chunk = chunk.dropna(subset=[column for column in chunk.columns if column not in label_columns])
+            yield compact_dtypes(chunk, integer_columns, float32)
+
+def _load_filtered_h5(filepath, columns, filters, dropna, chunksize, float32):
+    """Reads the rows of a single HDF file which pass the filters, chunk by chunk, and combines them."""
+    chunks = list(iter_h5_chunks(filepath, columns, chunksize, float32, filters, dropna))
+    if(not chunks):
+        return pd.DataFrame(columns=columns)
+    dataframe = pd.concat(chunks)
+    if(columns is None):
+        add_labels(dataframe)
     return dataframe
 
 def normalise_dataframe(dataframe, excluded_columns=[]):